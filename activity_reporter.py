@@ -1,18 +1,205 @@
 """
 קובץ פשוט לדיווח פעילות - העתק את הקובץ הזה לכל בוט
 """
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import json
+import logging
+import os
+import threading
+import time
+from pymongo import MongoClient, UpdateOne, timeout
+from datetime import datetime, timedelta, timezone
+
+from hll import estimate, merge_registers, registers_for
+
+logger = logging.getLogger(__name__)
+
+# כל כמה שניות נשלחת אצוות הפעילות למונגו, וכל כמה שניות לכל היותר מתעדכן מסמך השירות
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '5'))
+ACTIVITY_SERVICE_UPDATE_INTERVAL = float(os.getenv('ACTIVITY_SERVICE_UPDATE_INTERVAL', '30'))
+
+# זמן מקסימלי לפעולת מונגו - כשמונגו לא זמין נכשלים מהר במקום לחכות 30 שניות
+ACTIVITY_MONGO_TIMEOUT_MS = int(os.getenv('ACTIVITY_MONGO_TIMEOUT_MS', '2000'))
+# מפסק: אחרי X כשלונות רצופים מפסיקים לפנות למונגו למשך Y שניות
+ACTIVITY_BREAKER_FAILURES = int(os.getenv('ACTIVITY_BREAKER_FAILURES', '3'))
+ACTIVITY_BREAKER_RESET_SECONDS = float(os.getenv('ACTIVITY_BREAKER_RESET_SECONDS', '30'))
+# קובץ גיבוי מקומי לאירועים שלא נשלחו, עם תקרת גודל
+ACTIVITY_SPOOL_PATH = os.getenv('ACTIVITY_SPOOL_PATH', 'activity_spool.jsonl')
+ACTIVITY_SPOOL_MAX_MB = float(os.getenv('ACTIVITY_SPOOL_MAX_MB', '5'))
+
+def _day_key(moment):
+    return moment.strftime('%Y-%m-%d')
+
+
+def _hll_fields(registers):
+    """רגיסטרי HyperLogLog כשדות ל-$max במונגו: {"hll.<אינדקס>": דרגה}"""
+    return {f"hll.{index}": rank for index, rank in registers.items()}
+
+
+def _merge_users(target, batch):
+    """ממזג {user_id: [count, first, last]} לתוך target"""
+    for user_id, (count, first, last) in batch.items():
+        entry = target.get(user_id)
+        if entry is None:
+            target[user_id] = [count, first, last]
+        else:
+            entry[0] += count
+            entry[1] = min(entry[1], first)
+            entry[2] = max(entry[2], last)
+
+
+def _merge_days(target, days):
+    """ממזג {day: [count, users]} לתוך target"""
+    for day, (count, users) in days.items():
+        entry = target.setdefault(day, [0, set()])
+        entry[0] += count
+        entry[1].update(users)
+
+
+class CircuitBreaker:
+    """מפסק פשוט: סגור -> פתוח אחרי failure_threshold כשלונות רצופים.
+    כשהוא פתוח לא פונים לשרת; אחרי reset_timeout שניות מותר ניסיון אחד (חצי-פתוח),
+    והצלחה סוגרת אותו בחזרה.
+    """
+
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = ACTIVITY_BREAKER_FAILURES if failure_threshold is None else failure_threshold
+        self.reset_timeout = ACTIVITY_BREAKER_RESET_SECONDS if reset_timeout is None else reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # ניסיון יחיד; כשלון נוסף יפתח את המפסק מחדש לתקופה מלאה
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning("מונגו לא זמין - דיווחי הפעילות עוברים לקובץ הגיבוי")
+                self.opened_at = time.monotonic()
+
+
+class ActivitySpool:
+    """קובץ JSONL שמצטברים בו אירועים שלא נשלחו (append בלבד, עם תקרת גודל).
+    בשליחה החוזרת הקובץ נקרא, מתמזג לאצווה אחת ומתרוקן.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or ACTIVITY_SPOOL_PATH
+        self.max_bytes = int(ACTIVITY_SPOOL_MAX_MB * 1024 * 1024) if max_bytes is None else max_bytes
+        self.dropped = 0
+
+    def append(self, batch, days):
+        lines = [
+            json.dumps({"u": user_id, "n": count, "f": first.isoformat(), "l": last.isoformat()})
+            for user_id, (count, first, last) in batch.items()
+        ] + [
+            json.dumps({"d": day, "n": count, "users": sorted(users)})
+            for day, (count, users) in days.items()
+        ]
+        if not lines:
+            return
+        data = "\n".join(lines) + "\n"
+        try:
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if size + len(data) > self.max_bytes:
+                self.dropped += len(lines)
+                logger.warning(f"קובץ הגיבוי של הפעילות מלא - {len(lines)} רשומות נזרקו")
+                return
+            with open(self.path, 'a', encoding='utf-8') as handle:
+                handle.write(data)
+        except OSError as e:
+            self.dropped += len(lines)
+            logger.warning(f"כתיבה לקובץ הגיבוי נכשלה: {e}")
+
+    def load(self):
+        """קורא את כל הקובץ וממזג אותו ל-(batch, days)"""
+        batch, days = {}, {}
+        try:
+            with open(self.path, encoding='utf-8') as handle:
+                for line in handle:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "u" in record:
+                        _merge_users(batch, {record["u"]: [
+                            record["n"],
+                            datetime.fromisoformat(record["f"]),
+                            datetime.fromisoformat(record["l"]),
+                        ]})
+                    elif "d" in record:
+                        _merge_days(days, {record["d"]: [record["n"], set(record["users"])]})
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"קריאת קובץ הגיבוי נכשלה: {e}")
+        return batch, days
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"ריקון קובץ הגיבוי נכשל: {e}")
+
+    def rewrite(self, batch, days):
+        """דחיסה: מחליף את הקובץ בגרסה הממוזגת שלו"""
+        self.clear()
+        self.append(batch, days)
+
+
+def _op_timeout():
+    """מגביל את כל פעולות המונגו בבלוק (גם על client משותף עם זמנים ארוכים יותר)"""
+    return timeout(ACTIVITY_MONGO_TIMEOUT_MS / 1000)
+
 
 class SimpleActivityReporter:
-    def __init__(self, mongodb_uri, service_id, service_name=None):
+    def __init__(self, mongodb_uri, service_id, service_name=None, client=None,
+                 service_update_interval=None):
         """
         mongodb_uri: חיבור למונגו (אותו מהבוט המרכזי)
         service_id: מזהה השירות ב-Render
         service_name: שם הבוט (אופציונלי)
+        client: MongoClient קיים לשימוש משותף (אופציונלי - אחרת נוצר חדש)
+        service_update_interval: כל כמה שניות לכל היותר מתעדכן מסמך השירות
         """
+        self.breaker = CircuitBreaker()
+        self.service_update_interval = (ACTIVITY_SERVICE_UPDATE_INTERVAL
+                                        if service_update_interval is None else service_update_interval)
+        self._service_lock = threading.Lock()
+        self._service_last_activity = None
+        self._service_updated_at = 0.0
+        # רגיסטרי HLL של משתמשים שעוד לא נכנסו למסמך השירות
+        self._service_registers = {}
+        # סקיצת כל המשתמשים (נטענת פעם אחת ממסמך השירות) - ממנה מחושב total_users
+        self._lifetime_registers = None
         try:
-            self.client = MongoClient(mongodb_uri)
+            # MongoClient מתחבר בעצלות; הזמנים הקצרים מגבילים כל פעולה כשהשרת לא זמין
+            self.client = client or MongoClient(
+                mongodb_uri,
+                serverSelectionTimeoutMS=ACTIVITY_MONGO_TIMEOUT_MS,
+                connectTimeoutMS=ACTIVITY_MONGO_TIMEOUT_MS,
+                socketTimeoutMS=ACTIVITY_MONGO_TIMEOUT_MS,
+            )
             self.db = self.client["render_bot_monitor"]
             self.service_id = service_id
             self.service_name = service_name or service_id
@@ -23,47 +210,331 @@ class SimpleActivityReporter:
 
     def report_activity(self, user_id):
         """דיווח פעילות פשוט"""
-        if not self.connected:
+        if not self.connected or not self.breaker.allow():
             return
 
+        now = datetime.now(timezone.utc)
+        batch = {user_id: [1, now, now]}
         try:
-            now = datetime.now(timezone.utc)
+            # אותו מסלול כתיבה כמו באצוות של BufferedActivityReporter
+            self._write_activity(batch, {_day_key(now): [1, {user_id}]})
+        except Exception:
+            # שקט - אל תיכשל את הבוט אם יש בעיה
+            self.breaker.record_failure()
+            return
+
+        with self._service_lock:
+            self._note_service_activity(batch)
+            self._update_service(False)
 
-            # עדכון אינטראקציית המשתמש
-            self.db.user_interactions.update_one(
+    def _write_activity(self, batch, days):
+        """כותב אצווה: bulk_write אחד ל-user_interactions ואחד לדליים היומיים.
+        חריגה = האינטראקציות לא נכתבו. מחזיר False אם רק הדליים נכשלו.
+        """
+        operations = [
+            UpdateOne(
                 {"service_id": self.service_id, "user_id": user_id},
                 {
-                    "$set": {"last_interaction": now},
-                    "$inc": {"interaction_count": 1},
-                    "$setOnInsert": {"created_at": now}
+                    "$inc": {"interaction_count": count},
+                    "$max": {"last_interaction": last},
+                    "$setOnInsert": {"created_at": first},
                 },
-                upsert=True
+                upsert=True,
             )
+            for user_id, (count, first, last) in batch.items()
+        ]
+        now = datetime.now(timezone.utc)
+        buckets = [
+            UpdateOne(*self._day_bucket_update(day, count, users, now), upsert=True)
+            for day, (count, users) in days.items()
+        ]
+        with _op_timeout():
+            if operations:
+                self.db.user_interactions.bulk_write(operations, ordered=False)
+        self.breaker.record_success()
+        try:
+            with _op_timeout():
+                if buckets:
+                    self.db.activity_daily.bulk_write(buckets, ordered=False)
+        except Exception:
+            self.breaker.record_failure()
+            return False
+        return True
 
-            # עדכון פעילות השירות
-            self.db.service_activity.update_one(
-                {"_id": self.service_id},
-                {
-                    "$set": {
-                        "last_user_activity": now,
-                        "service_name": self.service_name,
-                        "updated_at": now
-                    },
-                    "$setOnInsert": {
-                        "created_at": now,
-                        "status": "active",
-                        "total_users": 0,
-                        "suspend_count": 0
-                    }
-                },
-                upsert=True
-            )
+    def _note_service_activity(self, batch):
+        """צובר למסמך השירות את המשתמשים שנכתבו ואת זמן הפעילות האחרון"""
+        merge_registers(self._service_registers, registers_for(batch))
+        latest = max((last for _count, _first, last in batch.values()), default=None)
+        if latest and (self._service_last_activity is None or latest > self._service_last_activity):
+            self._service_last_activity = latest
+
+    def _lifetime_estimate(self, registers):
+        """total_users מהסקיצה שבזיכרון: הסקיצה של מסמך השירות נקראת פעם אחת לתהליך,
+        ומשם רק ממזגים אליה את המשתמשים החדשים - בלי למשוך את השדות בכל עדכון.
+        """
+        if self._lifetime_registers is None:
+            doc = self.db.service_activity.find_one({"_id": self.service_id}, {"hll": 1}) or {}
+            self._lifetime_registers = merge_registers({}, doc.get("hll", {}))
+        merge_registers(self._lifetime_registers, registers)
+        return estimate(self._lifetime_registers)
 
+    def _update_service(self, force):
+        """עדכון מסמך השירות (כולל total_users) בכתיבה אחת - לכל היותר פעם ב-service_update_interval שניות"""
+        if self._service_last_activity is None:
+            return
+        now = datetime.now(timezone.utc)
+        if not force and now.timestamp() - self._service_updated_at < self.service_update_interval:
+            return
+        if self.breaker.is_open:
+            return
+        try:
+            with _op_timeout():
+                total_users = self._lifetime_estimate(self._service_registers)
+                self.db.service_activity.update_one(
+                    {"_id": self.service_id},
+                    {
+                        "$max": {
+                            "last_user_activity": self._service_last_activity,
+                            "total_users": total_users,
+                            **_hll_fields(self._service_registers),
+                        },
+                        "$set": {"service_name": self.service_name, "updated_at": now},
+                        "$setOnInsert": {
+                            "created_at": now,
+                            "status": "active",
+                            "suspend_count": 0
+                        }
+                    },
+                    upsert=True,
+                )
+            self._service_last_activity = None
+            self._service_registers = {}
+            self._service_updated_at = now.timestamp()
         except Exception:
-            # שקט - אל תיכשל את הבוט אם יש בעיה
-            pass
+            self.breaker.record_failure()
+
+    def _day_bucket_update(self, day, activities, user_ids, now):
+        """(filter, update) לדלי היומי של השירות: מונה פעילויות, קבוצת משתמשים וסקיצת HLL"""
+        return (
+            {"_id": f"{self.service_id}:{day}"},
+            {
+                "$inc": {"total_activities": activities},
+                "$addToSet": {"users": {"$each": list(user_ids)}},
+                "$max": _hll_fields(registers_for(user_ids)),
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"service_id": self.service_id, "date": day},
+            },
+        )
+
+    def get_weekly_stats(self):
+        """סטטיסטיקות ל-7 הימים האחרונים מתוך הדליים היומיים"""
+        return self._period_stats(7, "7 הימים האחרונים")
+
+    def get_monthly_stats(self):
+        """סטטיסטיקות ל-30 הימים האחרונים מתוך הדליים היומיים"""
+        return self._period_stats(30, "30 הימים האחרונים")
+
+    def get_unique_users(self):
+        """אומדן משתמשים ייחודיים מסקיצות HyperLogLog: {dau, wau, mau, lifetime}.
+        קורא את 30 הדליים היומיים ואת מסמך השירות בלבד, בלי קשר למספר המשתמשים.
+        """
+        if not self.connected:
+            return {"error": "אין חיבור למונגו"}
+        if not self.breaker.allow():
+            return {"error": "מונגו לא זמין כרגע"}
+        try:
+            today = datetime.now(timezone.utc)
+            day_keys = [_day_key(today - timedelta(days=offset)) for offset in range(30)]
+            with _op_timeout():
+                sketches = {
+                    doc["date"]: doc.get("hll", {})
+                    for doc in self.db.activity_daily.find(
+                        {"_id": {"$in": [f"{self.service_id}:{day}" for day in day_keys]}},
+                        {"date": 1, "hll": 1},
+                    )
+                }
+                service = self.db.service_activity.find_one({"_id": self.service_id}, {"hll": 1}) or {}
+
+            result = {}
+            for name, days in (("dau", 1), ("wau", 7), ("mau", 30)):
+                merged = {}
+                for day in day_keys[:days]:
+                    merge_registers(merged, sketches.get(day, {}))
+                result[name] = estimate(merged)
+            result["lifetime"] = estimate(service.get("hll", {}))
+            return result
+        except Exception as e:
+            self.breaker.record_failure()
+            return {"error": str(e)}
+
+    def _period_stats(self, days, period):
+        """קורא לכל היותר מסמך אחד לכל יום בתקופה (כולל היום).
+        מחזיר {period, unique_users, total_activities, daily_breakdown} - הפירוט מהיום החדש לישן.
+        """
+        if not self.connected:
+            return {"error": "אין חיבור למונגו"}
+        if not self.breaker.allow():
+            return {"error": "מונגו לא זמין כרגע"}
+        try:
+            today = datetime.now(timezone.utc)
+            day_keys = [_day_key(today - timedelta(days=offset)) for offset in range(days)]
+            with _op_timeout():
+                docs = {
+                    doc["date"]: doc
+                    for doc in self.db.activity_daily.find(
+                        {"_id": {"$in": [f"{self.service_id}:{day}" for day in day_keys]}},
+                        {"date": 1, "users": 1, "total_activities": 1},
+                    )
+                }
+
+            all_users = set()
+            total = 0
+            breakdown = []
+            for day in day_keys:
+                doc = docs.get(day, {})
+                users = doc.get("users", [])
+                all_users.update(users)
+                total += doc.get("total_activities", 0)
+                breakdown.append({
+                    "date": datetime.strptime(day, '%Y-%m-%d').strftime('%d/%m/%Y'),
+                    "unique_users_count": len(users),
+                    "total_activities": doc.get("total_activities", 0),
+                })
+
+            return {
+                "period": period,
+                "unique_users": len(all_users),
+                "total_activities": total,
+                "daily_breakdown": breakdown,
+            }
+        except Exception as e:
+            self.breaker.record_failure()
+            return {"error": str(e)}
+
+    def close(self):
+        """שולח את עדכון מסמך השירות שעוד לא נכתב (כל שאר הדיווחים נכתבים מיד)"""
+        if self.connected:
+            with self._service_lock:
+                self._update_service(True)
+
+
+class BufferedActivityReporter(SimpleActivityReporter):
+    """דיווח פעילות בלי גישה לרשת בזמן ה-handler.
+
+    report_activity רק מעדכן מונה בזיכרון (אינטראקציות מאותו משתמש מתאחדות),
+    וחוט רקע שולח כל flush_interval שניות bulk_write אחד עם upsert לכל משתמש
+    ($inc למונה, $max לזמן האחרון), ועדכון אחד של מסמך השירות לכל היותר
+    פעם ב-service_update_interval שניות.
+
+    כשמונגו נכשל האצווה נכתבת לקובץ הגיבוי (spool) והמפסק נפתח; בזמן שהוא
+    פתוח האצוות הולכות ישר לקובץ, ואחרי ההתאוששות הקובץ נשלח כאצווה אחת.
+    """
+
+    def __init__(self, mongodb_uri, service_id, service_name=None,
+                 flush_interval=None, service_update_interval=None, spool_path=None, client=None):
+        super().__init__(mongodb_uri, service_id, service_name, client=client,
+                         service_update_interval=service_update_interval)
+        self.spool = ActivitySpool(spool_path)
+        self.flush_interval = ACTIVITY_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        # user_id -> [מספר אינטראקציות, ראשונה, אחרונה]
+        self._pending = {}
+        # יום -> [מספר פעילויות, קבוצת משתמשים] לדליים היומיים
+        self._pending_days = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def report_activity(self, user_id):
+        """רושם אינטראקציה בזיכרון - בלי I/O"""
+        if not self.connected:
+            return
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            entry = self._pending.get(user_id)
+            if entry is None:
+                self._pending[user_id] = [1, now, now]
+            else:
+                entry[0] += 1
+                entry[2] = now
+            day = self._pending_days.setdefault(_day_key(now), [0, set()])
+            day[0] += 1
+            day[1].add(user_id)
+            if self._thread is None and not self._stop_event.is_set():
+                self._thread = threading.Thread(target=self._run, name="activity-reporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def _take_pending(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            days, self._pending_days = self._pending_days, {}
+        return batch, days
+
+    def flush(self, force_service_update=False):
+        """שולח את מה שהצטבר (כולל קובץ הגיבוי). מחזיר את מספר המשתמשים שנכתבו"""
+        with self._flush_lock:
+            batch, days = self._take_pending()
+            if not self.breaker.allow():
+                self.spool.append(batch, days)
+                return 0
+
+            # שליחה חוזרת של מה שנשמר בקובץ בזמן התקלה, ממוזג לאצווה הנוכחית
+            spooled_batch, spooled_days = self.spool.load()
+            spooled = bool(spooled_batch or spooled_days)
+            if spooled:
+                _merge_users(spooled_batch, batch)
+                _merge_days(spooled_days, days)
+                batch, days = spooled_batch, spooled_days
+
+            if batch or days:
+                try:
+                    days_written = self._write_activity(batch, days)
+                except Exception as e:
+                    self.breaker.record_failure()
+                    logger.debug(f"שליחת הפעילות למונגו נכשלה: {e}")
+                    if spooled:
+                        self.spool.rewrite(batch, days)
+                    else:
+                        self.spool.append(batch, days)
+                    return 0
+                if spooled:
+                    self.spool.clear()
+                if not days_written:
+                    # האינטראקציות כבר נכתבו - שומרים רק את הדליים
+                    self.spool.append({}, days)
+                self._note_service_activity(batch)
+
+            self._update_service(force_service_update)
+            return len(batch)
+
+    def get_unique_users(self):
+        self.flush()
+        return super().get_unique_users()
+
+    def _period_stats(self, days, period):
+        # קודם שולחים את מה שבזיכרון כדי שהסטטיסטיקה תכלול גם אותו
+        self.flush()
+        return super()._period_stats(days, period)
+
+    def close(self):
+        """עוצר את חוט הרקע ושולח את כל מה שנשאר (בטוח לקרוא כמה פעמים)"""
+        self._stop_event.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout=self.flush_interval + 5)
+        if self.connected:
+            self.flush(force_service_update=True)
+
 
 # דוגמה לשימוש קל
-def create_reporter(mongodb_uri, service_id, service_name=None):
-    """יצירת reporter פשוט"""
-    return SimpleActivityReporter(mongodb_uri, service_id, service_name)
\ No newline at end of file
+def create_reporter(mongodb_uri, service_id, service_name=None, buffered=True, client=None):
+    """יצירת reporter - ברירת המחדל מאחדת דיווחים ושולחת אותם ברקע.
+    client: MongoClient משותף, אם הבוט כבר מחזיק אחד לאותו שרת
+    """
+    if buffered:
+        return BufferedActivityReporter(mongodb_uri, service_id, service_name, client=client)
+    return SimpleActivityReporter(mongodb_uri, service_id, service_name, client=client)
\ No newline at end of file
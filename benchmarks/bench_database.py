@@ -0,0 +1,105 @@
+"""
+מדידת קריאות לשנייה בשכבת ה-SQLite: לפני (חיבור חדש בכל קריאה) ואחרי (ConnectionManager)
+להרצה: python benchmarks/bench_database.py [--calls 5000]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+class LegacyDatabaseManager:
+    """העתק של הדפוס הישן: sqlite3.connect חדש בכל קריאה, journal ברירת מחדל"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # הסכמה המקורית: טבלאות רגילות בלי אינדקסים ובלי כוונון
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('''
+                CREATE TABLE customer_requests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                    username TEXT, full_name TEXT, message_text TEXT NOT NULL,
+                    phone_number TEXT, email TEXT, status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE bot_stats (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                    action TEXT NOT NULL, data TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+    def log_user_action(self, user_id, action, data=None):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT INTO bot_stats (user_id, action, data) VALUES (?, ?, ?)',
+                    (user_id, action, data),
+                )
+        finally:
+            conn.close()
+
+    def get_request_by_id(self, request_id):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM customer_requests WHERE id = ?', (request_id,)).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+
+
+def _rate(fn, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    return calls / (time.perf_counter() - start)
+
+
+def run(calls: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = LegacyDatabaseManager(os.path.join(tmp, 'legacy.db'))
+        tuned = database.DatabaseManager(os.path.join(tmp, 'tuned.db'))
+
+        for db in (legacy, tuned):
+            if db is tuned:
+                db.save_customer_request(1, 'bench', 'Bench User', 'hello')
+            else:
+                with sqlite3.connect(db.db_path) as conn:
+                    conn.execute(
+                        "INSERT INTO customer_requests (user_id, username, full_name, message_text) "
+                        "VALUES (1, 'bench', 'Bench User', 'hello')"
+                    )
+
+        results = {
+            'write (log_user_action)': (
+                _rate(lambda i: legacy.log_user_action(i, 'bench'), calls),
+                _rate(lambda i: tuned.log_user_action(i, 'bench'), calls),
+            ),
+            'read (get_request_by_id)': (
+                _rate(lambda i: legacy.get_request_by_id(1), calls),
+                _rate(lambda i: tuned.get_request_by_id(1), calls),
+            ),
+        }
+        tuned.close()
+
+    print(f"{'path':<28}{'before/s':>12}{'after/s':>12}{'speedup':>10}")
+    for name, (before, after) in results.items():
+        print(f"{name:<28}{before:>12.0f}{after:>12.0f}{after / before:>9.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=5000)
+    run(parser.parse_args().calls)
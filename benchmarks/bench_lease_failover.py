@@ -0,0 +1,63 @@
+"""
+זמן השתלטות של standby על נעילת ה-lease אחרי שהמחזיק מפסיק לחדש (קריסה / SIGKILL).
+דורש mongod מקומי. להרצה: python benchmarks/bench_lease_failover.py [--uri mongodb://localhost:27017]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import MongoClient  # noqa: E402
+
+import lease  # noqa: E402
+
+LOCK_ID = 'bench_failover_lock'
+
+
+def _takeover_delay(collection, lease_seconds: float, poll_ms: float, legacy: bool) -> float:
+    """שניות מרגע פקיעת ה-lease של המחזיק ועד שה-standby מחזיק בנעילה"""
+    holder, standby = f"holder-{uuid.uuid4()}", f"standby-{uuid.uuid4()}"
+    collection.delete_many({"_id": LOCK_ID})
+    assert lease.try_acquire(collection, LOCK_ID, holder, lease_seconds)
+    # המחזיק "קורס" עכשיו - אין יותר חידושים
+    expires_at = time.monotonic() + lease_seconds
+    while True:
+        if lease.try_acquire(collection, LOCK_ID, standby, lease_seconds):
+            return time.monotonic() - expires_at
+        if legacy:
+            # ההתנהגות הקודמת: המתנה אקראית של 15-45 שניות בין ניסיונות
+            time.sleep(random.uniform(15, 45))
+        else:
+            time.sleep(poll_ms / 1000.0)
+
+
+def run(uri: str, trials: int, lease_seconds: float, poll_ms: float, legacy: bool) -> None:
+    client = MongoClient(uri, serverSelectionTimeoutMS=3000)
+    collection = client['bench_lease']['locks']
+    delays = [_takeover_delay(collection, lease_seconds, poll_ms, legacy) for _ in range(trials)]
+    collection.delete_many({"_id": LOCK_ID})
+    client.close()
+
+    delays.sort()
+    p95 = delays[min(len(delays) - 1, int(len(delays) * 0.95))]
+    mode = 'legacy 15-45s backoff' if legacy else f'hot standby, poll {poll_ms:g}ms'
+    print(f"{trials} trials, lease {lease_seconds:g}s, {mode}")
+    print(f"takeover after expiry: p50 {statistics.median(delays) * 1000:.0f}ms, "
+          f"p95 {p95 * 1000:.0f}ms, max {delays[-1] * 1000:.0f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--lease', type=float, default=2.0)
+    parser.add_argument('--poll-ms', type=float, default=250)
+    parser.add_argument('--legacy', action='store_true')
+    args = parser.parse_args()
+    run(args.uri, args.trials, args.lease, args.poll_ms, args.legacy)
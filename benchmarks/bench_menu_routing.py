@@ -0,0 +1,81 @@
+"""
+עלות ניתוב לחיצת כפתור: שרשרת if/elif + בניית מקלדת בכל תשובה (לפני)
+מול Menu - filters.Text על set, שליפה ממילון ומקלדת מוכנה (אחרי), עבור כמה גדלי תפריט.
+להרצה: python benchmarks/bench_menu_routing.py [--iterations 20000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import KeyboardButton, ReplyKeyboardMarkup, Update  # noqa: E402
+from telegram.ext import MessageHandler, filters  # noqa: E402
+
+import config  # noqa: E402
+import menu  # noqa: E402
+
+
+def _update(text: str) -> Update:
+    return Update.de_json({"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": 5, "type": "private"},
+        "from": {"id": 5, "is_bot": False, "first_name": "Bench"}}}, None)
+
+
+def _labels(size: int):
+    return [f"כפתור {i}" for i in range(size)]
+
+
+def legacy_route(labels):
+    """כמו handle_message הישן: השוואת מחרוזות לפי הסדר ואז בניית מקלדת חדשה"""
+    text_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, None)
+
+    def route(update):
+        text_handler.check_update(update)
+        text = update.message.text
+        chosen = None
+        for label in labels:
+            if text == label:
+                chosen = label
+                break
+        keyboard = ReplyKeyboardMarkup([[KeyboardButton(label)] for label in labels],
+                                       resize_keyboard=True, one_time_keyboard=False)
+        return chosen, keyboard
+
+    return route
+
+
+def menu_route(labels):
+    """Menu: handler אחד עם filters.Text על frozenset, שליפה ממילון ומקלדת מוכנה"""
+    for i, label in enumerate(labels):
+        config.BUTTON_TEXTS[f'bench_{i}'] = label
+    bench_menu = menu.Menu([menu.MenuItem(f'bench_{i}', f'action_{i}', reply='x') for i in range(len(labels))])
+    handler = bench_menu.handler()
+
+    def route(update):
+        handler.check_update(update)
+        return bench_menu.item_for(update.message.text), bench_menu.keyboard
+
+    return route
+
+
+def run(iterations: int) -> None:
+    print(f"{'buttons':>8}{'before (us)':>14}{'after (us)':>14}{'ratio':>9}")
+    for size in (4, 16, 64):
+        labels = _labels(size)
+        # הכפתור האחרון - המקרה הגרוע לשרשרת ההשוואות
+        update = _update(labels[-1])
+        before = legacy_route(labels)
+        after = menu_route(labels)
+        t_before = min(timeit.repeat(lambda: before(update), number=iterations, repeat=3)) / iterations
+        t_after = min(timeit.repeat(lambda: after(update), number=iterations, repeat=3)) / iterations
+        print(f"{size:>8}{t_before * 1e6:>14.2f}{t_after * 1e6:>14.2f}{t_before / t_after:>8.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20000)
+    run(parser.parse_args().iterations)
@@ -0,0 +1,99 @@
+"""
+פרץ הודעות יוצאות מול שרת שמדמה את flood control של טלגרם (429 מעל הקצב הגלובלי).
+לפני: שליחה ישירה לכל הודעה + retry_on_error עם ניסיון חוזר אחד. אחרי: OutboundRateLimiter.
+מודדים כמה 429 התקבלו, כמה הודעות אבדו, וזמן ההמתנה של תשובה למשתמש שנשלחה באמצע הפרץ.
+להרצה: python benchmarks/bench_outbound_burst.py [--messages 120] [--limit 30]
+"""
+
+import argparse
+import asyncio
+import datetime as dtm
+import logging
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import RetryAfter  # noqa: E402
+
+import outbound  # noqa: E402
+import utils  # noqa: E402
+
+warnings.simplefilter('ignore')
+logging.disable(logging.CRITICAL)
+
+
+class FakeTelegram:
+    """חלון של שנייה: מעל limit בקשות מוחזר RetryAfter עד סוף החלון"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.window_start = time.monotonic()
+        self.in_window = 0
+        self.flood_errors = 0
+
+    async def send(self):
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start, self.in_window = now, 0
+        if self.in_window >= self.limit:
+            self.flood_errors += 1
+            raise RetryAfter(dtm.timedelta(seconds=1 - (now - self.window_start)))
+        self.in_window += 1
+        await asyncio.sleep(0.002)
+        return True
+
+
+async def _before(count: int, limit: int):
+    server = FakeTelegram(limit)
+
+    @utils.retry_on_error(max_retries=1, delay=0.1)
+    async def send():
+        return await server.send()
+
+    async def safe(i):
+        try:
+            started = time.monotonic()
+            await send()
+            return time.monotonic() - started
+        except RetryAfter:
+            return None
+
+    results = await asyncio.gather(*(safe(i) for i in range(count)))
+    return server.flood_errors, sum(r is None for r in results), results[count // 2]
+
+
+async def _after(count: int, limit: int):
+    server = FakeTelegram(limit)
+    limiter = outbound.OutboundRateLimiter(global_per_second=limit * 0.9, chat_per_second=1000)
+
+    async def send(i, priority):
+        started = time.monotonic()
+        await limiter.process_request(server.send, (), {}, 'sendMessage', {'chat_id': i + 1}, priority)
+        return time.monotonic() - started
+
+    tasks = [asyncio.create_task(send(i, outbound.PRIORITY_BACKGROUND)) for i in range(count)]
+    await asyncio.sleep(0)
+    reply = asyncio.create_task(send(count, outbound.PRIORITY_REPLY))
+    results = await asyncio.gather(*tasks, reply, return_exceptions=True)
+    await limiter.shutdown()
+    lost = sum(isinstance(r, Exception) for r in results)
+    return server.flood_errors, lost, results[-1]
+
+
+def run(count: int, limit: int) -> None:
+    print(f"{'':>8}{'429s':>8}{'lost':>8}{'reply wait (s)':>16}")
+    for name, scenario in (('before', _before), ('after', _after)):
+        errors, lost, reply_wait = asyncio.run(scenario(count, limit))
+        wait = f"{reply_wait:.2f}" if reply_wait is not None else "lost"
+        print(f"{name:>8}{errors:>8}{lost:>8}{wait:>16}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=120)
+    parser.add_argument('--limit', type=int, default=30)
+    args = parser.parse_args()
+    run(args.messages, args.limit)
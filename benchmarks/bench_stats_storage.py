@@ -0,0 +1,149 @@
+"""
+השוואת גודל קובץ ומהירות סריקה של bot_stats: פורמט טקסט (לפני) מול פורמט קומפקטי (אחרי)
+על נתונים סינתטיים. להרצה: python benchmarks/bench_stats_storage.py [--events 10000000]
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+ACTIONS = ['start', 'open_whatsapp', 'view_info', 'share_to_friend',
+           'callback_request_opened', 'contact_details_submitted']
+MONTH = '202501'
+MONTH_START = 1735689600  # 2025-01-01 00:00:00 UTC
+MONTH_SECONDS = 31 * 24 * 3600
+CHUNK = 50000
+
+
+def _events(count: int, users: int, seed: int = 7):
+    """(user_id, action, data, epoch) - כ-5% מהאירועים עם data, כמו /start"""
+    rnd = random.Random(seed)
+    step = MONTH_SECONDS / count
+    for i in range(count):
+        action = rnd.choice(ACTIONS)
+        user_id = rnd.randrange(100000, 100000 + users)
+        data = None
+        if action == 'start' and rnd.random() < 0.3:
+            data = json.dumps({'username': f'user{user_id}', 'first_name': 'Bench'})
+        yield user_id, action, data, MONTH_START + int(i * step)
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    return conn
+
+
+def build_legacy(path: str, count: int, users: int):
+    """הפורמט הקודם: action ו-timestamp כטקסט, עם האינדקסים של גרסה 1"""
+    conn = _open(path)
+    conn.execute('''
+        CREATE TABLE bot_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+            action TEXT NOT NULL, data TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_stats_timestamp_user ON bot_stats(timestamp, user_id)')
+    conn.execute('CREATE INDEX idx_stats_user_timestamp ON bot_stats(user_id, timestamp)')
+    for chunk in _chunks(_events(count, users)):
+        conn.executemany(
+            'INSERT INTO bot_stats (user_id, action, data, timestamp) VALUES (?, ?, ?, ?)',
+            [(u, a, d, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))) for u, a, d, ts in chunk],
+        )
+        conn.commit()
+    conn.close()
+
+
+def build_compact(path: str, count: int, users: int):
+    """הפורמט החדש: מחיצה חודשית עם קוד פעולה ו-epoch, כפי ש-database יוצר אותה"""
+    conn = _open(path)
+    conn.execute('CREATE TABLE actions (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+    conn.executemany('INSERT INTO actions (name) VALUES (?)', [(name,) for name in ACTIONS])
+    ids = {name: i for i, name in conn.execute('SELECT id, name FROM actions')}
+    database._create_partition(conn, MONTH)
+    database._rebuild_stats_view(conn, [MONTH])
+    table = database._partition_table(MONTH)
+    for chunk in _chunks(_events(count, users)):
+        conn.executemany(
+            f'INSERT INTO {table} (ts, user_id, action_id, data) VALUES (?, ?, ?, ?)',
+            [(ts, u, ids[a], d) for u, a, d, ts in chunk],
+        )
+        conn.commit()
+    conn.close()
+
+
+def _timed(conn: sqlite3.Connection, sql: str, params=()) -> float:
+    start = time.perf_counter()
+    conn.execute(sql, params).fetchall()
+    return time.perf_counter() - start
+
+
+def measure(path: str, queries) -> dict:
+    conn = sqlite3.connect(path)
+    results = {'size (MB)': os.path.getsize(path) / 1024 / 1024}
+    for name, sql, params in queries:
+        _timed(conn, sql, params)  # חימום מטמון הדפים
+        results[name] = _timed(conn, sql, params)
+    conn.close()
+    return results
+
+
+def run(count: int, users: int) -> None:
+    week_start = MONTH_START + MONTH_SECONDS - 7 * 24 * 3600
+    week_start_str = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(week_start))
+    table = database._partition_table(MONTH)
+
+    legacy_queries = [
+        ('full scan by action (s)', 'SELECT action, COUNT(*) FROM bot_stats GROUP BY action', ()),
+        ('7d active users (s)', 'SELECT COUNT(DISTINCT user_id) FROM bot_stats WHERE timestamp > ?',
+         (week_start_str,)),
+    ]
+    compact_queries = [
+        ('full scan by action (s)',
+         f'SELECT a.name, c.n FROM (SELECT action_id, COUNT(*) AS n FROM {table} GROUP BY action_id) c '
+         f'JOIN actions a ON a.id = c.action_id', ()),
+        ('7d active users (s)', f'SELECT COUNT(DISTINCT user_id) FROM {table} WHERE ts > ?', (week_start,)),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        compact_path = os.path.join(tmp, 'compact.db')
+        build_legacy(legacy_path, count, users)
+        build_compact(compact_path, count, users)
+        before = measure(legacy_path, legacy_queries)
+        after = measure(compact_path, compact_queries)
+
+    print(f"{count:,} events, {users:,} users")
+    print(f"{'metric':<28}{'before':>12}{'after':>12}{'ratio':>10}")
+    for name in before:
+        print(f"{name:<28}{before[name]:>12.2f}{after[name]:>12.2f}{before[name] / after[name]:>9.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--events', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=50_000)
+    args = parser.parse_args()
+    run(args.events, args.users)
@@ -0,0 +1,65 @@
+"""
+תפוקת עיבוד עדכונים כשה-handlers ממתינים ל-I/O: עיבוד סדרתי (ברירת המחדל של PTB, לפני)
+מול PerUserUpdateProcessor (אחרי), עבור כמה רמות מקביליות. ה-handler מדמה קריאת רשת ב-sleep.
+להרצה: python benchmarks/bench_update_concurrency.py [--updates 400] [--users 50] [--io-ms 20]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import SimpleUpdateProcessor  # noqa: E402
+
+import update_processor  # noqa: E402
+
+
+def _updates(count: int, users: int):
+    rng = random.Random(1)
+    return [Update.de_json({"update_id": i, "message": {
+        "message_id": i, "date": 0, "text": "x",
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": "Bench"}}}, None)
+        for i, uid in ((i, rng.randrange(users)) for i in range(count))]
+
+
+async def _drive(processor, updates, io_seconds: float) -> float:
+    async def handler(update):
+        await asyncio.sleep(io_seconds)
+
+    async with processor:
+        started = time.perf_counter()
+        if processor.max_concurrent_updates > 1:
+            await asyncio.gather(*(processor.process_update(u, handler(u)) for u in updates))
+        else:
+            # כמו ה-fetcher של PTB במצב סדרתי: עדכון אחרי עדכון
+            for u in updates:
+                await processor.process_update(u, handler(u))
+        return time.perf_counter() - started
+
+
+def run(count: int, users: int, io_ms: float) -> None:
+    updates = _updates(count, users)
+    io_seconds = io_ms / 1000
+    sequential = asyncio.run(_drive(SimpleUpdateProcessor(1), updates, io_seconds))
+    print(f"{'concurrency':>12}{'updates/s':>12}{'wait avg ms':>13}{'wait max ms':>13}")
+    print(f"{'sequential':>12}{count / sequential:>12.0f}{'-':>13}{'-':>13}")
+    for concurrency in (4, 16, 64):
+        processor = update_processor.PerUserUpdateProcessor(concurrency)
+        elapsed = asyncio.run(_drive(processor, updates, io_seconds))
+        m = processor.metrics()
+        print(f"{concurrency:>12}{count / elapsed:>12.0f}{m['wait_avg_ms']:>13.1f}{m['wait_max_ms']:>13.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=400)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--io-ms', type=float, default=20)
+    args = parser.parse_args()
+    run(args.updates, args.users, args.io_ms)
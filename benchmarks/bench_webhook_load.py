@@ -0,0 +1,135 @@
+"""
+עומס על שרת ה-webhook עם לקוח "טלגרם" מקומי מזויף: זמן תגובה לבקשה ותפוקה,
+מענה מיידי אחרי הכנסה לתור (אחרי) מול מענה רק בסיום ה-handler (לפני).
+להרצה: python benchmarks/bench_webhook_load.py [--updates 5000 --concurrency 40 --handler-ms 20]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import webhook_server  # noqa: E402
+
+SECRET = 'bench-secret'
+PATH = '/telegram'
+RETRY_DELAY = 0.2
+
+# אזהרת התור המלא חוזרת על עצמה בכל 503
+logging.getLogger('webhook_server').setLevel(logging.ERROR)
+
+
+def _update(update_id: int) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "ℹ️ מידע על השירות",
+        "chat": {"id": 1000 + update_id % 500, "type": "private"},
+        "from": {"id": 1000 + update_id % 500, "is_bot": False, "first_name": "Bench"},
+    }}
+
+
+class _AckAfterHandler(webhook_server.WebhookServer):
+    """ההתנהגות שנמנעים ממנה: הבקשה מחכה עד שה-handler מסיים"""
+
+    def __init__(self, *args, handler_ms: float, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handler_ms = handler_ms
+
+    async def handle_update(self, request):
+        await request.read()
+        await asyncio.sleep(self.handler_ms / 1000)
+        return web.Response(status=200)
+
+
+async def _consumer(queue: asyncio.Queue, handler_ms: float, done: list):
+    while True:
+        await queue.get()
+        await asyncio.sleep(handler_ms / 1000)
+        done.append(time.perf_counter())
+        queue.task_done()
+
+
+async def _fire(port: int, updates: int, concurrency: int):
+    """שולח את העדכונים במקביל כמו טלגרם (עד concurrency חיבורים, ושוב אחרי 503) ומחזיר זמני תגובה"""
+    latencies, statuses = [], {}
+    counter = iter(range(updates))
+    headers = {webhook_server.SECRET_HEADER: SECRET}
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def worker():
+            for update_id in counter:
+                while True:
+                    start = time.perf_counter()
+                    async with session.post(f'http://127.0.0.1:{port}{PATH}', json=_update(update_id),
+                                            headers=headers) as resp:
+                        await resp.read()
+                    latencies.append(time.perf_counter() - start)
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+                    if resp.status != 503:
+                        break
+                    # כמו טלגרם: עדכון שלא התקבל נשלח שוב מאוחר יותר
+                    await asyncio.sleep(RETRY_DELAY)
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses
+
+
+async def run_mode(mode: str, args, port: int) -> dict:
+    queue = asyncio.Queue(maxsize=args.queue)
+    done: list = []
+    if mode == 'ack-after-handler':
+        server = _AckAfterHandler(queue, None, PATH, SECRET, handler_ms=args.handler_ms)
+        consumers = []
+    else:
+        server = webhook_server.WebhookServer(queue, None, PATH, SECRET)
+        # כמו PTB עם concurrent_updates: כמה handlers רצים במקביל
+        consumers = [asyncio.create_task(_consumer(queue, args.handler_ms, done))
+                     for _ in range(args.workers)]
+    await server.start('127.0.0.1', port)
+    start = time.perf_counter()
+    latencies, statuses = await _fire(port, args.updates, args.concurrency)
+    acked = time.perf_counter() - start
+    await queue.join()
+    finished = time.perf_counter() - start
+    for task in consumers:
+        task.cancel()
+    await server.stop()
+
+    latencies.sort()
+    return {
+        'p50 ack (ms)': statistics.median(latencies) * 1000,
+        'p99 ack (ms)': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'all acked (s)': acked,
+        'all handled (s)': finished if mode != 'ack-after-handler' else acked,
+        'statuses': statuses,
+    }
+
+
+async def main(args):
+    before = await run_mode('ack-after-handler', args, args.port)
+    after = await run_mode('queue', args, args.port + 1)
+    print(f"{args.updates:,} updates, {args.concurrency} connections, handler {args.handler_ms:g}ms, "
+          f"queue {args.queue}, {args.workers} workers")
+    print(f"{'metric':<20}{'before':>14}{'after':>14}")
+    for name in before:
+        if name == 'statuses':
+            print(f"{name:<20}{str(before[name]):>14}{str(after[name]):>14}")
+        else:
+            print(f"{name:<20}{before[name]:>14.2f}{after[name]:>14.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=40)
+    parser.add_argument('--handler-ms', type=float, default=20)
+    parser.add_argument('--queue', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--port', type=int, default=18443)
+    asyncio.run(main(parser.parse_args()))
@@ -42,5 +42,6 @@ BUTTON_TEXTS = {
     'whatsapp': '💬 צור קשר בוואטסאפ',
     'info': 'ℹ️ מידע על השירות', 
     'callback': '⏳ בקשה שאחזור ללקוח',
+    'share': '📤 שלח לחבר שרוצה בוט',
     'back': '🔙 חזור לתפריט הראשי'
 }
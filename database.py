@@ -3,23 +3,581 @@
 משתמש ב-SQLite - לא דורש התקנה נוספת
 """
 
+import atexit
+import os
+import re
 import sqlite3
 import json
-from datetime import datetime
-from typing import Optional, List, Dict
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Dict, Iterable, Iterator, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+# כוונון חיבורי SQLite (אפשר לשנות דרך משתני סביבה)
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '8192'))
+SQLITE_MMAP_SIZE_MB = int(os.getenv('SQLITE_MMAP_SIZE_MB', '64'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHED_STATEMENTS = int(os.getenv('SQLITE_CACHED_STATEMENTS', '256'))
+
+# תור הכתיבה ברקע של bot_stats - גודל אצווה, זמן המתנה מקסימלי ותקרת תור
+ACTION_LOG_BATCH_SIZE = int(os.getenv('ACTION_LOG_BATCH_SIZE', '200'))
+ACTION_LOG_FLUSH_INTERVAL = float(os.getenv('ACTION_LOG_FLUSH_INTERVAL', '1.0'))
+ACTION_LOG_MAX_QUEUE = int(os.getenv('ACTION_LOG_MAX_QUEUE', '10000'))
+
+# גודל אצווה בקריאה הזורמת (iter_*) - זה מה שמחזיקים בזיכרון בכל רגע
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+# אירוע פעולה: (user_id, action, data, timestamp)
+ActionEvent = Tuple[int, str, Optional[Dict], str]
+
+
+# ============== מחיצות חודשיות ל-bot_stats ==============
+# כל חודש נשמר בטבלה משלו (bot_stats_YYYYMM), ו-bot_stats הוא VIEW שמאחד את כולן.
+# מחיקת נתונים ישנים = DROP למחיצה שלמה במקום DELETE של שורות.
+
+_PARTITION_RE = re.compile(r'^bot_stats_(\d{6})$')
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# שורה במחיצה נשמרת בצורה קומפקטית: זמן כ-epoch שלם, קוד פעולה מטבלת
+# המילון actions, ו-data אחרונה (NULL כשאין נתונים - בית אחד בכותרת השורה).
+# ה-VIEW bot_stats מפענח בחזרה לעמודות המקוריות (action טקסט, timestamp טקסט).
+_PARTITION_DDL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        action_id INTEGER NOT NULL,
+        data TEXT
+    )
+'''
+_PARTITION_VIEW_SELECT = (
+    "SELECT p.id, p.user_id, a.name AS action, p.data, "
+    "datetime(p.ts, 'unixepoch') AS timestamp "
+    "FROM {table} p JOIN actions a ON a.id = p.action_id"
+)
+# העתקת שורות בפורמט הישן (action טקסט, timestamp טקסט) למחיצה קומפקטית.
+# המזהים נשמרים - הם ייחודיים על פני כל המחיצות (ראו stats_sequence)
+_LEGACY_COPY_SQL = '''
+    INSERT INTO {target} (id, ts, user_id, action_id, data)
+    SELECT s.id, CAST(strftime('%s', s.timestamp) AS INTEGER), s.user_id, a.id,
+           NULLIF(s.data, '')
+    FROM {source} s JOIN actions a ON a.name = s.action
+    {where}
+    ORDER BY s.id
+'''
+
+
+def _month_key(ts: str) -> str:
+    """'YYYY-MM-DD HH:MM:SS' -> 'YYYYMM'"""
+    return ts[:4] + ts[5:7]
+
+
+def _to_epoch(ts: str) -> int:
+    """'YYYY-MM-DD HH:MM:SS' (UTC) -> שניות epoch"""
+    return int(datetime.strptime(ts, _TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+
+
+def _full_timestamp(value: str) -> str:
+    """'YYYY-MM-DD' -> 'YYYY-MM-DD 00:00:00'; חותמת זמן מלאה חוזרת כמו שהיא"""
+    return value if len(value) > 10 else f'{value} 00:00:00'
+
+
+def _partition_table(month: str) -> str:
+    if not re.fullmatch(r'\d{6}', month or ''):
+        raise ValueError(f"מפתח מחיצה לא תקין: {month!r}")
+    return f'bot_stats_{month}'
+
+
+def _list_partitions(conn: sqlite3.Connection) -> List[str]:
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'bot_stats_%'")
+    months = []
+    for (name,) in rows:
+        match = _PARTITION_RE.match(name)
+        if match:
+            months.append(match.group(1))
+    return sorted(months)
+
+
+def _create_partition_indexes(conn: sqlite3.Connection, month: str):
+    table = _partition_table(month)
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_stats_timestamp_user_{month} ON {table}(ts, user_id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_stats_user_timestamp_{month} ON {table}(user_id, ts)')
+
+
+def _create_partition(conn: sqlite3.Connection, month: str):
+    conn.execute(_PARTITION_DDL.format(table=_partition_table(month)))
+    _create_partition_indexes(conn, month)
+
+
+def _rebuild_stats_view(conn: sqlite3.Connection, months: List[str]):
+    """יוצר מחדש את ה-VIEW bot_stats מעל רשימת המחיצות"""
+    conn.execute('DROP VIEW IF EXISTS bot_stats')
+    if months:
+        body = ' UNION ALL '.join(
+            _PARTITION_VIEW_SELECT.format(table=_partition_table(month)) for month in months
+        )
+    else:
+        body = 'SELECT NULL AS id, NULL AS user_id, NULL AS action, NULL AS data, NULL AS timestamp WHERE 0'
+    conn.execute(f'CREATE VIEW bot_stats AS {body}')
+
+
+def _register_legacy_actions(conn: sqlite3.Connection, source: str):
+    conn.execute(f'INSERT OR IGNORE INTO actions (name) SELECT DISTINCT action FROM {source}')
+
+
+def _partition_bot_stats(conn: sqlite3.Connection):
+    """מעביר טבלת bot_stats רגילה למחיצות חודשיות מאחורי VIEW"""
+    conn.execute('ALTER TABLE bot_stats RENAME TO bot_stats_legacy')
+    _register_legacy_actions(conn, 'bot_stats_legacy')
+    months = [row[0] for row in conn.execute(
+        "SELECT DISTINCT strftime('%Y%m', timestamp) FROM bot_stats_legacy WHERE timestamp IS NOT NULL"
+    )]
+    for month in months:
+        _create_partition(conn, month)
+        conn.execute(_LEGACY_COPY_SQL.format(
+            target=_partition_table(month), source='bot_stats_legacy',
+            where="WHERE strftime('%Y%m', s.timestamp) = ?",
+        ), (month,))
+    conn.execute('DROP TABLE bot_stats_legacy')
+    _rebuild_stats_view(conn, _list_partitions(conn))
+
+
+def _compact_partitions(conn: sqlite3.Connection):
+    """ממיר מחיצות בפורמט הטקסט הישן לפורמט הקומפקטי (קוד פעולה + epoch).
+    staging/DROP/RENAME אטומיים יחד כי _apply_migrations מריץ כל גרסה ב-BEGIN ... COMMIT.
+    """
+    conn.execute('DROP VIEW IF EXISTS bot_stats')
+    months = _list_partitions(conn)
+    for month in months:
+        table = _partition_table(month)
+        columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+        if 'ts' in columns:
+            continue
+        _register_legacy_actions(conn, table)
+        staging = f'{table}_compact'
+        conn.execute(_PARTITION_DDL.format(table=staging))
+        conn.execute(_LEGACY_COPY_SQL.format(target=staging, source=table, where=''))
+        # האינדקסים הישנים נמחקים עם הטבלה, ואז נבנים מחדש על העמודות החדשות
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {staging} RENAME TO {table}')
+        _create_partition_indexes(conn, month)
+    _rebuild_stats_view(conn, months)
+
+
+def _unique_stats_ids(conn: sqlite3.Connection):
+    """מזהה ייחודי לכל שורה על פני כל המחיצות, ורצף משותף למזהים חדשים.
+    מחיצות שנוצרו קודם מספרו כל אחת מ-1; מחיצה שהמזהים שלה חופפים לקודמות מוזזת קדימה.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS stats_sequence (next_id INTEGER NOT NULL)')
+    highest = 0
+    for month in _list_partitions(conn):
+        table = _partition_table(month)
+        low, high = conn.execute(f'SELECT MIN(id), MAX(id) FROM {table}').fetchone()
+        if low is None:
+            continue
+        if low <= highest:
+            offset = highest - low + 1
+            # דרך מזהים שליליים, כדי שהעדכון לא יתנגש במפתח קיים באמצע הדרך
+            conn.execute(f'UPDATE {table} SET id = -id')
+            conn.execute(f'UPDATE {table} SET id = ? - id', (offset,))
+            high += offset
+        highest = max(highest, high)
+    conn.execute('DELETE FROM stats_sequence')
+    conn.execute('INSERT INTO stats_sequence (next_id) VALUES (?)', (highest + 1,))
+
+
+def _allocate_stats_ids(conn: sqlite3.Connection, count: int) -> int:
+    """שומר count מזהים רצופים מהרצף המשותף ומחזיר את הראשון (בתוך טרנזקציית הכתיבה)"""
+    conn.execute('UPDATE stats_sequence SET next_id = next_id + ?', (count,))
+    return conn.execute('SELECT next_id FROM stats_sequence').fetchone()[0] - count
+
+
+# שורת הסיכום היומי של כל הפעולות יחד בטבלאות ה-rollup
+ROLLUP_ALL_ACTIONS = '*'
+
+
+def _update_action_rollups(conn: sqlite3.Connection, rows: List[Tuple]):
+    """מעדכן את טבלאות הסיכום היומי לפי אצוות שורות (user_id, action, data, timestamp)"""
+    events: Dict[Tuple[str, str], int] = {}
+    members = set()
+    for user_id, action, _data, ts in rows:
+        day = ts[:10]
+        for key in (action, ROLLUP_ALL_ACTIONS):
+            events[(day, key)] = events.get((day, key), 0) + 1
+            members.add((day, key, user_id))
+
+    new_users: Dict[Tuple[str, str], int] = {}
+    for day, key, user_id in members:
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO daily_action_users (day, action, user_id) VALUES (?, ?, ?)',
+            (day, key, user_id),
+        )
+        if cursor.rowcount > 0:
+            new_users[(day, key)] = new_users.get((day, key), 0) + 1
+
+    conn.executemany('''
+        INSERT INTO daily_action_rollup (day, action, events, users)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(day, action) DO UPDATE SET
+            events = events + excluded.events,
+            users = users + excluded.users
+    ''', [(day, key, count, new_users.get((day, key), 0)) for (day, key), count in events.items()])
+
+
+def _rebuild_rollups(conn: sqlite3.Connection):
+    """בונה מחדש את כל טבלאות הסיכום מההיסטוריה הגולמית"""
+    for table in ('daily_action_rollup', 'daily_action_users', 'daily_request_rollup',
+                  'daily_requester_rollup', 'request_users'):
+        conn.execute(f'DELETE FROM {table}')
+
+    conn.execute('''
+        INSERT INTO daily_action_users (day, action, user_id)
+        SELECT DISTINCT date(timestamp), action, user_id FROM bot_stats
+        UNION
+        SELECT DISTINCT date(timestamp), ?, user_id FROM bot_stats
+    ''', (ROLLUP_ALL_ACTIONS,))
+    conn.execute('''
+        INSERT INTO daily_action_rollup (day, action, events, users)
+        SELECT date(timestamp), action, COUNT(*), COUNT(DISTINCT user_id)
+        FROM bot_stats GROUP BY 1, 2
+        UNION ALL
+        SELECT date(timestamp), ?, COUNT(*), COUNT(DISTINCT user_id)
+        FROM bot_stats GROUP BY 1
+    ''', (ROLLUP_ALL_ACTIONS,))
+    conn.execute('''
+        INSERT INTO daily_request_rollup (day, status, requests)
+        SELECT date(created_at), COALESCE(status, 'unknown'), COUNT(*)
+        FROM customer_requests GROUP BY 1, 2
+    ''')
+    conn.execute('''
+        INSERT INTO request_users (user_id, first_day)
+        SELECT user_id, MIN(date(created_at)) FROM customer_requests GROUP BY user_id
+    ''')
+    conn.execute('''
+        INSERT INTO daily_requester_rollup (day, new_users)
+        SELECT first_day, COUNT(*) FROM request_users GROUP BY first_day
+    ''')
+
+
+# ============== חיפוש טקסט מלא (FTS5) בפניות ==============
+
+def _fts5_available(conn: sqlite3.Connection) -> bool:
+    try:
+        conn.execute('CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)')
+        conn.execute('DROP TABLE temp._fts5_probe')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def _create_requests_fts(conn: sqlite3.Connection):
+    """אינדקס FTS5 על טקסט הפנייה, השם וה-username, מסונכרן בטריגרים"""
+    if not _fts5_available(conn):
+        logger.warning("SQLite בלי FTS5 - החיפוש בפניות יעבוד בסריקת LIKE")
+        return
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS customer_requests_fts USING fts5(
+            message_text, full_name, username,
+            content='customer_requests', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_requests_fts_insert
+        AFTER INSERT ON customer_requests
+        BEGIN
+            INSERT INTO customer_requests_fts (rowid, message_text, full_name, username)
+            VALUES (NEW.id, NEW.message_text, NEW.full_name, NEW.username);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_requests_fts_delete
+        AFTER DELETE ON customer_requests
+        BEGIN
+            INSERT INTO customer_requests_fts (customer_requests_fts, rowid, message_text, full_name, username)
+            VALUES ('delete', OLD.id, OLD.message_text, OLD.full_name, OLD.username);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_requests_fts_update
+        AFTER UPDATE OF message_text, full_name, username ON customer_requests
+        BEGIN
+            INSERT INTO customer_requests_fts (customer_requests_fts, rowid, message_text, full_name, username)
+            VALUES ('delete', OLD.id, OLD.message_text, OLD.full_name, OLD.username);
+            INSERT INTO customer_requests_fts (rowid, message_text, full_name, username)
+            VALUES (NEW.id, NEW.message_text, NEW.full_name, NEW.username);
+        END
+    ''')
+    # אינדוקס הפניות שכבר קיימות
+    conn.execute("INSERT INTO customer_requests_fts (customer_requests_fts) VALUES ('rebuild')")
+
+
+def _fts_match_expression(query: str) -> str:
+    """הופך טקסט חופשי לביטוי MATCH בטוח: כל מילה כביטוי במירכאות עם חיפוש תחילית"""
+    terms = re.findall(r'\w+', query or '')
+    return ' '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+
+_SEARCH_REQUESTS_SQL = """
+    SELECT r.*,
+           snippet(customer_requests_fts, 0, '«', '»', '…', 12) AS snippet
+    FROM customer_requests_fts
+    JOIN customer_requests r ON r.id = customer_requests_fts.rowid
+    WHERE customer_requests_fts MATCH ?
+    ORDER BY bm25(customer_requests_fts, 5.0, 2.0, 2.0), r.id DESC
+    LIMIT ? OFFSET ?
+"""
+
+
+# אינדקסים משניים בגרסאות. הגרסה שהוחלה נשמרת ב-PRAGMA user_version,
+# וכל שלב נכתב כך שהרצה חוזרת שלו לא משנה דבר (IF NOT EXISTS).
+SCHEMA_MIGRATIONS = [
+    (1, "אינדקסים לפניות ממתינות, חלונות זמן ושליפות לפי משתמש", [
+        # אינדקס חלקי לתור הפניות הממתינות (created_at, id)
+        """CREATE INDEX IF NOT EXISTS idx_requests_pending
+           ON customer_requests(created_at, id) WHERE status = 'pending'""",
+        # חלון זמן על פניות - מכסה את user_id כדי שלא ניגש לטבלה
+        """CREATE INDEX IF NOT EXISTS idx_requests_created_user
+           ON customer_requests(created_at, user_id)""",
+        # הפנייה האחרונה של משתמש כולל פרטי התצוגה שלו
+        """CREATE INDEX IF NOT EXISTS idx_requests_user_created
+           ON customer_requests(user_id, created_at, username, full_name)""",
+        # חלון זמן על סטטיסטיקות + ניקוי נתונים ישנים
+        """CREATE INDEX IF NOT EXISTS idx_stats_timestamp_user
+           ON bot_stats(timestamp, user_id)""",
+        # הפעילות האחרונה של משתמש
+        """CREATE INDEX IF NOT EXISTS idx_stats_user_timestamp
+           ON bot_stats(user_id, timestamp)""",
+    ]),
+    (2, "טבלאות סיכום יומיות לסטטיסטיקות ולפניות", [
+        # פעולות לפי יום ופעולה (כולל שורת '*' לכל הפעולות יחד)
+        """CREATE TABLE IF NOT EXISTS daily_action_rollup (
+               day TEXT NOT NULL,
+               action TEXT NOT NULL,
+               events INTEGER NOT NULL DEFAULT 0,
+               users INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (day, action)
+           ) WITHOUT ROWID""",
+        # מי כבר נספר באותו יום ופעולה - כדי לספור משתמשים ייחודיים בהדרגה
+        """CREATE TABLE IF NOT EXISTS daily_action_users (
+               day TEXT NOT NULL,
+               action TEXT NOT NULL,
+               user_id INTEGER NOT NULL,
+               PRIMARY KEY (day, action, user_id)
+           ) WITHOUT ROWID""",
+        # פניות לפי יום יצירה וסטטוס נוכחי
+        """CREATE TABLE IF NOT EXISTS daily_request_rollup (
+               day TEXT NOT NULL,
+               status TEXT NOT NULL,
+               requests INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (day, status)
+           ) WITHOUT ROWID""",
+        # פונים חדשים לפי יום הפנייה הראשונה שלהם
+        """CREATE TABLE IF NOT EXISTS request_users (
+               user_id INTEGER PRIMARY KEY,
+               first_day TEXT NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS daily_requester_rollup (
+               day TEXT PRIMARY KEY,
+               new_users INTEGER NOT NULL DEFAULT 0
+           ) WITHOUT ROWID""",
+        # הפניות מתעדכנות רק דרך save/update - טריגרים שומרים על הסיכום מסונכרן
+        """CREATE TRIGGER IF NOT EXISTS trg_requests_rollup_insert
+           AFTER INSERT ON customer_requests
+           BEGIN
+               INSERT INTO daily_request_rollup (day, status, requests)
+               VALUES (date(NEW.created_at), COALESCE(NEW.status, 'unknown'), 1)
+               ON CONFLICT(day, status) DO UPDATE SET requests = requests + 1;
+               INSERT INTO daily_requester_rollup (day, new_users)
+               SELECT date(NEW.created_at), 1
+               WHERE NOT EXISTS (SELECT 1 FROM request_users WHERE user_id = NEW.user_id)
+               ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+               INSERT OR IGNORE INTO request_users (user_id, first_day)
+               VALUES (NEW.user_id, date(NEW.created_at));
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_requests_rollup_status
+           AFTER UPDATE OF status ON customer_requests
+           WHEN OLD.status IS NOT NEW.status
+           BEGIN
+               UPDATE daily_request_rollup SET requests = requests - 1
+               WHERE day = date(OLD.created_at) AND status = COALESCE(OLD.status, 'unknown');
+               INSERT INTO daily_request_rollup (day, status, requests)
+               VALUES (date(NEW.created_at), COALESCE(NEW.status, 'unknown'), 1)
+               ON CONFLICT(day, status) DO UPDATE SET requests = requests + 1;
+           END""",
+        # מילוי ראשוני מההיסטוריה הקיימת
+        _rebuild_rollups,
+    ]),
+    (3, "חלוקת bot_stats למחיצות חודשיות מאחורי VIEW", [
+        _partition_bot_stats,
+    ]),
+    (4, "אינדקס חיפוש FTS5 על טקסט הפניות", [
+        _create_requests_fts,
+    ]),
+    (5, "שורות bot_stats קומפקטיות: מילון פעולות וזמן epoch", [
+        _compact_partitions,
+    ]),
+    (6, "מצב שיחה מתמיד עם תפוגה", [
+        """CREATE TABLE IF NOT EXISTS conversation_state (
+               user_id INTEGER PRIMARY KEY,
+               state TEXT NOT NULL,
+               expires_at INTEGER NOT NULL
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_conversation_state_expires
+           ON conversation_state(expires_at)""",
+    ]),
+    (7, "מזהי bot_stats ייחודיים על פני המחיצות ורצף משותף", [
+        _unique_stats_ids,
+    ]),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
+def _utc_now_str() -> str:
+    """זמן UTC נוכחי באותו פורמט של CURRENT_TIMESTAMP ב-SQLite"""
+    return datetime.now(timezone.utc).strftime(_TIMESTAMP_FORMAT)
+
+
+def _utc_cutoff_str(days: int) -> str:
+    """תחילת חלון של X ימים אחורה, בפורמט של CURRENT_TIMESTAMP"""
+    since = datetime.now(timezone.utc) - timedelta(days=int(days))
+    return since.strftime(_TIMESTAMP_FORMAT)
+
+
+def _utc_since_day(days: int) -> str:
+    """היום הראשון (כולל) בחלון יומי של X ימים שמסתיים היום, 'YYYY-MM-DD'.
+    כל השאילתות על טבלאות הסיכום היומיות משתמשות בו עם day >= כדי שהחלונות יתאימו.
+    """
+    first = datetime.now(timezone.utc) - timedelta(days=max(1, int(days)) - 1)
+    return first.strftime('%Y-%m-%d')
+
+
+# משתמשים פעילים בחלון זמן יחד עם פרטי התצוגה מהפנייה האחרונה שלהם - בשאילתה אחת.
+# {stats_activity} מוחלף ב-SELECT על מחיצות bot_stats שחופפות לחלון בלבד.
+_RECENT_USERS_SQL = """
+    WITH activity AS (
+        {stats_activity}
+        SELECT user_id, created_at AS ts FROM customer_requests WHERE created_at > :since
+    ),
+    last_seen AS (
+        SELECT user_id, MAX(ts) AS last_seen FROM activity GROUP BY user_id
+    ),
+    latest_request AS (
+        SELECT user_id, username, full_name,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC, id DESC) AS rn
+        FROM customer_requests
+        WHERE user_id IN (SELECT user_id FROM last_seen)
+    )
+    SELECT l.user_id, r.username, r.full_name, l.last_seen
+    FROM last_seen l
+    LEFT JOIN latest_request r ON r.user_id = l.user_id AND r.rn = 1
+    ORDER BY l.last_seen DESC, l.user_id DESC
+"""
+
+
+class ConnectionManager:
+    """מחזיק חיבור SQLite ארוך-חיים לכל חוט במקום לפתוח חיבור חדש בכל קריאה.
+
+    כל חיבור מוגדר פעם אחת: WAL, synchronous=NORMAL, מטמון דפים ו-mmap,
+    ומטמון prepared statements של המודול sqlite3 (cached_statements).
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{int(SQLITE_CACHE_SIZE_KB)}')
+        conn.execute(f'PRAGMA mmap_size={int(SQLITE_MMAP_SIZE_MB) * 1024 * 1024}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        """מחזיר את החיבור של החוט הנוכחי (יוצר אותו בפעם הראשונה)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """commit בסיום מוצלח, rollback בשגיאה - בלי לסגור את החיבור"""
+        conn = self.get()
+        with conn:
+            yield conn
+
+    @contextmanager
+    def schema_transaction(self):
+        """טרנזקציה מפורשת (BEGIN IMMEDIATE) לשינויי סכמה: sqlite3 פותח טרנזקציה מרומזת
+        רק לפני DML, ובלעדיה DROP/CREATE נשמרים מיד - קוראים היו רואים מצב ביניים
+        (למשל רגע בלי ה-VIEW bot_stats) וקריסה הייתה משאירה אותו כך.
+        """
+        conn = self.get()
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def close_all(self):
+        """סוגר את כל החיבורים (בעת כיבוי או בסוף בדיקות)"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.debug(f"סגירת חיבור SQLite נכשלה: {e}")
+        self._local = threading.local()
+
+
 class DatabaseManager:
     def __init__(self, db_path: str = "bot_data.db"):
         self.db_path = db_path
+        self.connections = ConnectionManager(db_path)
+        self._schema_lock = threading.Lock()
+        self._partitions: List[str] = []
+        self._action_ids: Dict[str, int] = {}
         self.init_database()
+
+    def close(self):
+        """סוגר את כל החיבורים הפתוחים לבסיס הנתונים"""
+        self.connections.close_all()
+
+    def ping(self) -> float:
+        """שאילתה מינימלית על החיבור של החוט. מחזיר זמן במילישניות (חריגה אם הבסיס לא זמין)"""
+        start = time.perf_counter()
+        self.connections.get().execute('SELECT 1').fetchone()
+        return (time.perf_counter() - start) * 1000
     
     def init_database(self):
         """יוצר את טבלאות בסיס הנתונים"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.transaction() as conn:
                 cursor = conn.cursor()
                 
                 # טבלת פניות לקוחות
@@ -49,18 +607,88 @@ class DatabaseManager:
                     )
                 ''')
                 
-                conn.commit()
+                # מילון הפעולות - קוד מספרי קצר לכל שם פעולה ב-bot_stats
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS actions (
+                        id INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL UNIQUE
+                    )
+                ''')
+                
+                self._apply_migrations(conn)
+                self._partitions = _list_partitions(conn)
+                self._action_ids = {
+                    row["name"]: row["id"] for row in conn.execute('SELECT id, name FROM actions')
+                }
                 logger.info("בסיס הנתונים הותחל בהצלחה")
                 
         except Exception as e:
             logger.error(f"שגיאה ביצירת בסיס הנתונים: {e}")
+
+    def _apply_migrations(self, conn: sqlite3.Connection):
+        """מחיל את שלבי הסכמה שעוד לא הוחלו על הקובץ הזה.
+
+        כל גרסה רצה בטרנזקציה מפורשת (BEGIN ... COMMIT): המודול sqlite3 פותח טרנזקציה
+        מרומזת רק לפני DML, כך שבלי BEGIN פקודות DDL (RENAME/DROP/CREATE) היו נשמרות מיד.
+        קריסה באמצע שלב משאירה את הסכמה ואת user_version בגרסה הקודמת.
+        """
+        if conn.in_transaction:
+            conn.commit()
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            # IMMEDIATE: תהליך אחר שמאתחל במקביל ממתין, ואחרי ההמתנה רואה את הגרסה המעודכנת
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if version <= conn.execute('PRAGMA user_version').fetchone()[0]:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+            logger.info(f"הוחל שלב סכמה {version}: {description}")
+
+    def _ensure_partitions(self, months):
+        """יוצר מחיצות חודשיות שעוד לא קיימות (בטרנזקציה נפרדת מהכתיבה)"""
+        missing = sorted(set(months) - set(self._partitions))
+        if not missing:
+            return
+        with self._schema_lock:
+            with self.connections.schema_transaction() as conn:
+                for month in missing:
+                    _create_partition(conn, month)
+                partitions = _list_partitions(conn)
+                _rebuild_stats_view(conn, partitions)
+            self._partitions = partitions
+
+    def _ensure_action_ids(self, names) -> Dict[str, int]:
+        """מחזיר קודי פעולה לשמות, ורושם במילון שמות חדשים (בטרנזקציה נפרדת)"""
+        missing = set(names) - set(self._action_ids)
+        if missing:
+            with self._schema_lock:
+                with self.connections.transaction() as conn:
+                    conn.executemany('INSERT OR IGNORE INTO actions (name) VALUES (?)',
+                                     [(name,) for name in sorted(missing)])
+                    ids = {row["name"]: row["id"] for row in conn.execute('SELECT id, name FROM actions')}
+                self._action_ids = ids
+        return self._action_ids
+
+    def _stats_partitions_since(self, since: str) -> List[str]:
+        """שמות טבלאות המחיצה שחופפות לחלון שמתחיל ב-since"""
+        first = _month_key(since)
+        return [_partition_table(month) for month in self._partitions if month >= first]
     
     def save_customer_request(self, user_id: int, username: str, full_name: str, 
                             message_text: str, phone_number: str = None, 
                             email: str = None) -> int:
         """שומר פנייה חדשה של לקוח"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT INTO customer_requests 
@@ -69,7 +697,6 @@ class DatabaseManager:
                 ''', (user_id, username, full_name, message_text, phone_number, email))
                 
                 request_id = cursor.lastrowid
-                conn.commit()
                 
                 logger.info(f"פנייה חדשה נשמרה: {request_id}")
                 return request_id
@@ -81,7 +708,7 @@ class DatabaseManager:
     def update_request_status(self, request_id: int, status: str) -> bool:
         """מעדכן את סטטוס הפנייה"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connections.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     UPDATE customer_requests 
@@ -89,7 +716,6 @@ class DatabaseManager:
                     WHERE id = ?
                 ''', (status, request_id))
                 
-                conn.commit()
                 return cursor.rowcount > 0
                 
         except Exception as e:
@@ -99,8 +725,7 @@ class DatabaseManager:
     def get_pending_requests(self) -> List[Dict]:
         """מחזיר את כל הפניות הממתינות"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT * FROM customer_requests 
@@ -114,11 +739,165 @@ class DatabaseManager:
             logger.error(f"שגיאה בקבלת פניות ממתינות: {e}")
             return []
     
+    def get_pending_requests_page(self, cursor: Optional[Tuple[str, int]] = None,
+                                  direction: str = 'older', limit: int = 5) -> Dict:
+        """עמוד אחד מתור הפניות הממתינות, מהחדשה לישנה (keyset pagination).
+
+        cursor הוא (created_at, id) של הרשומה שממנה ממשיכים: direction='older'
+        מחזיר את הרשומות שאחריה ו-'newer' את אלו שלפניה. כל עמוד הוא קריאת
+        טווח אחת על האינדקס החלקי idx_requests_pending, בלי OFFSET.
+        מחזיר {items, has_older, has_newer}; הרשומות תמיד מהחדשה לישנה.
+        """
+        empty = {'items': [], 'has_older': False, 'has_newer': False}
+        try:
+            limit = max(1, int(limit))
+            with self.connections.transaction() as conn:
+                if cursor is None:
+                    rows = conn.execute('''
+                        SELECT * FROM customer_requests
+                        WHERE status = 'pending'
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT ?
+                    ''', (limit + 1,)).fetchall()
+                elif direction == 'newer':
+                    rows = conn.execute('''
+                        SELECT * FROM customer_requests
+                        WHERE status = 'pending' AND (created_at, id) > (?, ?)
+                        ORDER BY created_at, id
+                        LIMIT ?
+                    ''', (cursor[0], cursor[1], limit + 1)).fetchall()
+                else:
+                    rows = conn.execute('''
+                        SELECT * FROM customer_requests
+                        WHERE status = 'pending' AND (created_at, id) < (?, ?)
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT ?
+                    ''', (cursor[0], cursor[1], limit + 1)).fetchall()
+
+            more = len(rows) > limit
+            items = [dict(row) for row in rows[:limit]]
+            if cursor is not None and direction == 'newer':
+                items.reverse()
+                return {'items': items, 'has_older': True, 'has_newer': more}
+            return {'items': items, 'has_older': more, 'has_newer': cursor is not None}
+
+        except Exception as e:
+            logger.error(f"שגיאה בקבלת עמוד פניות ממתינות: {e}")
+            return empty
+
+    def search_requests(self, query: str, limit: int = 10, offset: int = 0) -> Dict:
+        """חיפוש טקסט מלא בפניות (הודעה, שם, username), מדורג לפי bm25.
+        מחזיר {items, has_more}; כל רשומה כוללת גם snippet עם ההתאמה מסומנת.
+        """
+        empty = {'items': [], 'has_more': False}
+        match = _fts_match_expression(query)
+        if not match:
+            return empty
+        try:
+            limit = max(1, int(limit))
+            with self.connections.transaction() as conn:
+                has_fts = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'customer_requests_fts'"
+                ).fetchone()
+                if has_fts:
+                    rows = conn.execute(_SEARCH_REQUESTS_SQL, (match, limit + 1, int(offset))).fetchall()
+                else:
+                    # גיבוי כש-FTS5 לא זמין: כל המילים חייבות להופיע באחד השדות
+                    terms = re.findall(r'\w+', query)
+                    where = ' AND '.join(
+                        "(message_text LIKE ? OR full_name LIKE ? OR username LIKE ?)" for _ in terms
+                    )
+                    params = [f"%{term}%" for term in terms for _ in range(3)]
+                    rows = conn.execute(
+                        f"SELECT *, substr(message_text, 1, 80) AS snippet FROM customer_requests "
+                        f"WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?",
+                        (*params, limit + 1, int(offset)),
+                    ).fetchall()
+
+            return {'items': [dict(row) for row in rows[:limit]], 'has_more': len(rows) > limit}
+
+        except Exception as e:
+            logger.error(f"שגיאה בחיפוש פניות: {e}")
+            return empty
+
+    def iter_customer_requests(self, since: Optional[str] = None, until: Optional[str] = None,
+                               status: Optional[str] = None,
+                               batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[Dict]:
+        """מחזיר פניות אחת-אחת לפי סדר id, באצוות keyset של batch_size.
+        since/until בפורמט 'YYYY-MM-DD[ HH:MM:SS]' (UTC), since כולל ו-until לא כולל.
+        כל אצווה היא שאילתה נפרדת, כך שלא מוחזקת טרנזקציית קריאה ארוכה.
+        """
+        conditions, params = ['id > ?'], []
+        if since:
+            conditions.append('created_at >= ?')
+            params.append(since)
+        if until:
+            conditions.append('created_at < ?')
+            params.append(until)
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        sql = f"SELECT * FROM customer_requests WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+
+        last_id = 0
+        while True:
+            rows = self.connections.get().execute(sql, (last_id, *params, batch_size)).fetchall()
+            for row in rows:
+                yield dict(row)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1]["id"]
+
+    def iter_bot_stats(self, since: Optional[str] = None, until: Optional[str] = None,
+                       action: Optional[str] = None,
+                       batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[Dict]:
+        """מחזיר אירועי bot_stats אחד-אחד, מחיצה אחר מחיצה בסדר כרונולוגי.
+        קורא רק את המחיצות שחופפות לטווח; הרשומות במבנה של ה-VIEW
+        (id, user_id, action, data, timestamp).
+        """
+        conditions, params = ['id > ?'], []
+        if since:
+            conditions.append('ts >= ?')
+            params.append(_to_epoch(_full_timestamp(since)))
+        if until:
+            conditions.append('ts < ?')
+            params.append(_to_epoch(_full_timestamp(until)))
+        if action:
+            action_id = self._action_ids.get(action)
+            if action_id is None:
+                return
+            conditions.append('action_id = ?')
+            params.append(action_id)
+
+        names = {action_id: name for name, action_id in self._action_ids.items()}
+        first = _month_key(since) if since else ''
+        last = _month_key(until) if until else '999999'
+        for month in list(self._partitions):
+            if not first <= month <= last:
+                continue
+            sql = (
+                f"SELECT id, user_id, action_id, data, datetime(ts, 'unixepoch') AS timestamp "
+                f"FROM {_partition_table(month)} WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+            )
+            last_id = 0
+            while True:
+                rows = self.connections.get().execute(sql, (last_id, *params, batch_size)).fetchall()
+                for row in rows:
+                    yield {
+                        "id": row["id"],
+                        "user_id": row["user_id"],
+                        "action": names.get(row["action_id"]),
+                        "data": row["data"],
+                        "timestamp": row["timestamp"],
+                    }
+                if len(rows) < batch_size:
+                    break
+                last_id = rows[-1]["id"]
+
     def get_request_by_id(self, request_id: int) -> Optional[Dict]:
         """מחזיר פנייה לפי מזהה"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.connections.transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT * FROM customer_requests WHERE id = ?', (request_id,))
                 
@@ -131,43 +910,110 @@ class DatabaseManager:
     
     def log_user_action(self, user_id: int, action: str, data: Dict = None):
         """רושם פעולה של משתמש לסטטיסטיקות"""
+        self.log_user_actions([(user_id, action, data, _utc_now_str())])
+
+    def log_user_actions(self, events: Iterable[ActionEvent]) -> int:
+        """רושם אצוות פעולות בטרנזקציה אחת (executemany)"""
+        rows = [
+            (user_id, action, json.dumps(data, ensure_ascii=False) if data else None, ts)
+            for user_id, action, data, ts in events
+        ]
+        if not rows:
+            return 0
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                data_json = json.dumps(data, ensure_ascii=False) if data else None
-                cursor.execute('''
-                    INSERT INTO bot_stats (user_id, action, data)
-                    VALUES (?, ?, ?)
-                ''', (user_id, action, data_json))
-                
-                conn.commit()
+            action_ids = self._ensure_action_ids({row[1] for row in rows})
+            self._ensure_partitions({_month_key(row[3]) for row in rows})
+
+            with self.connections.transaction() as conn:
+                # המזהים מרצף אחד לכל המחיצות, כך ש-id ב-VIEW נשאר ייחודי
+                first_id = _allocate_stats_ids(conn, len(rows))
+                by_month: Dict[str, List[Tuple]] = {}
+                for offset, (user_id, action, data, ts) in enumerate(rows):
+                    by_month.setdefault(_month_key(ts), []).append(
+                        (first_id + offset, _to_epoch(ts), user_id, action_ids[action], data)
+                    )
+                for month, month_rows in by_month.items():
+                    conn.executemany(f'''
+                        INSERT INTO {_partition_table(month)} (id, ts, user_id, action_id, data)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', month_rows)
+                _update_action_rollups(conn, rows)
+            return len(rows)
                 
         except Exception as e:
             logger.error(f"שגיאה בשמירת הסטטיסטיקה: {e}")
+            return 0
     
+    def get_conversation_state(self, user_id: int, now: int) -> Optional[Tuple[str, int]]:
+        """(מצב, תפוגה ב-epoch) של משתמש אם עוד בתוקף"""
+        try:
+            row = self.connections.get().execute(
+                'SELECT state, expires_at FROM conversation_state WHERE user_id = ? AND expires_at > ?',
+                (user_id, now),
+            ).fetchone()
+            return (row["state"], row["expires_at"]) if row else None
+        except Exception as e:
+            logger.error(f"שגיאה בקריאת מצב שיחה: {e}")
+            return None
+
+    def get_active_conversation_ids(self, now: int) -> List[int]:
+        """מזהי המשתמשים עם מצב שיחה בתוקף (לטעינה עצלה אחרי הפעלה מחדש)"""
+        try:
+            return [row[0] for row in self.connections.get().execute(
+                'SELECT user_id FROM conversation_state WHERE expires_at > ?', (now,))]
+        except Exception as e:
+            logger.error(f"שגיאה בקריאת מצבי שיחה: {e}")
+            return []
+
+    def set_conversation_state(self, user_id: int, state: str, expires_at: int) -> bool:
+        try:
+            with self.connections.transaction() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO conversation_state (user_id, state, expires_at) VALUES (?, ?, ?)',
+                    (user_id, state, expires_at),
+                )
+            return True
+        except Exception as e:
+            logger.error(f"שגיאה בשמירת מצב שיחה: {e}")
+            return False
+
+    def delete_conversation_state(self, user_id: int) -> bool:
+        try:
+            with self.connections.transaction() as conn:
+                conn.execute('DELETE FROM conversation_state WHERE user_id = ?', (user_id,))
+            return True
+        except Exception as e:
+            logger.error(f"שגיאה במחיקת מצב שיחה: {e}")
+            return False
+
+    def purge_conversation_states(self, now: int) -> int:
+        """מוחק מצבי שיחה שפג תוקפם. מחזיר כמה נמחקו"""
+        try:
+            with self.connections.transaction() as conn:
+                return conn.execute('DELETE FROM conversation_state WHERE expires_at <= ?', (now,)).rowcount
+        except Exception as e:
+            logger.error(f"שגיאה בניקוי מצבי שיחה: {e}")
+            return 0
+
     def get_user_stats(self, days: int = 30) -> Dict:
-        """מחזיר סטטיסטיקות של הבוט"""
+        """מחזיר סטטיסטיקות של הבוט (מטבלאות הסיכום - עלות לפי מספר הימים)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            since_day = _utc_since_day(days)
+            with self.connections.transaction() as conn:
                 cursor = conn.cursor()
                 
-                # סך הפניות
-                cursor.execute('SELECT COUNT(*) FROM customer_requests')
-                total_requests = cursor.fetchone()[0]
-                
-                # פניות ממתינות
-                cursor.execute("SELECT COUNT(*) FROM customer_requests WHERE status = 'pending'")
-                pending_requests = cursor.fetchone()[0]
-                
-                # פניות מהימים האחרונים
+                # סך הפניות, ממתינות ומהימים האחרונים
                 cursor.execute('''
-                    SELECT COUNT(*) FROM customer_requests 
-                    WHERE created_at > datetime('now', '-{} days')
-                '''.format(days))
-                recent_requests = cursor.fetchone()[0]
+                    SELECT
+                        COALESCE(SUM(requests), 0),
+                        COALESCE(SUM(CASE WHEN status = 'pending' THEN requests END), 0),
+                        COALESCE(SUM(CASE WHEN day >= ? THEN requests END), 0)
+                    FROM daily_request_rollup
+                ''', (since_day,))
+                total_requests, pending_requests, recent_requests = cursor.fetchone()
                 
-                # משתמשים ייחודיים
-                cursor.execute('SELECT COUNT(DISTINCT user_id) FROM customer_requests')
+                # משתמשים ייחודיים (סכום הפונים החדשים בכל יום)
+                cursor.execute('SELECT COALESCE(SUM(new_users), 0) FROM daily_requester_rollup')
                 unique_users = cursor.fetchone()[0]
                 
                 return {
@@ -180,23 +1026,70 @@ class DatabaseManager:
         except Exception as e:
             logger.error(f"שגיאה בקבלת סטטיסטיקות: {e}")
             return {}
+
+    def get_daily_activity(self, days: int = 7) -> List[Dict]:
+        """מחזיר פירוט יומי של פעולות מטבלאות הסיכום, מהיום החדש לישן.
+        כל רשומה: {date, events, users, actions: {action: events}}
+        """
+        try:
+            since_day = _utc_since_day(days)
+            with self.connections.transaction() as conn:
+                rows = conn.execute('''
+                    SELECT day, action, events, users
+                    FROM daily_action_rollup
+                    WHERE day >= ?
+                    ORDER BY day DESC
+                ''', (since_day,)).fetchall()
+
+            by_day: Dict[str, Dict] = {}
+            for row in rows:
+                entry = by_day.setdefault(row["day"], {
+                    "date": row["day"], "events": 0, "users": 0, "actions": {},
+                })
+                if row["action"] == ROLLUP_ALL_ACTIONS:
+                    entry["events"] = row["events"]
+                    entry["users"] = row["users"]
+                else:
+                    entry["actions"][row["action"]] = row["events"]
+            return list(by_day.values())
+        except Exception as e:
+            logger.error(f"שגיאה בקבלת פירוט יומי: {e}")
+            return []
+
+    def rebuild_rollups(self) -> bool:
+        """מחשב מחדש את טבלאות הסיכום מכל ההיסטוריה הגולמית"""
+        try:
+            with self.connections.transaction() as conn:
+                _rebuild_rollups(conn)
+            logger.info("טבלאות הסיכום נבנו מחדש")
+            return True
+        except Exception as e:
+            logger.error(f"שגיאה בבנייה מחדש של טבלאות הסיכום: {e}")
+            return False
     
     def cleanup_old_data(self, days: int = 90):
-        """מנקה נתונים ישנים"""
+        """מנקה נתונים ישנים.
+
+        סטטיסטיקות נמחקות במחיצות חודשיות שלמות: מחיצה נמחקת כשכל החודש שלה
+        ישן מ-X ימים, כך שנשמר לכל היותר חודש נוסף מעבר לתקופת השמירה.
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # מחיקת סטטיסטיקות ישנות
-                cursor.execute('''
-                    DELETE FROM bot_stats 
-                    WHERE timestamp < datetime('now', '-{} days')
-                '''.format(days))
-                
-                deleted_stats = cursor.rowcount
-                conn.commit()
-                
-                logger.info(f"נמחקו {deleted_stats} רשומות סטטיסטיקה ישנות")
+            cutoff = _utc_cutoff_str(days)
+            cutoff_month = _month_key(cutoff)
+            with self._schema_lock:
+                expired = [month for month in self._partitions if month < cutoff_month]
+                with self.connections.schema_transaction() as conn:
+                    for month in expired:
+                        conn.execute(f'DROP TABLE IF EXISTS {_partition_table(month)}')
+                    partitions = _list_partitions(conn)
+                    if expired:
+                        _rebuild_stats_view(conn, partitions)
+
+                    # רשימות החברות היומיות נחוצות רק לימים שעוד נכתבים
+                    conn.execute('DELETE FROM daily_action_users WHERE day < ?', (cutoff[:10],))
+                self._partitions = partitions
+
+            logger.info(f"נמחקו {len(expired)} מחיצות סטטיסטיקה ישנות")
                 
         except Exception as e:
             logger.error(f"שגיאה בניקוי נתונים: {e}")
@@ -206,29 +1099,24 @@ class DatabaseManager:
         פעילות נמדדת לפי טבלת bot_stats ולפי פניות ב-customer_requests
         """
         try:
-            since_expr = f"-" + str(int(days)) + " days"
-            with sqlite3.connect(self.db_path) as conn:
+            since = _utc_cutoff_str(days)
+            with self.connections.transaction() as conn:
                 cursor = conn.cursor()
 
-                # משתמשים מטבלת הסטטיסטיקות
-                cursor.execute(
-                    """
-                    SELECT DISTINCT user_id
-                    FROM bot_stats
-                    WHERE timestamp > datetime('now', ?)
-                    """,
-                    (since_expr,)
-                )
-                stats_users = {row[0] for row in cursor.fetchall()}
+                # משתמשים מטבלת הסטטיסטיקות - רק מהמחיצות שחופפות לחלון
+                stats_users = set()
+                for table in self._stats_partitions_since(since):
+                    cursor.execute(f"SELECT user_id FROM {table} WHERE ts > ?", (_to_epoch(since),))
+                    stats_users.update(row[0] for row in cursor.fetchall())
 
                 # משתמשים מטבלת הפניות
                 cursor.execute(
                     """
-                    SELECT DISTINCT user_id
+                    SELECT user_id
                     FROM customer_requests
-                    WHERE created_at > datetime('now', ?)
+                    WHERE created_at > ?
                     """,
-                    (since_expr,)
+                    (since,)
                 )
                 request_users = {row[0] for row in cursor.fetchall()}
 
@@ -242,72 +1130,216 @@ class DatabaseManager:
         """מחזיר משתמשים פעילים ב-X ימים אחרונים כולל פרטי תצוגה וזמן אחרון
         מחזיר רשומות במבנה: {user_id, username, full_name, last_seen}
         """
-        try:
-            user_ids = self.get_active_user_ids(days)
-            if not user_ids:
-                return []
+        return self.get_recent_users_by_window((days,)).get(days, [])
 
-            results: List[Dict] = []
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
+    def get_recent_users_by_window(self, windows=(7, 30)) -> Dict[int, List[Dict]]:
+        """מחזיר משתמשים פעילים לכמה חלונות זמן בשאילתה אחת.
 
-                for uid in user_ids:
-                    # שליפת פרטי משתמש (username/full_name) מהבקשה האחרונה אם קיימת
-                    cursor.execute(
-                        """
-                        SELECT username, full_name
-                        FROM customer_requests
-                        WHERE user_id = ?
-                        ORDER BY created_at DESC
-                        LIMIT 1
-                        """,
-                        (uid,)
-                    )
-                    row = cursor.fetchone()
-                    username = row["username"] if row else None
-                    full_name = row["full_name"] if row else None
-
-                    # שליפת זמן אחרון מכל הטבלאות
-                    cursor.execute(
-                        """
-                        SELECT MAX(ts) as last_seen
-                        FROM (
-                            SELECT timestamp as ts FROM bot_stats WHERE user_id = ?
-                            UNION ALL
-                            SELECT created_at as ts FROM customer_requests WHERE user_id = ?
-                        )
-                        """,
-                        (uid, uid)
-                    )
-                    ts_row = cursor.fetchone()
-                    last_seen = ts_row["last_seen"] if ts_row and ts_row["last_seen"] else None
-
-                    results.append({
-                        "user_id": uid,
-                        "username": username,
-                        "full_name": full_name,
-                        "last_seen": last_seen,
-                    })
-
-            # מיין לפי זמן אחרון יורד (None בסוף)
-            results.sort(key=lambda r: (r["last_seen"] is None, r["last_seen"]), reverse=True)
+        השאילתה רצה פעם אחת על החלון הגדול ביותר; משתמש שייך לחלון קטן יותר
+        אם הפעילות האחרונה שלו (last_seen) בתוכו. מחזיר {days: [רשומות]}
+        במבנה של get_recent_users_with_details, ממוין לפי last_seen יורד.
+        """
+        windows = sorted({int(days) for days in windows})
+        if not windows:
+            return {}
+        try:
+            since = _utc_cutoff_str(windows[-1])
+            stats_activity = ''.join(
+                f"SELECT user_id, datetime(ts, 'unixepoch') AS ts FROM {table} "
+                f"WHERE ts > :since_epoch UNION ALL "
+                for table in self._stats_partitions_since(since)
+            )
+            sql = _RECENT_USERS_SQL.format(stats_activity=stats_activity)
+            with self.connections.transaction() as conn:
+                rows = conn.execute(sql, {"since": since, "since_epoch": _to_epoch(since)}).fetchall()
+
+            results: Dict[int, List[Dict]] = {}
+            for days in windows:
+                cutoff = _utc_cutoff_str(days)
+                results[days] = [
+                    {
+                        "user_id": row["user_id"],
+                        "username": row["username"],
+                        "full_name": row["full_name"],
+                        "last_seen": row["last_seen"],
+                    }
+                    for row in rows
+                    if row["last_seen"] > cutoff
+                ]
             return results
         except Exception as e:
             logger.error(f"שגיאה בקבלת פרטי משתמשים פעילים: {e}")
+            return {days: [] for days in windows}
+
+
+# סמן פנימי שמעיר את חוט הכתיבה (עצירה או flush) וסוגר את האצווה הנוכחית
+_WAKE = object()
+
+
+class ActionLogWriter:
+    """תור write-behind לרישום פעולות משתמשים.
+
+    ה-handlers רק מכניסים אירוע לתור (בלי לחכות לדיסק), וחוט רקע כותב
+    אותם באצוות עם executemany. אצווה נכתבת כשהיא מגיעה ל-batch_size או
+    אחרי flush_interval שניות מהאירוע הראשון בה - המוקדם מביניהם.
+    """
+
+    def __init__(self, db_manager: DatabaseManager,
+                 batch_size: int = ACTION_LOG_BATCH_SIZE,
+                 flush_interval: float = ACTION_LOG_FLUSH_INTERVAL,
+                 max_queue: int = ACTION_LOG_MAX_QUEUE):
+        self.db_manager = db_manager
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.01, flush_interval)
+        self._queue: "queue.Queue[ActionEvent]" = queue.Queue(maxsize=max_queue)
+        self._stop_event = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+
+    def enqueue(self, user_id: int, action: str, data: Dict = None) -> bool:
+        """מכניס אירוע לתור בלי לחסום. מחזיר False אם התור מלא"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((user_id, action, data, _utc_now_str()))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"תור הסטטיסטיקות מלא - אירוע {action} נזרק (סה\"כ {self.dropped})")
+            return False
+
+    def _ensure_started(self):
+        if self._thread is not None or self._stop_event.is_set():
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="action-log-writer", daemon=True)
+                self._thread.start()
+
+    def _collect_batch(self) -> List:
+        """ממתין לאירוע ראשון ואוסף עוד עד גודל האצווה או עד תום חלון הזמן"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
             return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not _WAKE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List):
+        try:
+            self.db_manager.log_user_actions(event for event in batch if event is not _WAKE)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._collect_batch()
+            if batch:
+                self._write(batch)
+        # עצירה: כותבים את כל מה שנשאר לפני היציאה - אחרת מי שממתין ב-flush נתקע
+        self._drain()
+
+    def _drain(self):
+        """כותב את כל מה שבתור כרגע, באצוות, בחוט הנוכחי"""
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not batch:
+                return
+            self._write(batch)
+
+    def flush(self):
+        """כותב מיד את כל מה שבתור וממתין לאצווה שכבר בדרך לדיסק"""
+        thread = self._thread
+        if self._wake():
+            # החוט יסגור את האצווה שלו בסמן וימשיך לרוקן את מה שאחריו.
+            # אם הוא יוצא בינתיים (stop) - לא ממתינים לו יותר, ומה שנשאר נכתב כאן
+            with self._queue.all_tasks_done:
+                while self._queue.unfinished_tasks and thread.is_alive():
+                    self._queue.all_tasks_done.wait(timeout=0.1)
+            if thread.is_alive():
+                return
+        self._drain()
+
+    def stop(self, timeout: Optional[float] = None):
+        """עוצר את חוט הרקע וכותב את כל מה שנשאר בתור (לקריאה בכיבוי).
+        timeout הוא ההמתנה לחוט לפני ש-flush ממשיך לחכות לאצווה שבכתיבה.
+        """
+        self._stop_event.set()
+        thread = self._thread
+        if thread is not None:
+            self._wake()
+            thread.join(timeout=self.flush_interval + 5 if timeout is None else timeout)
+        self.flush()
+
+    def _wake(self) -> bool:
+        """מעיר את חוט הרקע אם הוא ממתין לאירועים נוספים. מחזיר True אם החוט רץ"""
+        if self._thread is None or not self._thread.is_alive():
+            return False
+        try:
+            self._queue.put_nowait(_WAKE)
+        except queue.Full:
+            pass
+        return True
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
 
 # אינסטנס גלובלי של מנהל בסיס הנתונים
 db = DatabaseManager()
 
+# תור רישום הפעולות ברקע - נעצר ומתרוקן ביציאה מהתהליך
+action_writer = ActionLogWriter(db)
+atexit.register(action_writer.stop)
+
 # פונקציות נוחות
 def save_request(user_id: int, username: str, full_name: str, message: str) -> int:
     """פונקציה מקוצרת לשמירת פנייה"""
     return db.save_customer_request(user_id, username, full_name, message)
 
 def log_action(user_id: int, action: str, data: Dict = None):
-    """פונקציה מקוצרת לרישום פעולה"""
-    db.log_user_action(user_id, action, data)
+    """פונקציה מקוצרת לרישום פעולה - מכניסה לתור הכתיבה ברקע ולא חוסמת"""
+    action_writer.enqueue(user_id, action, data)
+
+def flush_actions():
+    """כותב מיד את כל הפעולות שממתינות בתור"""
+    action_writer.flush()
+
+def get_pending_page(cursor: Optional[Tuple[str, int]] = None, direction: str = 'older',
+                     limit: int = 5) -> Dict:
+    """פונקציה מקוצרת לעמוד בתור הפניות הממתינות"""
+    return db.get_pending_requests_page(cursor, direction, limit)
+
+def search_requests(query: str, limit: int = 10, offset: int = 0) -> Dict:
+    """פונקציה מקוצרת לחיפוש טקסט מלא בפניות"""
+    return db.search_requests(query, limit, offset)
+
+def update_status(request_id: int, status: str) -> bool:
+    """פונקציה מקוצרת לעדכון סטטוס פנייה"""
+    return db.update_request_status(request_id, status)
+
+def health() -> Dict:
+    """מצב בסיס הנתונים עבור /health: זמינות, זמן תגובה ואורך תור הכתיבה"""
+    try:
+        return {"ok": True, "latency_ms": round(db.ping(), 2), "pending_actions": action_writer.pending}
+    except Exception as e:
+        logger.error(f"בדיקת בריאות בסיס הנתונים נכשלה: {e}")
+        return {"ok": False, "error": str(e), "pending_actions": action_writer.pending}
 
 def get_stats() -> Dict:
     """פונקציה מקוצרת לקבלת סטטיסטיקות"""
@@ -316,3 +1348,15 @@ def get_stats() -> Dict:
 def get_active_users(days: int = 7) -> List[Dict]:
     """פונקציה מקוצרת לקבלת משתמשים פעילים והפרטים שלהם"""
     return db.get_recent_users_with_details(days)
+
+def get_daily_activity(days: int = 7) -> List[Dict]:
+    """פונקציה מקוצרת לפירוט יומי מטבלאות הסיכום"""
+    return db.get_daily_activity(days)
+
+def get_active_users_by_window(windows=(7, 30)) -> Dict[int, List[Dict]]:
+    """פונקציה מקוצרת לקבלת משתמשים פעילים לכמה חלונות זמן בסריקה אחת"""
+    return db.get_recent_users_by_window(windows)
+
+def window_start(days: int) -> str:
+    """תחילת חלון של X ימים אחורה (UTC), בפורמט של since בשליפות ובייצוא"""
+    return _utc_cutoff_str(days)
@@ -0,0 +1,84 @@
+"""
+ייצוא זורם של פניות ופעילות לקבצי CSV / JSONL
+השורות נקראות מהגנרטורים של database ונכתבות ישר לקובץ - הזיכרון לא גדל עם כמות הנתונים
+"""
+
+import csv
+import json
+import os
+from typing import Dict, Iterable, Iterator, List, Optional
+import logging
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# גודל מקסימלי לכל קובץ בייצוא. קובץ שנשלח בטלגרם נטען לזיכרון בשלמותו,
+# ולכן ייצוא גדול מתפצל לכמה קבצים קטנים במקום קובץ אחד ענק (מגבלת הבוטים: 50MB)
+EXPORT_PART_MAX_MB = float(os.getenv('EXPORT_PART_MAX_MB', '10'))
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+EXPORT_KINDS = {
+    'requests': ['id', 'user_id', 'username', 'full_name', 'message_text', 'phone_number',
+                 'email', 'status', 'created_at', 'updated_at'],
+    'activity': ['id', 'user_id', 'action', 'data', 'timestamp'],
+}
+
+
+def iter_rows(kind: str, since: Optional[str] = None, until: Optional[str] = None,
+              status: Optional[str] = None) -> Iterator[Dict]:
+    """גנרטור השורות לפי סוג הייצוא. status מסנן סטטוס פנייה, או שם פעולה בפעילות"""
+    if kind == 'requests':
+        return database.db.iter_customer_requests(since, until, status)
+    if kind == 'activity':
+        return database.db.iter_bot_stats(since, until, status)
+    raise ValueError(f"סוג ייצוא לא מוכר: {kind}")
+
+
+def export_to_files(rows: Iterable[Dict], fields: List[str], fmt: str, directory: str,
+                    basename: str, max_bytes: Optional[int] = None) -> List[str]:
+    """כותב את השורות לקובץ אחד או יותר בתיקייה ומחזיר את הנתיבים לפי הסדר.
+    קובץ חדש נפתח כשהנוכחי עובר את max_bytes (כל קובץ CSV מקבל שורת כותרת משלו).
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"פורמט ייצוא לא מוכר: {fmt}")
+    if max_bytes is None:
+        max_bytes = int(EXPORT_PART_MAX_MB * 1024 * 1024)
+
+    paths: List[str] = []
+    handle = writer = None
+    try:
+        for row in rows:
+            if handle is None or handle.tell() >= max_bytes:
+                if handle is not None:
+                    handle.close()
+                path = os.path.join(directory, f"{basename}-{len(paths) + 1:03d}.{fmt}")
+                handle = open(path, 'w', encoding='utf-8', newline='')
+                paths.append(path)
+                if fmt == 'csv':
+                    writer = csv.DictWriter(handle, fieldnames=fields, extrasaction='ignore')
+                    writer.writeheader()
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                handle.write(json.dumps({field: row.get(field) for field in fields},
+                                        ensure_ascii=False, default=str))
+                handle.write('\n')
+    finally:
+        if handle is not None:
+            handle.close()
+
+    logger.info(f"ייצוא {basename}: {len(paths)} קבצים")
+    return paths
+
+
+def export(kind: str, fmt: str, directory: str, since: Optional[str] = None,
+           until: Optional[str] = None, status: Optional[str] = None,
+           max_bytes: Optional[int] = None) -> List[str]:
+    """ייצוא מלא: שורות מהבסיס -> קבצים בתיקייה. מחזיר רשימת נתיבים (ריקה אם אין נתונים)"""
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"סוג ייצוא לא מוכר: {kind}")
+    basename = f"{kind}-{(since or 'all')[:10]}"
+    return export_to_files(iter_rows(kind, since, until, status), EXPORT_KINDS[kind], fmt,
+                           directory, basename, max_bytes)
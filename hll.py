@@ -0,0 +1,60 @@
+"""
+HyperLogLog - ספירה משוערת של משתמשים ייחודיים בזיכרון קבוע
+כל סקיצה היא m=2^p רגיסטרים קטנים; איחוד סקיצות = מקסימום לכל רגיסטר
+"""
+
+import hashlib
+import math
+from typing import Dict, Iterable, Mapping, Tuple
+
+# p=11 -> 2048 רגיסטרים, שגיאת תקן של כ-2.3% (1.04/sqrt(m))
+HLL_PRECISION = 11
+
+
+def _hash64(value) -> int:
+    digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def register_for(value, precision: int = HLL_PRECISION) -> Tuple[int, int]:
+    """(אינדקס רגיסטר, דרגה) עבור ערך: p הביטים העליונים בוחרים רגיסטר,
+    והדרגה היא מיקום הביט הדולק הראשון בשאר הביטים.
+    """
+    hashed = _hash64(value)
+    index = hashed >> (64 - precision)
+    rest_bits = 64 - precision
+    rest = hashed & ((1 << rest_bits) - 1)
+    rank = rest_bits - rest.bit_length() + 1
+    return index, rank
+
+
+def registers_for(values: Iterable, precision: int = HLL_PRECISION) -> Dict[int, int]:
+    """רגיסטרים דלילים {אינדקס: דרגה} לקבוצת ערכים - מה שנשלח ל-$max במונגו"""
+    registers: Dict[int, int] = {}
+    for value in values:
+        index, rank = register_for(value, precision)
+        if rank > registers.get(index, 0):
+            registers[index] = rank
+    return registers
+
+
+def merge_registers(target: Dict[int, int], other: Mapping) -> Dict[int, int]:
+    """איחוד רגיסטרים דלילים (מקסימום לכל אינדקס) לתוך target"""
+    for index, rank in other.items():
+        index = int(index)
+        if rank > target.get(index, 0):
+            target[index] = rank
+    return target
+
+
+def estimate(registers: Mapping, precision: int = HLL_PRECISION) -> int:
+    """אומדן מספר הערכים הייחודיים מרגיסטרים דלילים (המפתחות יכולים להיות מחרוזות כמו במונגו)"""
+    m = 1 << precision
+    alpha = 0.7213 / (1 + 1.079 / m)
+    zeros = m - len(registers)
+    harmonic = zeros + sum(2.0 ** -int(rank) for rank in registers.values())
+    raw = alpha * m * m / harmonic
+    # תחום קטן: linear counting מדויק יותר כשיש עוד רגיסטרים ריקים
+    if raw <= 2.5 * m and zeros:
+        return int(round(m * math.log(m / zeros)))
+    return int(round(raw))
@@ -0,0 +1,105 @@
+"""
+שרת ה-HTTP של הבוט (/, /health, /admin/loglevel) על aiohttp, בתוך ה-event loop של הבוט
+במקום Flask בחוט נפרד. ה-health מדווח מצב אמיתי: השהיית ה-loop, בסיס הנתונים והנעילה.
+"""
+
+import asyncio
+import hmac
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+import logging
+
+from aiohttp import web
+
+from logging_setup import update_log_level
+
+logger = logging.getLogger(__name__)
+
+# תדירות מדידת השהיית ה-loop
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '1'))
+
+
+class LoopLagMonitor:
+    """מודד כמה באיחור מתעורר sleep קצר - מדד ישיר לחסימת ה-event loop"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_ms = max(0.0, (loop.time() - start - self.interval) * 1000)
+            self.max_ms = max(self.max_ms, self.last_ms)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> Dict:
+        return {"lag_ms": round(self.last_ms, 2), "max_lag_ms": round(self.max_ms, 2)}
+
+
+def create_app(health_provider: Callable[[], Awaitable[Dict]]) -> web.Application:
+    """אפליקציית aiohttp עם נתיבי הבסיס. health_provider מחזיר את תוכן /health;
+    המפתח "status" קובע את קוד התשובה (unhealthy -> 503).
+    """
+    app = web.Application()
+
+    async def home(request: web.Request) -> web.Response:
+        return web.Response(text="Bot is running!")
+
+    async def health(request: web.Request) -> web.Response:
+        started = time.perf_counter()
+        payload = await health_provider()
+        payload["took_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        status = 503 if payload.get("status") == "unhealthy" else 200
+        return web.json_response(payload, status=status)
+
+    async def admin_loglevel(request: web.Request) -> web.Response:
+        """שינוי/בדיקת רמת לוג בזמן ריצה. דרוש טוקן אבטחה."""
+        admin_token = os.environ.get('LOG_ADMIN_TOKEN')
+        if not admin_token:
+            return web.json_response({"error": "endpoint disabled (missing LOG_ADMIN_TOKEN)"}, status=404)
+
+        provided = request.query.get('token') or request.headers.get('X-Admin-Token') or ''
+        if not hmac.compare_digest(provided.encode('utf-8'), admin_token.encode('utf-8')):
+            return web.json_response({"error": "forbidden"}, status=403)
+
+        level = request.query.get('level')
+        if level:
+            new_level = update_log_level(level)
+            logger.info(f"עודכנה רמת לוג: {new_level}")
+            return web.json_response({"status": "ok", "level": new_level})
+
+        # ללא פרמטר level מחזיר את הרמה הנוכחית
+        current = logging.getLevelName(logging.getLogger().level)
+        return web.json_response({"status": "ok", "level": current})
+
+    app.router.add_get('/', home)
+    app.router.add_get('/health', health)
+    app.router.add_get('/admin/loglevel', admin_loglevel)
+    return app
+
+
+async def start(app: web.Application, host: str, port: int) -> web.AppRunner:
+    """מפעיל את השרת על ה-loop הנוכחי ומחזיר runner לסגירה"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"שרת HTTP מאזין ב-{host}:{port}")
+    return runner
@@ -0,0 +1,396 @@
+"""
+נעילת מופע יחיד (lease) עם backends מתחלפים: MongoDB, SQLite וקובץ נעילה (fcntl)
+לכל ה-backends אותה סמנטיקה: רכישה (גם חוזרת ע"י אותו owner), חידוש ושחרור,
+וסימון handover - המחזיק מודיע שהוא עומד לשחרר כדי שהממתין ישתלט מיד.
+ב-MongoDB כל הזמנים נלקחים משעון השרת ($$NOW), כך שהפרשי שעונים בין מכונות לא משפיעים על הרכישה
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+import logging
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+try:
+    import fcntl
+except ImportError:  # לא זמין ב-Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LOCK_BACKENDS = ('mongo', 'sqlite', 'file')
+# נתיבי ברירת מחדל ל-backends המקומיים (מכונה אחת)
+DEFAULT_SQLITE_PATH = 'bot_lock.db'
+DEFAULT_FILE_PATH = 'bot.lock'
+
+
+def ensure_indexes(collection):
+    """אינדקס TTL על expiresAt - מסמכי נעילה שפגו נמחקים גם בלי תהליך פעיל"""
+    try:
+        collection.create_index("expiresAt", expireAfterSeconds=0, background=True)
+    except Exception as e:
+        logger.warning(f"יצירת אינדקס TTL נכשלה/כבר קיים: {e}")
+
+
+def try_acquire(collection, lock_id: str, owner: str, lease_seconds: float) -> bool:
+    """ניסיון רכישה אטומי: מצליח אם אין נעילה, אם היא שלנו, או אם פג תוקפה לפי שעון השרת"""
+    lease_ms = int(lease_seconds * 1000)
+    try:
+        doc = collection.find_one_and_update(
+            {
+                "_id": lock_id,
+                "$or": [
+                    {"owner": owner},
+                    {"$expr": {"$lte": ["$expiresAt", "$$NOW"]}},
+                ],
+            },
+            [{"$set": {
+                "owner": owner,
+                "host": os.environ.get('RENDER_SERVICE_NAME', 'unknown'),
+                "updatedAt": "$$NOW",
+                "expiresAt": {"$add": ["$$NOW", lease_ms]},
+                "createdAt": {"$ifNull": ["$createdAt", "$$NOW"]},
+                "handover": False,
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # המסמך קיים ומוחזק ע"י תהליך אחר שה-lease שלו עוד בתוקף
+        return False
+    return bool(doc) and doc.get("owner") == owner
+
+
+def renew(collection, lock_id: str, owner: str, lease_seconds: float) -> bool:
+    """הארכת ה-lease (heartbeat). False אם הנעילה כבר לא שלנו"""
+    result = collection.update_one(
+        {"_id": lock_id, "owner": owner},
+        [{"$set": {
+            "updatedAt": "$$NOW",
+            "expiresAt": {"$add": ["$$NOW", int(lease_seconds * 1000)]},
+        }}],
+    )
+    return result.matched_count > 0
+
+
+def release(collection, lock_id: str, owner: str) -> bool:
+    """שחרור הנעילה אם היא שלנו"""
+    return collection.delete_one({"_id": lock_id, "owner": owner}).deleted_count > 0
+
+
+def mark_handover(collection, lock_id: str, owner: str, grace_seconds: float) -> bool:
+    """סימון handover: המחזיק בתהליך כיבוי. ה-lease מתקצר ל-grace_seconds,
+    כך שגם אם התהליך נהרג לפני השחרור, הממתין לא מחכה את כל ה-lease.
+    """
+    result = collection.update_one(
+        {"_id": lock_id, "owner": owner},
+        [{"$set": {
+            "handover": True,
+            "handoverAt": "$$NOW",
+            "expiresAt": {"$min": ["$expiresAt", {"$add": ["$$NOW", int(grace_seconds * 1000)]}]},
+        }}],
+    )
+    return result.matched_count > 0
+
+
+def peek(collection, lock_id: str) -> Optional[Dict]:
+    """מצב הנעילה בלי לשנות אותו: {'owner', 'handover'} או None אם היא פנויה/פגה"""
+    doc = collection.find_one(
+        {"_id": lock_id, "$expr": {"$gt": ["$expiresAt", "$$NOW"]}},
+        {"owner": 1, "handover": 1},
+    )
+    if not doc:
+        return None
+    return {"owner": doc.get("owner"), "handover": bool(doc.get("handover"))}
+
+
+class LeaseBackend:
+    """בסיס משותף עם מדידת זמנים לכל פעולה. תתי-מחלקות מממשות _acquire/_renew/_release"""
+
+    name = 'base'
+
+    def __init__(self, lock_id: str):
+        self.lock_id = lock_id
+        self._metrics: Dict[str, Dict] = {}
+        self._metrics_lock = threading.Lock()
+
+    def ensure(self):
+        """הכנה חד-פעמית (אינדקסים/טבלאות). ברירת מחדל: כלום"""
+
+    def _timed(self, op: str, func, *args):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = func(*args)
+            ok = True
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._metrics_lock:
+                entry = self._metrics.setdefault(
+                    op, {"count": 0, "errors": 0, "total_ms": 0.0, "last_ms": 0.0, "max_ms": 0.0})
+                entry["count"] += 1
+                entry["errors"] += 0 if ok else 1
+                entry["total_ms"] += elapsed_ms
+                entry["last_ms"] = elapsed_ms
+                entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+    def try_acquire(self, owner: str, lease_seconds: float) -> bool:
+        return self._timed('acquire', self._acquire, owner, lease_seconds)
+
+    def renew(self, owner: str, lease_seconds: float) -> bool:
+        return self._timed('renew', self._renew, owner, lease_seconds)
+
+    def release(self, owner: str) -> bool:
+        return self._timed('release', self._release, owner)
+
+    def mark_handover(self, owner: str, grace_seconds: float) -> bool:
+        return self._timed('handover', self._mark_handover, owner, grace_seconds)
+
+    def peek(self) -> Optional[Dict]:
+        return self._timed('peek', self._peek)
+
+    def metrics(self) -> Dict[str, Dict]:
+        """זמני הפעולות במילישניות (count/errors/avg/last/max) לכל פעולה"""
+        with self._metrics_lock:
+            return {
+                op: {
+                    "count": m["count"],
+                    "errors": m["errors"],
+                    "avg_ms": round(m["total_ms"] / m["count"], 2) if m["count"] else 0.0,
+                    "last_ms": round(m["last_ms"], 2),
+                    "max_ms": round(m["max_ms"], 2),
+                }
+                for op, m in self._metrics.items()
+            }
+
+    def _acquire(self, owner: str, lease_seconds: float) -> bool:
+        raise NotImplementedError
+
+    def _renew(self, owner: str, lease_seconds: float) -> bool:
+        raise NotImplementedError
+
+    def _release(self, owner: str) -> bool:
+        raise NotImplementedError
+
+    def _mark_handover(self, owner: str, grace_seconds: float) -> bool:
+        raise NotImplementedError
+
+    def _peek(self) -> Optional[Dict]:
+        raise NotImplementedError
+
+
+class MongoLeaseBackend(LeaseBackend):
+    """נעילה מבוזרת ב-MongoDB - מתאימה לכמה מכונות"""
+
+    name = 'mongo'
+
+    def __init__(self, collection, lock_id: str):
+        super().__init__(lock_id)
+        self.collection = collection
+
+    def ensure(self):
+        ensure_indexes(self.collection)
+
+    def _acquire(self, owner: str, lease_seconds: float) -> bool:
+        return try_acquire(self.collection, self.lock_id, owner, lease_seconds)
+
+    def _renew(self, owner: str, lease_seconds: float) -> bool:
+        return renew(self.collection, self.lock_id, owner, lease_seconds)
+
+    def _release(self, owner: str) -> bool:
+        return release(self.collection, self.lock_id, owner)
+
+    def _mark_handover(self, owner: str, grace_seconds: float) -> bool:
+        return mark_handover(self.collection, self.lock_id, owner, grace_seconds)
+
+    def _peek(self) -> Optional[Dict]:
+        return peek(self.collection, self.lock_id)
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """נעילה בקובץ SQLite מקומי - לכמה תהליכים על אותה מכונה.
+    BEGIN IMMEDIATE מבטיח שרק תהליך אחד בודק וכותב בכל רגע.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path: str, lock_id: str):
+        super().__init__(lock_id)
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        # חיבור לכל פעולה - ה-heartbeat רץ בחוט אחר, והפעולות נדירות
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def ensure(self):
+        conn = self._connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    handover INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(leases)')}
+            if 'handover' not in columns:
+                conn.execute('ALTER TABLE leases ADD COLUMN handover INTEGER NOT NULL DEFAULT 0')
+        finally:
+            conn.close()
+
+    def _acquire(self, owner: str, lease_seconds: float) -> bool:
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = conn.execute('SELECT owner, expires_at FROM leases WHERE id = ?',
+                               (self.lock_id,)).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO leases (id, owner, expires_at, updated_at, handover) '
+                'VALUES (?, ?, ?, ?, 0)',
+                (self.lock_id, owner, now + lease_seconds, now),
+            )
+            conn.execute('COMMIT')
+            return True
+        finally:
+            conn.close()
+
+    def _renew(self, owner: str, lease_seconds: float) -> bool:
+        conn = self._connect()
+        try:
+            now = time.time()
+            cursor = conn.execute(
+                'UPDATE leases SET expires_at = ?, updated_at = ? WHERE id = ? AND owner = ?',
+                (now + lease_seconds, now, self.lock_id, owner),
+            )
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def _release(self, owner: str) -> bool:
+        conn = self._connect()
+        try:
+            cursor = conn.execute('DELETE FROM leases WHERE id = ? AND owner = ?', (self.lock_id, owner))
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def _mark_handover(self, owner: str, grace_seconds: float) -> bool:
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                'UPDATE leases SET handover = 1, expires_at = MIN(expires_at, ?) WHERE id = ? AND owner = ?',
+                (time.time() + grace_seconds, self.lock_id, owner),
+            )
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def _peek(self) -> Optional[Dict]:
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT owner, handover FROM leases WHERE id = ? AND expires_at > ?',
+                               (self.lock_id, time.time())).fetchone()
+        finally:
+            conn.close()
+        return {"owner": row[0], "handover": bool(row[1])} if row else None
+
+
+class FileLeaseBackend(LeaseBackend):
+    """נעילת קובץ (flock) - הקרנל משחרר אותה כשהתהליך מת, ולכן אין צורך בתפוגה.
+    lease_seconds מתקבל רק לאחידות הממשק.
+    """
+
+    name = 'file'
+
+    def __init__(self, path: str, lock_id: str):
+        if fcntl is None:
+            raise RuntimeError("backend 'file' דורש fcntl (לא זמין במערכת זו)")
+        super().__init__(lock_id)
+        self.path = path
+        self._fd: Optional[int] = None
+        self._owner: Optional[str] = None
+
+    def _acquire(self, owner: str, lease_seconds: float) -> bool:
+        if self._fd is not None:
+            return self._owner == owner
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{self.lock_id} {owner} {os.getpid()}\n".encode('utf-8'))
+        self._fd, self._owner = fd, owner
+        return True
+
+    def _renew(self, owner: str, lease_seconds: float) -> bool:
+        if self._fd is None or self._owner != owner:
+            return False
+        # אם הקובץ נמחק או הוחלף, תהליך אחר יכול לנעול קובץ חדש באותו נתיב
+        try:
+            return os.fstat(self._fd).st_ino == os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _release(self, owner: str) -> bool:
+        if self._fd is None or self._owner != owner:
+            return False
+        fd, self._fd, self._owner = self._fd, None, None
+        try:
+            # קובץ ריק = פנוי, עבור peek של הממתין
+            os.ftruncate(fd, 0)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+        return True
+
+    def _mark_handover(self, owner: str, grace_seconds: float) -> bool:
+        if self._fd is None or self._owner != owner:
+            return False
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, f"{self.lock_id} {owner} {os.getpid()} handover\n".encode('utf-8'), 0)
+        return True
+
+    def _peek(self) -> Optional[Dict]:
+        try:
+            with open(self.path, encoding='utf-8') as handle:
+                try:
+                    # נעילה משותפת מצליחה רק אם אף אחד לא מחזיק - גם אם מחזיק קודם קרס
+                    # והשאיר את תוכן הקובץ
+                    fcntl.flock(handle, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    parts = handle.read().split()
+                else:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                    return None
+        except FileNotFoundError:
+            return None
+        if len(parts) < 2:
+            return None
+        return {"owner": parts[1], "handover": parts[-1] == 'handover'}
+
+
+def create_backend(kind: str, lock_id: str, mongodb_uri: Optional[str] = None,
+                   path: Optional[str] = None) -> LeaseBackend:
+    """יוצר backend לפי שם (mongo / sqlite / file)"""
+    if kind == 'mongo':
+        import mongo_clients
+        client = mongo_clients.get_client(mongodb_uri)
+        return MongoLeaseBackend(client.bot_locks.service_locks, lock_id)
+    if kind == 'sqlite':
+        return SQLiteLeaseBackend(path or DEFAULT_SQLITE_PATH, lock_id)
+    if kind == 'file':
+        return FileLeaseBackend(path or DEFAULT_FILE_PATH, lock_id)
+    raise ValueError(f"backend נעילה לא מוכר: {kind} (אפשרויות: {', '.join(LOCK_BACKENDS)})")
@@ -0,0 +1,73 @@
+"""
+רישום הצהרתי של כפתורי התפריט: כל כפתור מוגדר פעם אחת (תווית, פעולה לסטטיסטיקה, handler או תבנית תשובה).
+מהרישום נבנים מראש המקלדת (אובייקט PTB קפוא) ו-handler אחד עם filters.Text,
+כך שהניתוב קורה ב-dispatch של PTB ועולה בדיקת set ושליפה ממילון אחת - בלי קשר למספר הכפתורים.
+"""
+
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from telegram import KeyboardButton, ReplyKeyboardMarkup, Update
+from telegram.ext import ContextTypes, MessageHandler, filters
+
+import config
+
+Handler = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+
+
+@dataclass(frozen=True)
+class MenuItem:
+    """כפתור בתפריט. התווית נלקחת מ-config.BUTTON_TEXTS[key].
+    בלי handler - הלחיצה עונה ב-reply (עם parse_mode) ומציגה שוב את המקלדת.
+    """
+    key: str
+    action: str
+    handler: Optional[Handler] = None
+    reply: Optional[str] = None
+    parse_mode: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return config.BUTTON_TEXTS[self.key]
+
+
+class Menu:
+    """תפריט מקלדת: מקלדת מוכנה, פילטר ו-handler אחד לכל הכפתורים"""
+
+    def __init__(self, items: Iterable[MenuItem], columns: int = 1):
+        self.items: Tuple[MenuItem, ...] = tuple(items)
+        self._by_label: Dict[str, MenuItem] = {}
+        for item in self.items:
+            if item.handler is None and item.reply is None:
+                raise ValueError(f"לכפתור {item.key} אין handler ואין תשובה")
+            if item.label in self._by_label:
+                raise ValueError(f"תווית כפולה בתפריט: {item.label}")
+            self._by_label[item.label] = item
+
+        rows = [
+            [KeyboardButton(item.label) for item in self.items[i:i + columns]]
+            for i in range(0, len(self.items), columns)
+        ]
+        # אובייקטי PTB קפואים אחרי היצירה - אותה מקלדת נשלחת בכל תשובה
+        self.keyboard = ReplyKeyboardMarkup(rows, resize_keyboard=True, one_time_keyboard=False)
+        # frozenset: הבדיקה ב-filters.Text היא `text in strings`, כלומר חיפוש hash
+        self.filter = filters.Text(frozenset(self._by_label))
+
+    def item_for(self, text: Optional[str]) -> Optional[MenuItem]:
+        return self._by_label.get(text) if text else None
+
+    def action_for(self, text: Optional[str]) -> Optional[str]:
+        """שם הפעולה לרישום ב-bot_stats עבור טקסט הכפתור, או None אם זה לא כפתור"""
+        item = self.item_for(text)
+        return item.action if item else None
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        item = self._by_label[update.message.text]
+        if item.handler is not None:
+            await item.handler(update, context)
+            return
+        await update.message.reply_text(item.reply, parse_mode=item.parse_mode, reply_markup=self.keyboard)
+
+    def handler(self) -> MessageHandler:
+        """handler יחיד לכל כפתורי התפריט - נרשם לפני handler הטקסט החופשי"""
+        return MessageHandler(self.filter, self.dispatch)
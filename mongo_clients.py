@@ -0,0 +1,107 @@
+"""
+רישום משותף של חיבורי MongoDB לכל התהליך
+MongoClient אחד לכל URI - הנעילה, ה-heartbeat וה-reporter חולקים את אותו מאגר חיבורים
+"""
+
+import atexit
+import os
+import threading
+import time
+from typing import Dict
+import logging
+
+from pymongo import MongoClient, monitoring
+
+logger = logging.getLogger(__name__)
+
+# גודל מאגר החיבורים וזמני המתנה (אפשר לשנות דרך משתני סביבה)
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '10'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '10000'))
+
+_clients: Dict[str, MongoClient] = {}
+_health: Dict[str, Dict] = {}
+_lock = threading.Lock()
+
+
+class _HealthListener(monitoring.ServerHeartbeatListener):
+    """עוקב אחרי ה-heartbeat של הדרייבר עצמו - מצב בריאות בלי פניות נוספות לשרת"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        _health[self.name].update({
+            "ok": True,
+            "last_ok": time.time(),
+            "latency_ms": round(event.duration * 1000, 1),
+        })
+
+    def failed(self, event):
+        _health[self.name].update({
+            "ok": False,
+            "last_error": str(event.reply),
+            "last_error_at": time.time(),
+        })
+
+
+def get_client(uri: str, name: str = 'default') -> MongoClient:
+    """מחזיר את ה-MongoClient המשותף ל-URI (נוצר בפעם הראשונה בלבד).
+    name משמש רק לדיווח הבריאות.
+    """
+    client = _clients.get(uri)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(uri)
+        if client is None:
+            _health.setdefault(name, {"ok": None, "last_ok": None, "latency_ms": None})
+            client = MongoClient(
+                uri,
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                event_listeners=[_HealthListener(name)],
+            )
+            _clients[uri] = client
+            logger.info(f"נוצר חיבור MongoDB משותף ({name})")
+    return client
+
+
+def health() -> Dict[str, Dict]:
+    """מצב הבריאות האחרון של כל חיבור, לפי ה-heartbeat של הדרייבר"""
+    return {name: dict(state) for name, state in _health.items()}
+
+
+def ping(uri: str) -> bool:
+    """בדיקה אקטיבית (ping) מול השרת"""
+    try:
+        get_client(uri).admin.command('ping')
+        return True
+    except Exception as e:
+        logger.warning(f"ping ל-MongoDB נכשל: {e}")
+        return False
+
+
+def close_all():
+    """סוגר את כל החיבורים (נרשם ל-atexit כאן, ולכן רץ אחרי ניקויים שנרשמו אחריו)"""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            logger.debug(f"סגירת חיבור MongoDB נכשלה: {e}")
+
+
+atexit.register(close_all)
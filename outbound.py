@@ -0,0 +1,234 @@
+"""
+תזמון ההודעות היוצאות לטלגרם (BaseRateLimiter של PTB)
+כל בקשה שנשלחת לצ'אט עוברת דלי אסימונים לצ'אט ודלי גלובלי לפי מגבלות טלגרם,
+תשובות למשתמשים קודמות להודעות רקע, ו-RetryAfter עוצר את כל השליחה בדיוק לזמן שהתבקש.
+בקשות שאינן לצ'אט (getUpdates, answerCallbackQuery, setWebhook...) עוברות ישירות.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+import logging
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from utils import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# מגבלות טלגרם: כ-30 הודעות בשנייה בסך הכל, הודעה בשנייה לצ'אט פרטי ו-20 בדקה לקבוצה.
+# ברירת המחדל הגלובלית מעט מתחת ל-30, והפרץ הגלובלי קטן (עשירית שנייה) - כך שגם בחלון
+# של שנייה אחת לא עוברים את המגבלה
+OUTBOUND_GLOBAL_PER_SECOND = float(os.getenv('OUTBOUND_GLOBAL_PER_SECOND', '27'))
+OUTBOUND_CHAT_PER_SECOND = float(os.getenv('OUTBOUND_CHAT_PER_SECOND', '1'))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv('OUTBOUND_GROUP_PER_MINUTE', '20'))
+# כמה הודעות לצ'אט פרטי אפשר לשלוח ברצף לפני שהקצב נאכף (תשובה + הודעת המשך)
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+
+# עדיפות (rate_limit_args): מספר קטן יותר נשלח קודם. ברירת המחדל היא תשובה למשתמש
+PRIORITY_REPLY = 0
+PRIORITY_BACKGROUND = 10
+
+# מעבר למספר הזה של צ'אטים במעקב, דליים מלאים (צ'אטים שקטים) נמחקים
+_MAX_TRACKED_CHATS = 1024
+
+
+class TokenBucket:
+    """דלי אסימונים. reserve מזמין אסימון מראש ומחזיר כמה לחכות - היתרה יכולה לרדת
+    מתחת לאפס, כך שבקשות לאותו דלי מקבלות זמני שליחה עוקבים לפי סדר ההגעה.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """כמה שניות עד שיהיה אסימון שלם"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def reserve(self, now: float) -> float:
+        self.take(now)
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def _is_private(chat_id: Any) -> bool:
+    try:
+        return int(chat_id) > 0
+    except (TypeError, ValueError):
+        # @username של ערוץ/קבוצה
+        return False
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """מתזמן מרכזי לכל הבקשות היוצאות של הבוט.
+
+    כל בקשה לצ'אט ממתינה קודם לדלי של הצ'אט, ואז נכנסת לתור עדיפויות של הדלי הגלובלי;
+    משימת dispatch אחת משחררת את ראש התור בכל פעם שיש אסימון ואין עצירה בעקבות RetryAfter.
+    """
+
+    def __init__(self, global_per_second: float = OUTBOUND_GLOBAL_PER_SECOND,
+                 chat_per_second: float = OUTBOUND_CHAT_PER_SECOND,
+                 group_per_minute: float = OUTBOUND_GROUP_PER_MINUTE,
+                 chat_burst: int = OUTBOUND_CHAT_BURST,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_per_second = global_per_second
+        self.chat_per_second = chat_per_second
+        self.group_per_second = group_per_minute / 60
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[Any, TokenBucket] = {}
+        # (עדיפות, מספר סידורי, future) - המספר הסידורי שומר על FIFO בתוך אותה עדיפות
+        self._heap: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._paused_until = 0.0
+        self._stats = {"sent": {}, "max_queued": 0, "wait_total_ms": 0.0, "wait_max_ms": 0.0,
+                       "retry_after": 0, "retry_after_seconds": 0.0, "failed": 0}
+
+    async def initialize(self) -> None:
+        self._ensure_dispatcher()
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            if self._global is None:
+                self._global = TokenBucket(self.global_per_second, max(1.0, self.global_per_second / 10),
+                                           time.monotonic())
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            while not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self._global.delay(now))
+            if wait > 0:
+                # אחרי ההמתנה נבחר שוב ראש התור - בקשה דחופה שנכנסה בינתיים תעקוף
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                # הממתין בוטל
+                continue
+            self._global.take(now)
+            future.set_result(None)
+
+    def _chat_bucket(self, chat_id: Any, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_TRACKED_CHATS:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle(now)}
+            if _is_private(chat_id):
+                bucket = TokenBucket(self.chat_per_second, self.chat_burst, now)
+            else:
+                bucket = TokenBucket(self.group_per_second, 1, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id: Any, priority: int):
+        self._ensure_dispatcher()
+        started = time.monotonic()
+        chat_wait = self._chat_bucket(chat_id, started).reserve(started)
+        if chat_wait > 0:
+            await asyncio.sleep(chat_wait)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        self._stats["max_queued"] = max(self._stats["max_queued"], len(self._heap))
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+        waited_ms = (time.monotonic() - started) * 1000
+        self._stats["wait_total_ms"] += waited_ms
+        self._stats["wait_max_ms"] = max(self._stats["wait_max_ms"], waited_ms)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else PRIORITY_REPLY
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                seconds = retry_after_seconds(e)
+                self._stats["retry_after"] += 1
+                self._stats["retry_after_seconds"] += seconds
+                # טלגרם עוצר את הבוט כולו - עוצרים את כל השליחה עד הזמן שהתבקש
+                self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+                if attempt == self.max_retries:
+                    self._stats["failed"] += 1
+                    logger.error(f"{endpoint} ל-{chat_id} נכשל אחרי {attempt + 1} ניסיונות (RetryAfter)")
+                    raise
+                logger.warning(f"RetryAfter {seconds}s ב-{endpoint} ל-{chat_id} - השליחה נעצרת ומנוסה שוב")
+                attempt += 1
+                continue
+            sent = self._stats["sent"]
+            sent[priority] = sent.get(priority, 0) + 1
+            return result
+
+    def metrics(self) -> Dict:
+        """עומק התור, זמני המתנה ועצירות RetryAfter"""
+        stats = self._stats
+        count = sum(stats["sent"].values())
+        return {
+            "queued": len(self._heap),
+            "max_queued": stats["max_queued"],
+            "sent": {("reply" if p == PRIORITY_REPLY else "background" if p == PRIORITY_BACKGROUND else str(p)): n
+                     for p, n in stats["sent"].items()},
+            "wait_avg_ms": round(stats["wait_total_ms"] / count, 2) if count else 0.0,
+            "wait_max_ms": round(stats["wait_max_ms"], 2),
+            "retry_after": stats["retry_after"],
+            "retry_after_seconds": round(stats["retry_after_seconds"], 2),
+            "failed": stats["failed"],
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            "chats_tracked": len(self._chats),
+        }
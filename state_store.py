@@ -0,0 +1,125 @@
+"""
+מצב שיחה לכל משתמש (למשל 'waiting_for_details') עם תפוגה, בזיכרון ובכתיבה-דרך ל-SQLite
+בזיכרון נשמרות רק שיחות פעילות: (מצב, תפוגה) לכל משתמש, מסודרות לפי זמן תפוגה.
+אחרי הפעלה מחדש המצבים נטענים בעצלות - רק מזהי המשתמשים נקראים מראש, והמצב עצמו בגישה הראשונה.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Set, Tuple
+import logging
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# כמה זמן מצב שיחה נשאר בתוקף אחרי העדכון האחרון שלו
+CONVERSATION_STATE_TTL = int(os.getenv('CONVERSATION_STATE_TTL', str(24 * 3600)))
+# ניקוי מצבים שפגו מהבסיס - לכל היותר פעם בפרק הזמן הזה
+CONVERSATION_PURGE_INTERVAL = int(os.getenv('CONVERSATION_PURGE_INTERVAL', '600'))
+
+
+class ConversationStateStore:
+    """מילון user_id -> מצב עם TTL. None / clear מוחקים את הרשומה במקום לשמור None"""
+
+    def __init__(self, db: Optional[database.DatabaseManager] = None,
+                 ttl_seconds: int = CONVERSATION_STATE_TTL,
+                 purge_interval: int = CONVERSATION_PURGE_INTERVAL):
+        self.db = db if db is not None else database.db
+        self.ttl_seconds = ttl_seconds
+        self.purge_interval = purge_interval
+        # סדר ההכנסה = סדר התפוגה (TTL אחיד + move_to_end בכל עדכון), כך שהניקוי עובר רק על מה שפג
+        self._states: "OrderedDict[int, Tuple[str, int]]" = OrderedDict()
+        # משתמשים שיש להם מצב בבסיס שעוד לא נטען לזיכרון (None = עוד לא נבדק)
+        self._unloaded: Optional[Set[int]] = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _now(self) -> int:
+        return int(time.time())
+
+    def _load_pending_ids(self, now: int):
+        if self._unloaded is None:
+            self._unloaded = set(self.db.get_active_conversation_ids(now))
+            if self._unloaded:
+                logger.info(f"נמצאו {len(self._unloaded)} שיחות פעילות מהפעלה קודמת")
+
+    def get(self, user_id: int) -> Optional[str]:
+        now = self._now()
+        with self._lock:
+            self._evict_expired(now)
+            entry = self._states.get(user_id)
+            if entry is not None:
+                if entry[1] > now:
+                    return entry[0]
+                # רשומה שנטענה מהבסיס יכולה לפוג לפני רשומות שקודמות לה בסדר
+                del self._states[user_id]
+                return None
+            self._load_pending_ids(now)
+            if user_id not in self._unloaded:
+                return None
+            self._unloaded.discard(user_id)
+        # טעינה עצלה מהבסיס - פעם אחת לכל משתמש אחרי הפעלה מחדש
+        stored = self.db.get_conversation_state(user_id, now)
+        if stored is None:
+            return None
+        state, expires_at = stored
+        with self._lock:
+            if user_id not in self._states:
+                self._insert(user_id, sys.intern(state), expires_at)
+        return state
+
+    def set(self, user_id: int, state: Optional[str]):
+        """שומר מצב (ומאריך את התפוגה). None מוחק"""
+        if state is None:
+            self.clear(user_id)
+            return
+        now = self._now()
+        expires_at = now + self.ttl_seconds
+        with self._lock:
+            if self._unloaded:
+                self._unloaded.discard(user_id)
+            self._states.pop(user_id, None)
+            self._insert(user_id, sys.intern(state), expires_at)
+            self._evict_expired(now)
+        self.db.set_conversation_state(user_id, state, expires_at)
+        self._maybe_purge(now)
+
+    def clear(self, user_id: int):
+        now = self._now()
+        with self._lock:
+            persisted = self._states.pop(user_id, None) is not None
+            self._load_pending_ids(now)
+            if user_id in self._unloaded:
+                persisted = True
+                self._unloaded.discard(user_id)
+        # מחיקה מהבסיס רק כשייתכן שיש שם רשומה - /start של משתמש בלי מצב לא נוגע בדיסק
+        if persisted:
+            self.db.delete_conversation_state(user_id)
+
+    def _insert(self, user_id: int, state: str, expires_at: int):
+        self._states[user_id] = (state, expires_at)
+        self._states.move_to_end(user_id)
+
+    def _evict_expired(self, now: int):
+        while self._states:
+            _, (_, expires_at) = next(iter(self._states.items()))
+            if expires_at > now:
+                break
+            self._states.popitem(last=False)
+
+    def _maybe_purge(self, now: int):
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        removed = self.db.purge_conversation_states(now)
+        if removed:
+            logger.debug(f"נוקו {removed} מצבי שיחה שפג תוקפם")
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._evict_expired(self._now())
+            return len(self._states)
@@ -6,19 +6,41 @@
 
 import pytest
 import asyncio
+import csv
 import os
 import tempfile
 import sqlite3
+import json
+import logging
+import time
+import threading
 from unittest.mock import Mock, AsyncMock, patch
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # ייבוא המודולים שלנו
 import config
 import messages
 import database
+import export
 import utils
 from bot import create_main_keyboard
 
+
+@pytest.fixture
+def temp_db(tmp_path):
+    """בסיס נתונים זמני ונקי לבדיקה (קובץ בתיקייה הזמנית של pytest)"""
+    db = database.DatabaseManager(str(tmp_path / 'test.db'))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def global_temp_db(temp_db, monkeypatch):
+    """temp_db שמחליף גם את database.db - לקוד שעובד מול המופע הגלובלי"""
+    monkeypatch.setattr(database, 'db', temp_db)
+    return temp_db
+
+
 class TestConfig:
     """בדיקות הגדרות הבוט"""
     
@@ -96,6 +118,7 @@ class TestDatabase:
         yield db
         
         # ניקוי
+        db.close()
         os.unlink(db_path)
     
     def test_database_initialization(self, temp_db):
@@ -108,8 +131,8 @@ class TestDatabase:
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='customer_requests'")
             assert cursor.fetchone() is not None
             
-            # בדיקת טבלת סטטיסטיקות
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='bot_stats'")
+            # בדיקת טבלת סטטיסטיקות (VIEW מעל מחיצות חודשיות)
+            cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name='bot_stats'")
             assert cursor.fetchone() is not None
     
     def test_save_customer_request(self, temp_db):
@@ -158,6 +181,1200 @@ class TestDatabase:
         assert len(pending) == 2
         assert all(req['status'] == 'pending' for req in pending)
 
+    def test_pending_requests_keyset_pages(self, temp_db):
+        """בדיקה שדפדוף בתור הממתינות עובר על כל הפניות בלי כפילויות וחוזר אחורה"""
+        ids = [temp_db.save_customer_request(i, f"user{i}", f"משתמש {i}", "הודעה") for i in range(12)]
+        temp_db.update_request_status(ids[5], 'completed')
+
+        seen, cursor, pages = [], None, []
+        while True:
+            page = temp_db.get_pending_requests_page(cursor, 'older', limit=5)
+            pages.append(page)
+            seen.extend(item['id'] for item in page['items'])
+            if not page['has_older']:
+                break
+            last = page['items'][-1]
+            cursor = (last['created_at'], last['id'])
+
+        expected = sorted((i for i in ids if i != ids[5]), reverse=True)
+        assert seen == expected
+        assert [len(p['items']) for p in pages] == [5, 5, 1]
+
+        first_of_second = pages[1]['items'][0]
+        back = temp_db.get_pending_requests_page(
+            (first_of_second['created_at'], first_of_second['id']), 'newer', limit=5)
+        assert back['items'] == pages[0]['items']
+        assert not back['has_newer']
+
+    def test_search_requests_full_text(self, temp_db):
+        """בדיקה שחיפוש טקסט מלא מוצא עברית ואנגלית, מדרג ומתעדכן"""
+        first = temp_db.save_customer_request(1, "danny", "דני כהן", "מחפש בוט לניהול תורים במספרה")
+        temp_db.save_customer_request(2, "sara", "שרה לוי", "I need a Telegram bot for my shop")
+        temp_db.save_customer_request(3, "moshe", "משה", "שאלה על מחירים")
+
+        result = temp_db.search_requests("תורים")
+        assert [r['id'] for r in result['items']] == [first]
+        assert '«' in result['items'][0]['snippet']
+
+        # תחילית מילה, שם משתמש ושם מלא
+        assert len(temp_db.search_requests("teleg")['items']) == 1
+        assert len(temp_db.search_requests("danny")['items']) == 1
+        assert len(temp_db.search_requests("שרה")['items']) == 1
+
+        # עדכון טקסט מסונכרן לאינדקס דרך הטריגר
+        conn = temp_db.connections.get()
+        with conn:
+            conn.execute("UPDATE customer_requests SET message_text = 'בקשה חדשה' WHERE id = ?", (first,))
+        assert temp_db.search_requests("תורים")['items'] == []
+
+        # תווים מיוחדים לא שוברים את התחביר של MATCH
+        assert temp_db.search_requests('"bot" (*')['items']
+
+    def test_search_requests_pagination(self, temp_db):
+        for i in range(7):
+            temp_db.save_customer_request(i, f"u{i}", f"משתמש {i}", "רוצה בוט")
+        first = temp_db.search_requests("בוט", limit=5)
+        second = temp_db.search_requests("בוט", limit=5, offset=5)
+        assert first['has_more'] and not second['has_more']
+        assert len(first['items']) + len(second['items']) == 7
+        assert not {r['id'] for r in first['items']} & {r['id'] for r in second['items']}
+
+    def test_recent_users_by_window(self, temp_db):
+        """בדיקה שחלונות שבוע/חודש מגיעים משאילתה אחת עם פרטי הפנייה האחרונה"""
+        conn = temp_db.connections.get()
+        with conn:
+            conn.execute(
+                "INSERT INTO customer_requests (user_id, username, full_name, message_text, created_at) "
+                "VALUES (1, 'old_name', 'שם ישן', 'ישן', datetime('now', '-20 days'))"
+            )
+        temp_db.log_user_actions([(2, 'start', None, database._utc_cutoff_str(20))])
+        temp_db.save_customer_request(1, 'new_name', 'שם חדש', 'חדש')
+        temp_db.log_user_action(3, 'start')
+
+        windows = temp_db.get_recent_users_by_window((7, 30))
+        assert {u['user_id'] for u in windows[7]} == {1, 3}
+        assert {u['user_id'] for u in windows[30]} == {1, 2, 3}
+        user1 = next(u for u in windows[30] if u['user_id'] == 1)
+        assert user1['username'] == 'new_name'
+        assert windows[7] == temp_db.get_recent_users_with_details(7)
+
+    def test_connection_is_reused_and_tuned(self, temp_db):
+        """בדיקה שהחיבור נשמר לכל חוט ומוגדר ל-WAL"""
+        conn = temp_db.connections.get()
+        temp_db.log_user_action(123, 'start')
+        assert temp_db.connections.get() is conn
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+
+    def test_connection_per_thread(self, temp_db):
+        """בדיקה שכל חוט מקבל חיבור משלו"""
+        import threading
+        other = []
+        thread = threading.Thread(target=lambda: other.append(temp_db.connections.get()))
+        thread.start()
+        thread.join()
+        assert other[0] is not temp_db.connections.get()
+
+class TestRollups:
+    """בדיקות טבלאות הסיכום היומיות"""
+
+    def _snapshot(self, db):
+        conn = db.connections.get()
+        return {
+            table: sorted(tuple(row) for row in conn.execute(f'SELECT * FROM {table}'))
+            for table in ('daily_action_rollup', 'daily_request_rollup', 'daily_requester_rollup')
+        }
+
+    def test_stats_follow_requests_and_status_changes(self, temp_db):
+        first = temp_db.save_customer_request(1, 'u1', 'משתמש 1', 'הודעה 1')
+        temp_db.save_customer_request(1, 'u1', 'משתמש 1', 'הודעה 2')
+        temp_db.save_customer_request(2, 'u2', 'משתמש 2', 'הודעה 3')
+        temp_db.update_request_status(first, 'completed')
+
+        stats = temp_db.get_user_stats()
+        assert stats == {
+            'total_requests': 3,
+            'pending_requests': 2,
+            'recent_requests': 3,
+            'unique_users': 2,
+        }
+
+    def test_daily_activity_counts_events_and_distinct_users(self, temp_db):
+        temp_db.log_user_actions([
+            (1, 'start', None, database._utc_now_str()),
+            (1, 'view_info', None, database._utc_now_str()),
+            (2, 'view_info', None, database._utc_now_str()),
+        ])
+        temp_db.log_user_action(1, 'view_info')
+
+        today = temp_db.get_daily_activity(7)[0]
+        assert today['events'] == 4
+        assert today['users'] == 2
+        assert today['actions'] == {'start': 1, 'view_info': 3}
+
+    def test_day_window_boundaries_match(self, temp_db):
+        """אותו חלון של 7 ימים: היום הראשון נכלל, היום שלפניו לא - בשתי השאילתות"""
+        first_day = database._utc_since_day(7)
+        day_before = (datetime.strptime(first_day, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+        inside, outside = f'{first_day} 00:00:00', f'{day_before} 23:59:59'
+        with temp_db.connections.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO customer_requests (user_id, message_text, created_at) VALUES (?, 'x', ?)",
+                [(1, inside), (2, outside)],
+            )
+        temp_db.log_user_actions([(1, 'start', None, inside), (2, 'start', None, outside)])
+
+        assert temp_db.get_user_stats(7)['recent_requests'] == 1
+        daily = temp_db.get_daily_activity(7)
+        assert [d['date'] for d in daily] == [first_day]
+        assert sum(d['events'] for d in daily) == 1
+
+    def test_rebuild_matches_incremental(self, temp_db):
+        temp_db.save_customer_request(1, 'u1', 'משתמש 1', 'הודעה')
+        temp_db.save_customer_request(3, 'u3', 'משתמש 3', 'הודעה')
+        temp_db.update_request_status(1, 'completed')
+        for user_id, action in [(1, 'start'), (2, 'start'), (1, 'open_whatsapp'), (1, 'start')]:
+            temp_db.log_user_action(user_id, action)
+
+        incremental = self._snapshot(temp_db)
+        assert temp_db.rebuild_rollups()
+        assert self._snapshot(temp_db) == incremental
+
+class TestCompactStats:
+    """בדיקות פורמט השורות הקומפקטי של bot_stats"""
+
+    def test_actions_are_dictionary_encoded(self, temp_db):
+        ts = database._utc_now_str()
+        temp_db.log_user_actions([(1, 'start', None, ts), (2, 'start', {'x': 1}, ts), (1, 'view_info', None, ts)])
+        conn = temp_db.connections.get()
+
+        assert conn.execute('SELECT COUNT(*) FROM actions').fetchone()[0] == 2
+        table = database._partition_table(database._month_key(ts))
+        raw = conn.execute(f'SELECT ts, action_id, data FROM {table} ORDER BY id').fetchall()
+        assert all(isinstance(row['ts'], int) and isinstance(row['action_id'], int) for row in raw)
+        assert raw[0]['data'] is None
+
+        # ה-VIEW מחזיר את העמודות המקוריות
+        rows = conn.execute('SELECT user_id, action, data, timestamp FROM bot_stats ORDER BY id').fetchall()
+        assert [(r['user_id'], r['action']) for r in rows] == [(1, 'start'), (2, 'start'), (1, 'view_info')]
+        assert rows[0]['timestamp'] == ts
+        assert json.loads(rows[1]['data']) == {'x': 1}
+
+    def test_failed_view_rebuild_keeps_bot_stats(self, temp_db):
+        """שגיאה אחרי DROP VIEW בזמן יצירת מחיצה מתגלגלת אחורה - bot_stats לא נעלם"""
+        temp_db.log_user_action(1, 'start')
+        with patch.object(database, '_PARTITION_VIEW_SELECT', 'SELECT FROM {table} WHERE'):
+            with pytest.raises(sqlite3.OperationalError):
+                temp_db._ensure_partitions(['209901'])
+        conn = temp_db.connections.get()
+        assert conn.execute('SELECT COUNT(*) FROM bot_stats').fetchone()[0] == 1
+        assert '209901' not in temp_db._partitions
+        assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'bot_stats_209901'").fetchone() is None
+
+    def test_legacy_partitions_are_converted(self, temp_db):
+        """מחיצה בפורמט הטקסט הישן מומרת בשדרוג לגרסה 5 בלי לאבד שורות"""
+        month = database._month_key(database._utc_now_str())
+        table = database._partition_table(month)
+        conn = temp_db.connections.get()
+        with conn:
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+            conn.execute(f'''CREATE TABLE {table} (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+                            action TEXT NOT NULL, data TEXT, timestamp TIMESTAMP)''')
+            conn.execute(f"INSERT INTO {table} VALUES (7, 42, 'open_whatsapp', '', '2025-01-02 03:04:05')")
+            conn.execute('PRAGMA user_version = 4')
+        temp_db.close()
+
+        upgraded = database.DatabaseManager(temp_db.db_path)
+        try:
+            conn = upgraded.connections.get()
+            assert conn.execute('PRAGMA user_version').fetchone()[0] == database.SCHEMA_VERSION
+            row = conn.execute('SELECT * FROM bot_stats').fetchone()
+            assert (row['id'], row['user_id'], row['action'], row['data'], row['timestamp']) == \
+                (7, 42, 'open_whatsapp', None, '2025-01-02 03:04:05')
+            columns = {r[1] for r in conn.execute(f'PRAGMA table_info({table})')}
+            assert {'ts', 'action_id'} <= columns and 'action' not in columns
+        finally:
+            upgraded.close()
+
+
+class TestStatsMigrations:
+    """שדרוג bot_stats למחיצות: אטומיות מול קריסה ומזהים ייחודיים"""
+
+    def _db_at_version(self, path, version):
+        with patch.object(database, 'SCHEMA_MIGRATIONS', database.SCHEMA_MIGRATIONS[:version]):
+            db = database.DatabaseManager(path)
+        return db
+
+    def _ids(self, path):
+        db = database.DatabaseManager(path)
+        try:
+            conn = db.connections.get()
+            assert conn.execute('PRAGMA user_version').fetchone()[0] == database.SCHEMA_VERSION
+            return [row[0] for row in conn.execute('SELECT id FROM bot_stats ORDER BY id')], db
+        except Exception:
+            db.close()
+            raise
+
+    def test_crash_during_partitioning_recovers(self, tmp_path):
+        """קריסה באמצע גרסה 3 לא משאירה טבלה משונה, וההפעלה הבאה משלימה את השדרוג"""
+        path = str(tmp_path / 'legacy.db')
+        legacy = self._db_at_version(path, 2)
+        with legacy.connections.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO bot_stats (id, user_id, action, timestamp) VALUES (?, ?, 'start', ?)",
+                [(10, 1, '2025-01-05 10:00:00'), (11, 2, '2025-02-05 10:00:00'), (12, 3, '2025-02-06 10:00:00')],
+            )
+        legacy.close()
+
+        create = database._create_partition
+        created = []
+
+        def crash_on_second(conn, month):
+            created.append(month)
+            if len(created) == 2:
+                raise RuntimeError("crash")
+            create(conn, month)
+
+        with patch.object(database, '_create_partition', crash_on_second):
+            database.DatabaseManager(path).close()
+
+        with sqlite3.connect(path) as conn:
+            assert conn.execute('PRAGMA user_version').fetchone()[0] == 2
+            objects = dict(conn.execute("SELECT name, type FROM sqlite_master WHERE name LIKE 'bot_stats%'"))
+            assert objects == {'bot_stats': 'table'}
+            assert conn.execute('SELECT COUNT(*) FROM bot_stats').fetchone()[0] == 3
+
+        ids, db = self._ids(path)
+        try:
+            # המזהים המקוריים נשמרים, ומזהה חדש ממשיך אחריהם
+            assert ids == [10, 11, 12]
+            db.log_user_action(4, 'start')
+            assert self._max_id(db) == 13
+        finally:
+            db.close()
+
+    def _max_id(self, db):
+        return db.connections.get().execute('SELECT MAX(id) FROM bot_stats').fetchone()[0]
+
+    def test_ids_unique_across_partitions(self, tmp_path):
+        """מחיצות שמוספרו כל אחת מ-1 מקבלות מזהים ייחודיים, ומזהים חדשים באים מרצף אחד"""
+        path = str(tmp_path / 'dupes.db')
+        old = self._db_at_version(path, 6)
+        with old.connections.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO actions (name) VALUES ('start')")
+            for month in ('202501', '202502'):
+                database._create_partition(conn, month)
+                conn.executemany(
+                    f"INSERT INTO bot_stats_{month} (id, ts, user_id, action_id) VALUES (?, ?, 1, 1)",
+                    [(1, 1736000000), (2, 1736000001)],
+                )
+            database._rebuild_stats_view(conn, ['202501', '202502'])
+        old.close()
+
+        ids, db = self._ids(path)
+        try:
+            assert ids == [1, 2, 3, 4]
+            now = database._utc_now_str()
+            db.log_user_actions([(5, 'start', None, now), (6, 'start', None, '2025-01-09 00:00:00')])
+            ids = [row[0] for row in db.connections.get().execute('SELECT id FROM bot_stats')]
+            assert sorted(ids) == [1, 2, 3, 4, 5, 6]
+        finally:
+            db.close()
+
+
+class TestExport:
+    """בדיקות הייצוא הזורם"""
+
+    def test_iter_requests_filters_and_batches(self, temp_db):
+        ids = [temp_db.save_customer_request(i, f"u{i}", "שם", f"פנייה {i}") for i in range(7)]
+        temp_db.update_request_status(ids[0], 'completed')
+
+        rows = list(temp_db.iter_customer_requests(batch_size=2))
+        assert [r['id'] for r in rows] == ids
+        assert len(list(temp_db.iter_customer_requests(status='pending', batch_size=3))) == 6
+        assert list(temp_db.iter_customer_requests(since='2100-01-01')) == []
+
+    def test_iter_bot_stats_reads_partitions_in_order(self, temp_db):
+        old = database._utc_cutoff_str(40)
+        now = database._utc_now_str()
+        temp_db.log_user_actions([(1, 'start', None, old), (2, 'view_info', {'a': 1}, now),
+                                  (3, 'start', None, now)])
+
+        rows = list(temp_db.iter_bot_stats(batch_size=1))
+        assert [(r['user_id'], r['action'], r['timestamp']) for r in rows] == \
+            [(1, 'start', old), (2, 'view_info', now), (3, 'start', now)]
+        assert [r['user_id'] for r in temp_db.iter_bot_stats(since=database.window_start(1))] == [2, 3]
+        assert [r['user_id'] for r in temp_db.iter_bot_stats(action='start')] == [1, 3]
+        assert list(temp_db.iter_bot_stats(action='unknown')) == []
+
+    def test_export_splits_into_parts(self, global_temp_db, tmp_path):
+        for i in range(50):
+            global_temp_db.save_customer_request(i, f"u{i}", "שם, עם פסיק", "טקסט\nבשתי שורות")
+
+        paths = export.export('requests', 'csv', str(tmp_path), max_bytes=1000)
+        assert len(paths) > 1
+        rows = []
+        for path in paths:
+            with open(path, encoding='utf-8', newline='') as handle:
+                rows.extend(csv.DictReader(handle))
+        assert len(rows) == 50
+        assert rows[0]['full_name'] == "שם, עם פסיק"
+
+        jsonl = export.export('requests', 'jsonl', str(tmp_path), status='completed')
+        assert jsonl == []
+
+    def test_parse_export_args(self):
+        from bot import _parse_export_args
+        assert _parse_export_args(['requests']) == ('requests', 'csv', None, None)
+        assert _parse_export_args(['activity', 'jsonl', '30', 'start']) == ('activity', 'jsonl', 30, 'start')
+        assert _parse_export_args(['users']) is None
+        assert _parse_export_args([]) is None
+
+
+class TestBufferedActivityReporter:
+    """בדיקות ה-reporter שמאחד דיווחים ושולח אותם באצווה"""
+
+    @pytest.fixture
+    def reporter(self, tmp_path):
+        from activity_reporter import BufferedActivityReporter
+        # MongoClient לא מתחבר עד הפעולה הראשונה; הקולקציות מוחלפות ב-Mock
+        rep = BufferedActivityReporter("mongodb://localhost:1", "srv-test", "Test",
+                                       flush_interval=60, service_update_interval=60,
+                                       spool_path=str(tmp_path / 'spool.jsonl'))
+        rep.db = Mock()
+        rep.db.service_activity.find_one.return_value = None
+        yield rep
+        rep._stop_event.set()
+
+    def test_report_is_buffered_and_coalesced(self, reporter):
+        for _ in range(3):
+            reporter.report_activity(1)
+        reporter.report_activity(2)
+        reporter.db.user_interactions.bulk_write.assert_not_called()
+
+        assert reporter.flush() == 2
+        operations = reporter.db.user_interactions.bulk_write.call_args[0][0]
+        counts = {op._filter["user_id"]: op._doc["$inc"]["interaction_count"] for op in operations}
+        assert counts == {1: 3, 2: 1}
+        assert reporter.db.service_activity.update_one.call_count == 1
+
+        # בלי פעילות חדשה אין כתיבה, ועדכון השירות מוגבל בקצב
+        reporter.report_activity(1)
+        reporter.flush()
+        assert reporter.db.user_interactions.bulk_write.call_count == 2
+        assert reporter.db.service_activity.update_one.call_count == 1
+
+    def test_failed_flush_keeps_counts(self, reporter):
+        reporter.report_activity(7)
+        reporter.db.user_interactions.bulk_write.side_effect = Exception("down")
+        assert reporter.flush() == 0
+
+        reporter.db.user_interactions.bulk_write.side_effect = None
+        reporter.report_activity(7)
+        reporter.close()
+        operations = reporter.db.user_interactions.bulk_write.call_args[0][0]
+        assert operations[0]._doc["$inc"]["interaction_count"] == 2
+        assert reporter.db.service_activity.update_one.called
+        assert not os.path.exists(reporter.spool.path)
+
+    def test_open_breaker_spools_and_replays(self, reporter):
+        bulk_write = reporter.db.user_interactions.bulk_write
+        bulk_write.side_effect = Exception("down")
+        for user_id in range(reporter.breaker.failure_threshold):
+            reporter.report_activity(user_id)
+            reporter.flush()
+        assert reporter.breaker.is_open
+        calls = bulk_write.call_count
+
+        # בזמן שהמפסק פתוח לא פונים למונגו בכלל - הכל הולך לקובץ
+        reporter.report_activity(0)
+        reporter.flush()
+        assert bulk_write.call_count == calls
+        assert os.path.getsize(reporter.spool.path) > 0
+
+        bulk_write.side_effect = None
+        reporter.breaker.opened_at -= reporter.breaker.reset_timeout
+        reporter.report_activity(1)
+        assert reporter.flush() == reporter.breaker.failure_threshold
+        counts = {op._filter["user_id"]: op._doc["$inc"]["interaction_count"]
+                  for op in bulk_write.call_args[0][0]}
+        assert counts[0] == 2 and counts[1] == 2
+        assert not reporter.breaker.is_open
+        assert not os.path.exists(reporter.spool.path)
+
+    def test_unbuffered_report_shares_write_path(self):
+        """דיווח לא מאוחד: bulk_write אחד לאינטראקציות ואחד לדלי היומי; מסמך השירות
+        מתעדכן לכל היותר פעם ב-service_update_interval"""
+        from activity_reporter import SimpleActivityReporter
+        reporter = SimpleActivityReporter("mongodb://localhost:1", "srv-test", "Test",
+                                          service_update_interval=60)
+        reporter.db = Mock()
+        reporter.db.service_activity.find_one.return_value = None
+        for user_id in (1, 2, 3):
+            reporter.report_activity(user_id)
+        assert reporter.db.user_interactions.bulk_write.call_count == 3
+        assert reporter.db.activity_daily.bulk_write.call_count == 3
+        reporter.db.user_interactions.update_one.assert_not_called()
+        assert reporter.db.service_activity.update_one.call_count == 1
+        reporter.close()
+        assert reporter.db.service_activity.update_one.call_count == 2
+
+    def test_spool_is_capped(self, tmp_path):
+        from activity_reporter import ActivitySpool
+        now = datetime.now()
+        spool = ActivitySpool(str(tmp_path / 'cap.jsonl'), max_bytes=200)
+        for user_id in range(10):
+            spool.append({user_id: [1, now, now]}, {})
+        assert os.path.getsize(spool.path) <= 200
+        assert spool.dropped > 0
+        batch, _days = spool.load()
+        assert len(batch) == 10 - spool.dropped
+
+
+class TestActivityDailyBuckets:
+    """בדיקות הדליים היומיים במונגו (מול mongomock)"""
+
+    @pytest.fixture
+    def reporter(self, tmp_path):
+        mongomock = pytest.importorskip('mongomock')
+        from activity_reporter import BufferedActivityReporter
+        rep = BufferedActivityReporter("mongodb://localhost:1", "srv-test", "Test",
+                                       flush_interval=60, service_update_interval=0,
+                                       spool_path=str(tmp_path / 'spool.jsonl'))
+        rep.db = mongomock.MongoClient()["render_bot_monitor"]
+        yield rep
+        rep._stop_event.set()
+
+    def test_weekly_stats_from_buckets(self, reporter):
+        from datetime import timedelta, timezone
+        for user_id in (1, 1, 2):
+            reporter.report_activity(user_id)
+        reporter.flush()
+
+        # דלי של לפני שלושה ימים ודלי ישן שמחוץ לשבוע
+        for days_ago, users, total in ((3, [2, 3], 5), (20, [9], 4)):
+            day = (datetime.now(timezone.utc) - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+            reporter.db.activity_daily.insert_one(
+                {"_id": f"srv-test:{day}", "service_id": "srv-test", "date": day,
+                 "users": users, "total_activities": total})
+
+        reporter.report_activity(4)
+        week = reporter.get_weekly_stats()
+        assert week["period"] == "7 הימים האחרונים"
+        assert week["unique_users"] == 4
+        assert week["total_activities"] == 9
+        assert len(week["daily_breakdown"]) == 7
+        assert week["daily_breakdown"][0]["unique_users_count"] == 3
+        assert week["daily_breakdown"][3]["total_activities"] == 5
+
+        month = reporter.get_monthly_stats()
+        assert month["unique_users"] == 5 and month["total_activities"] == 13
+        assert reporter.db.activity_daily.count_documents({}) == 3
+
+    def test_unique_users_from_sketches(self, reporter):
+        for user_id in range(1, 301):
+            reporter.report_activity(user_id)
+        reporter.flush(force_service_update=True)
+        for user_id in range(200, 401):
+            reporter.report_activity(user_id)
+        reporter.flush(force_service_update=True)
+
+        unique = reporter.get_unique_users()
+        for key in ("dau", "wau", "mau", "lifetime"):
+            assert abs(unique[key] - 400) <= 400 * 0.07, (key, unique[key])
+        service = reporter.db.service_activity.find_one({"_id": "srv-test"})
+        assert service["total_users"] == unique["lifetime"]
+
+    def test_unbuffered_reporter_updates_total_users(self, reporter):
+        """total_users מתעדכן גם ב-SimpleActivityReporter, בלי כתיבה שנייה למסמך השירות"""
+        from activity_reporter import SimpleActivityReporter
+        simple = SimpleActivityReporter("mongodb://localhost:1", "srv-test", "Test",
+                                        service_update_interval=0)
+        simple.db = reporter.db
+        for user_id in range(1, 51):
+            simple.report_activity(user_id)
+        service = simple.db.service_activity.find_one({"_id": "srv-test"})
+        assert abs(service["total_users"] - 50) <= 3
+        assert service["total_users"] == simple.get_unique_users()["lifetime"]
+
+    def test_total_users_computed_in_memory(self, reporter):
+        """הסקיצה של מסמך השירות נקראת פעם אחת, וכל עדכון הוא כתיבה אחת"""
+        reporter.report_activity(1)
+        reporter.flush()
+        service = reporter.db.service_activity
+        with patch.object(service, 'find_one', wraps=service.find_one) as find_one, \
+                patch.object(service, 'update_one', wraps=service.update_one) as update_one:
+            for user_id in range(2, 12):
+                reporter.report_activity(user_id)
+                reporter.flush()
+        find_one.assert_not_called()
+        assert update_one.call_count == 10
+        assert service.find_one({"_id": "srv-test"})["total_users"] == 11
+
+    def test_stats_week_shows_estimates(self):
+        import bot
+        update = Mock()
+        update.effective_user.id = 99
+        update.message.reply_text = AsyncMock()
+        reporter = Mock()
+        reporter.get_weekly_stats.return_value = {"period": "7 הימים האחרונים", "unique_users": 3,
+                                                  "total_activities": 5, "daily_breakdown": []}
+        reporter.get_unique_users.return_value = {"dau": 1, "wau": 3, "mau": 4, "lifetime": 9}
+        with patch.object(bot, 'reporter', reporter), patch.object(bot, 'OWNER_CHAT_ID', '99'):
+            asyncio.run(bot.stats_week(update, Mock()))
+        text = update.message.reply_text.call_args.args[0]
+        assert "שבוע 3" in text and "מאז ומעולם 9" in text
+        assert bot._format_unique_users({"error": "x"}) == ""
+
+
+class TestMongoClients:
+    """בדיקות הרישום המשותף של חיבורי MongoDB"""
+
+    def test_client_shared_per_uri(self, monkeypatch):
+        import mongo_clients
+        # רישום ריק לבדיקה - לא נוגעים בחיבור של הבוט
+        monkeypatch.setattr(mongo_clients, '_clients', {})
+        uri = "mongodb://localhost:1/?appName=shared-test"
+        try:
+            client = mongo_clients.get_client(uri, name='shared-test')
+            assert mongo_clients.get_client(uri) is client
+            assert mongo_clients.get_client("mongodb://localhost:2/", name='other-test') is not client
+            assert client.options.pool_options.max_pool_size == mongo_clients.MONGO_MAX_POOL_SIZE
+        finally:
+            mongo_clients.close_all()
+        assert mongo_clients.get_client(uri) is not client
+        mongo_clients.close_all()
+
+    def test_health_from_heartbeats(self):
+        import mongo_clients
+        mongo_clients._health['hb-test'] = {"ok": None, "last_ok": None, "latency_ms": None}
+        listener = mongo_clients._HealthListener('hb-test')
+        listener.succeeded(Mock(duration=0.012))
+        assert mongo_clients.health()['hb-test']['ok'] is True
+        assert mongo_clients.health()['hb-test']['latency_ms'] == 12.0
+        listener.failed(Mock(reply="timeout"))
+        assert mongo_clients.health()['hb-test']['ok'] is False
+
+
+class TestLease:
+    """בדיקות פעולות ה-lease מול collection מדומה"""
+
+    def test_acquire_uses_server_time(self):
+        import lease
+        collection = Mock()
+        collection.find_one_and_update.return_value = {"_id": "lock", "owner": "me"}
+        assert lease.try_acquire(collection, "lock", "me", 60) is True
+        query, pipeline = collection.find_one_and_update.call_args.args
+        assert {"$expr": {"$lte": ["$expiresAt", "$$NOW"]}} in query["$or"]
+        assert pipeline[0]["$set"]["expiresAt"] == {"$add": ["$$NOW", 60000]}
+
+    def test_acquire_held_by_other(self):
+        import lease
+        from pymongo.errors import DuplicateKeyError
+        collection = Mock()
+        collection.find_one_and_update.side_effect = DuplicateKeyError("dup")
+        assert lease.try_acquire(collection, "lock", "me", 60) is False
+
+    def test_renew_and_release_report_ownership(self):
+        import lease
+        collection = Mock()
+        collection.update_one.return_value = Mock(matched_count=0)
+        collection.delete_one.return_value = Mock(deleted_count=1)
+        assert lease.renew(collection, "lock", "me", 60) is False
+        assert lease.release(collection, "lock", "me") is True
+
+    @pytest.mark.parametrize("kind", ["sqlite", "file"])
+    def test_local_backends_semantics(self, tmp_path, kind):
+        import lease
+        path = str(tmp_path / f"lock.{kind}")
+        first = lease.create_backend(kind, "svc", path=path)
+        second = lease.create_backend(kind, "svc", path=path)
+        first.ensure()
+        assert first.try_acquire("a", 60) is True
+        assert first.try_acquire("a", 60) is True  # רכישה חוזרת ע"י אותו owner
+        assert second.try_acquire("b", 60) is False
+        assert first.renew("a", 60) is True
+        assert second.renew("b", 60) is False
+        assert second.release("b") is False
+        assert first.release("a") is True
+        assert second.try_acquire("b", 60) is True
+        assert second.release("b") is True
+        metrics = first.metrics()
+        assert metrics["acquire"]["count"] == 2
+        assert metrics["release"]["count"] == 1
+
+    @pytest.mark.parametrize("kind", ["sqlite", "file"])
+    def test_handover_marker(self, tmp_path, kind):
+        import lease
+        path = str(tmp_path / f"lock.{kind}")
+        holder = lease.create_backend(kind, "svc", path=path)
+        waiter = lease.create_backend(kind, "svc", path=path)
+        holder.ensure()
+        assert holder.try_acquire("old", 60)
+        assert waiter.peek() == {"owner": "old", "handover": False}
+        assert holder.mark_handover("old", 30) is True
+        assert waiter.peek()["handover"] is True
+        holder.release("old")
+        assert waiter.peek() is None
+        assert waiter.try_acquire("new", 60)
+        assert waiter.peek() == {"owner": "new", "handover": False}
+
+    def test_waiter_wakes_on_handover(self, monkeypatch):
+        import bot
+        monkeypatch.setattr(bot, 'LOCK_WAIT_MIN_SECONDS', 30)
+        monkeypatch.setattr(bot, 'LOCK_WAIT_MAX_SECONDS', 30)
+        monkeypatch.setattr(bot, 'LOCK_HANDOVER_POLL_SECONDS', 0.01)
+        backend = Mock()
+        backend.peek.side_effect = [{"owner": "old", "handover": False},
+                                    {"owner": "old", "handover": True}]
+        start = time.monotonic()
+        assert bot._sleep_when_locked(backend) is True
+        assert time.monotonic() - start < 5
+        assert backend.peek.call_count == 2
+
+    def test_hot_standby_polls_read_only(self, monkeypatch):
+        """הממתין בודק ב-peek, ומנסה לרכוש (כתיבה) רק כשה-lease פנוי או ב-handover"""
+        import bot
+        monkeypatch.setattr(bot, 'LOCK_STANDBY_POLL_MS', 1)
+        backend = Mock()
+        backend.peek.side_effect = [{"owner": "old", "handover": False}] * 5 + [None]
+        with patch.object(bot.logger, 'info') as info:
+            assert bot._wait_hot_standby(backend) is False
+        assert backend.peek.call_count == 6
+        backend.try_acquire.assert_not_called()
+        info.assert_called_once()
+
+        backend.peek.side_effect = [{"owner": "old", "handover": True}]
+        assert bot._wait_hot_standby(backend) is True
+
+    def test_peek_is_read_only_on_server_time(self):
+        import lease
+        collection = Mock()
+        collection.find_one.return_value = None
+        assert lease.peek(collection, "lock") is None
+        query, _ = collection.find_one.call_args.args
+        assert query["$expr"] == {"$gt": ["$expiresAt", "$$NOW"]}
+        collection.find_one_and_update.assert_not_called()
+        collection.update_one.assert_not_called()
+
+    def test_file_peek_ignores_stale_owner(self, tmp_path):
+        """תוכן שנשאר בקובץ אחרי שמחזיק קרס (בלי flock) לא נחשב נעילה מוחזקת"""
+        import lease
+        path = tmp_path / "lock.file"
+        path.write_text("svc crashed 123\n", encoding='utf-8')
+        backend = lease.create_backend("file", "svc", path=str(path))
+        assert backend.peek() is None
+
+    def test_sqlite_expired_lease_taken_over(self, tmp_path):
+        import lease
+        backend = lease.create_backend("sqlite", "svc", path=str(tmp_path / "lock.db"))
+        backend.ensure()
+        assert backend.try_acquire("a", 0.01) is True
+        time.sleep(0.02)
+        assert backend.try_acquire("b", 60) is True
+        assert backend.renew("a", 60) is False
+
+    def test_unknown_backend(self):
+        import lease
+        with pytest.raises(ValueError):
+            lease.create_backend("redis", "svc")
+
+
+class TestHyperLogLog:
+    """בדיקות סקיצת HyperLogLog מול ספירה מדויקת"""
+
+    def test_error_within_bounds(self):
+        import hll
+        bound = 3 * 1.04 / (2 ** (hll.HLL_PRECISION / 2))  # שלוש שגיאות תקן
+        for exact in (10, 500, 5000, 50000):
+            registers = hll.registers_for(range(exact))
+            assert abs(hll.estimate(registers) - exact) <= max(1, exact * bound), exact
+
+    def test_merge_equals_union(self):
+        import hll
+        left = hll.registers_for(range(0, 20000))
+        right = hll.registers_for(range(10000, 30000))
+        merged = hll.merge_registers(dict(left), right)
+        assert merged == hll.registers_for(range(0, 30000))
+        # מפתחות מחרוזת (כמו שחוזרים ממונגו) נותנים אותו אומדן
+        assert hll.estimate({str(k): v for k, v in merged.items()}) == hll.estimate(merged)
+        # ערכים חוזרים לא משנים את הסקיצה
+        assert hll.registers_for(list(range(100)) * 3) == hll.registers_for(range(100))
+
+
+class TestWebhookServer:
+    """בדיקות קבלת עדכונים ב-webhook: סוד, תור חסום ומענה מיידי"""
+
+    UPDATE = {"update_id": 1, "message": {"message_id": 1, "date": 0, "text": "hi",
+                                          "chat": {"id": 5, "type": "private"}}}
+
+    def _run(self, queue, scenario):
+        from aiohttp.test_utils import TestClient, TestServer
+        import webhook_server
+
+        async def go():
+            server = webhook_server.WebhookServer(queue, None, '/telegram', 'sekret')
+            async with TestClient(TestServer(server.app)) as client:
+                await scenario(client)
+            return server.stats
+
+        return asyncio.run(go())
+
+    def test_secret_and_queue(self):
+        queue = asyncio.Queue(maxsize=1)
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 'sekret'}
+
+        async def scenario(client):
+            assert (await client.post('/telegram', json=self.UPDATE)).status == 403
+            wrong = {'X-Telegram-Bot-Api-Secret-Token': 'nope'}
+            assert (await client.post('/telegram', json=self.UPDATE, headers=wrong)).status == 403
+            assert (await client.post('/telegram', data='{', headers=headers)).status == 400
+            assert (await client.post('/telegram', json=self.UPDATE, headers=headers)).status == 200
+            # התור מלא ואף אחד לא מרוקן אותו - 503 מיד, בלי לחכות
+            assert (await client.post('/telegram', json=self.UPDATE, headers=headers)).status == 503
+
+        stats = self._run(queue, scenario)
+        assert stats == {"accepted": 1, "forbidden": 2, "bad_request": 1, "queue_full": 1}
+        update = queue.get_nowait()
+        assert update.update_id == 1 and update.message.text == "hi"
+
+    def test_updates_in_processing_count_towards_limit(self):
+        """התור מתרוקן מיד (כמו ה-fetcher של PTB עם concurrent_updates), אבל עדכונים
+        שעדיין בעיבוד תופסים מקום - כשהמגבלה מלאה מוחזר 503"""
+        import update_processor
+        import webhook_server
+        queue = webhook_server.PendingUpdatesQueue(2)
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 'sekret'}
+
+        async def scenario(client):
+            processor = update_processor.PerUserUpdateProcessor(4)
+            release = asyncio.Event()
+
+            async def handler():
+                await release.wait()
+
+            async def fetcher():
+                tasks = []
+                while True:
+                    update = await queue.get()
+                    if update is None:
+                        queue.task_done()
+                        return tasks
+
+                    async def process(update=update):
+                        await processor.process_update(update, handler())
+                        queue.task_done()
+                    tasks.append(asyncio.create_task(process()))
+
+            fetching = asyncio.create_task(fetcher())
+            for update_id in (1, 2):
+                update = dict(self.UPDATE, update_id=update_id)
+                assert (await client.post('/telegram', json=update, headers=headers)).status == 200
+            await asyncio.sleep(0.01)
+            assert queue.empty() and queue.pending == 2
+            assert (await client.post('/telegram', json=self.UPDATE, headers=headers)).status == 503
+
+            release.set()
+            await asyncio.sleep(0.01)
+            assert queue.pending == 0
+            assert (await client.post('/telegram', json=self.UPDATE, headers=headers)).status == 200
+            # אות העצירה (put ממתין, כמו ב-PTB) מסיים את ה-fetcher
+            await queue.put(None)
+            await asyncio.gather(*await fetching)
+
+        stats = self._run(queue, scenario)
+        assert stats["accepted"] == 3 and stats["queue_full"] == 1
+
+    def test_secret_is_shared_across_instances(self):
+        """בלי WEBHOOK_SECRET כל המופעים גוזרים את אותו סוד מהטוקן"""
+        import bot
+        derived = bot._webhook_secret(None, '123:abc')
+        assert derived == bot._webhook_secret('', '123:abc')
+        assert derived != bot._webhook_secret(None, '123:other')
+        assert bot._webhook_secret('configured', '123:abc') == 'configured'
+        assert bot._webhook_secret(None, None) is None
+
+
+class TestUpdateProcessor:
+    """עיבוד במקביל בין משתמשים, לפי הסדר לכל משתמש"""
+
+    @staticmethod
+    def _update(update_id, user_id):
+        from telegram import Update
+        return Update.de_json({"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "text": "x",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "U"}}}, None)
+
+    def _process(self, processor, updates, handler):
+        async def go():
+            async with processor:
+                # כמו ה-fetcher של PTB: משימה לכל עדכון לפי סדר ההגעה
+                await asyncio.gather(*(processor.process_update(u, handler(u)) for u in updates))
+        asyncio.run(go())
+
+    def test_same_user_in_order_other_users_concurrent(self):
+        import update_processor
+        processor = update_processor.PerUserUpdateProcessor(concurrency=4)
+        events = []
+
+        async def handler(update):
+            user = update.effective_user.id
+            events.append(('start', user, update.update_id))
+            # העדכון הראשון של משתמש 1 איטי - לא אמור לעכב את משתמש 2
+            await asyncio.sleep(0.05 if update.update_id == 1 else 0.001)
+            events.append(('end', user, update.update_id))
+
+        updates = [self._update(1, 1), self._update(2, 1), self._update(3, 2), self._update(4, 1)]
+        self._process(processor, updates, handler)
+
+        user1 = [e for e in events if e[1] == 1]
+        assert user1 == [('start', 1, 1), ('end', 1, 1), ('start', 1, 2), ('end', 1, 2),
+                         ('start', 1, 4), ('end', 1, 4)]
+        assert events.index(('end', 2, 3)) < events.index(('end', 1, 1))
+        metrics = processor.metrics()
+        assert metrics["processed"] == 4 and metrics["waiting"] == 0 and metrics["users_in_flight"] == 0
+        assert metrics["max_active"] == 2
+
+    def test_concurrency_limit_and_errors(self):
+        import update_processor
+        processor = update_processor.PerUserUpdateProcessor(concurrency=2)
+        active = {"now": 0, "max": 0}
+
+        async def handler(update):
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+            await asyncio.sleep(0.005)
+            active["now"] -= 1
+            if update.update_id == 3:
+                raise RuntimeError("boom")
+
+        updates = [self._update(i, i) for i in range(1, 7)]
+
+        async def go():
+            async with processor:
+                return await asyncio.gather(*(processor.process_update(u, handler(u)) for u in updates),
+                                            return_exceptions=True)
+        results = asyncio.run(go())
+        assert active["max"] == 2
+        assert isinstance(results[2], RuntimeError)
+        metrics = processor.metrics()
+        assert metrics["processed"] == 6 and metrics["errors"] == 1 and metrics["wait_max_ms"] > 0
+
+    def test_invalid_concurrency(self):
+        import update_processor
+        with pytest.raises(ValueError):
+            update_processor.PerUserUpdateProcessor(concurrency=0)
+
+
+class TestHttpServer:
+    """בדיקות שרת ה-HTTP שרץ על ה-loop של הבוט"""
+
+    def _run(self, app, scenario):
+        from aiohttp.test_utils import TestClient, TestServer
+
+        async def go():
+            async with TestClient(TestServer(app)) as client:
+                await scenario(client)
+
+        asyncio.run(go())
+
+    def test_health_reports_bot_state(self):
+        import bot
+        import http_server
+
+        async def scenario(client):
+            resp = await client.get('/health')
+            assert resp.status == 200
+            body = await resp.json()
+            assert body["status"] == "healthy"
+            assert body["db"]["ok"] is True
+            assert set(body) >= {"loop", "bot", "lock", "mongo", "took_ms"}
+            assert (await client.get('/')).status == 200
+
+        self._run(http_server.create_app(bot._health_payload), scenario)
+
+    def test_unhealthy_is_503(self):
+        import http_server
+
+        async def provider():
+            return {"status": "unhealthy"}
+
+        async def scenario(client):
+            assert (await client.get('/health')).status == 503
+
+        self._run(http_server.create_app(provider), scenario)
+
+    def test_loglevel_requires_token(self, monkeypatch):
+        import http_server
+        monkeypatch.setenv('LOG_ADMIN_TOKEN', 'tok')
+        root_level = logging.getLogger().level
+
+        async def provider():
+            return {"status": "healthy"}
+
+        async def scenario(client):
+            assert (await client.get('/admin/loglevel?token=bad')).status == 403
+            resp = await client.get('/admin/loglevel', headers={'X-Admin-Token': 'tok'})
+            assert (await resp.json())["status"] == "ok"
+
+        try:
+            self._run(http_server.create_app(provider), scenario)
+        finally:
+            logging.getLogger().setLevel(root_level)
+
+    def test_loop_lag_monitor(self):
+        import http_server
+
+        async def go():
+            monitor = http_server.LoopLagMonitor(interval=0.01)
+            monitor.start()
+            await asyncio.sleep(0.02)
+            time.sleep(0.05)  # חסימה מכוונת של ה-loop
+            await asyncio.sleep(0.02)
+            await monitor.stop()
+            return monitor.snapshot()
+
+        assert asyncio.run(go())["max_lag_ms"] >= 30
+
+
+class TestTrackingMiddleware:
+    """בדיקות שכבת המעקב שרצה פעם אחת לכל עדכון"""
+
+    def _update(self, text, user_id=10):
+        update = Mock()
+        update.effective_user.id = user_id
+        update.effective_user.username = 'u'
+        update.effective_user.full_name = 'User'
+        update.message.text = text
+        return update
+
+    def test_action_labels(self):
+        import bot
+        assert bot._action_label(self._update("/start")) == ('start', {'username': 'u', 'full_name': 'User'})
+        assert bot._action_label(self._update("/pending")) == (None, None)
+        assert bot._action_label(self._update("/admin_stats")) == (None, None)
+        with patch.object(bot, 'OWNER_CHAT_ID', '10'):
+            assert bot._action_label(self._update("/admin_stats")) == ('admin_stats_view', None)
+        assert bot._action_label(self._update("ℹ️ מידע על השירות")) == ('view_info', None)
+        assert bot._action_label(self._update("שלום")) == ('free_text_message', None)
+        with patch.object(bot.conversation_states, 'get', return_value='waiting_for_details'):
+            assert bot._action_label(self._update("הפרטים שלי")) == ('contact_details_submitted', None)
+
+    def test_button_press_tracked_once(self):
+        import bot
+        update = self._update("ℹ️ מידע על השירות")
+        update.message.reply_text = AsyncMock()
+        with patch.object(bot, 'reporter') as reporter, patch.object(bot.database, 'log_action') as log_action:
+            asyncio.run(bot.track_update(update, Mock()))
+            asyncio.run(bot.MAIN_MENU.dispatch(update, Mock()))
+        reporter.report_activity.assert_called_once_with(10)
+        log_action.assert_called_once_with(10, 'view_info', None)
+
+    def test_admin_stats_view_keeps_counts(self):
+        """admin_stats_view נרשם אחרי ה-handler, עם מספרי המשתמשים שה-handler צירף"""
+        import bot
+        from types import SimpleNamespace
+        update = self._update("/admin_stats")
+        update.message.reply_text = AsyncMock()
+        windows = {7: [{"user_id": 1}], 30: [{"user_id": 1}, {"user_id": 2}]}
+        with patch.object(bot, 'OWNER_CHAT_ID', '10'), patch.object(bot, 'reporter'), \
+                patch.object(bot.database, 'get_active_users_by_window', return_value=windows), \
+                patch.object(bot.database, 'get_stats', return_value={}), \
+                patch.object(bot.database, 'get_daily_activity', return_value=[]), \
+                patch.object(bot.database, 'log_action') as log_action:
+            context = SimpleNamespace()
+            asyncio.run(bot.track_update(update, context))
+            log_action.assert_not_called()
+            asyncio.run(bot.admin_stats(update, context))
+            asyncio.run(bot.log_deferred_action(update, context))
+            log_action.assert_called_once_with(10, 'admin_stats_view', {'week_count': 1, 'month_count': 2})
+
+            # handler שנכשל לא מצרף נתונים - אין רישום, כמו קודם
+            log_action.reset_mock()
+            context = SimpleNamespace()
+            asyncio.run(bot.track_update(update, context))
+            asyncio.run(bot.log_deferred_action(update, context))
+            log_action.assert_not_called()
+
+
+class TestQueryPlans:
+    """בדיקה שהשאילתות החמות משתמשות באינדקסים ולא סורקות טבלאות מלאות"""
+
+    @pytest.fixture
+    def temp_db(self, temp_db):
+        """temp_db עם פנייה ופעולה אחת, כדי שלתוכניות הביצוע יהיו טבלאות לא ריקות"""
+        temp_db.save_customer_request(1, 'user1', 'משתמש 1', 'הודעה')
+        temp_db.log_user_action(1, 'start')
+        return temp_db
+
+    def _plans(self, db, call):
+        """מריץ את הפונקציה, לוכד את השאילתות שהיא שולחת ומחזיר את תוכנית הביצוע של כל אחת"""
+        conn = db.connections.get()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+        plans = {}
+        for sql in statements:
+            if sql.lstrip().upper().startswith(('SELECT', 'DELETE', 'WITH')):
+                rows = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+                plans[sql] = [row[3] for row in rows]
+        assert plans, "לא נלכדו שאילתות"
+        return plans
+
+    def _assert_uses(self, plans, *index_names):
+        details = "\n".join(d for plan in plans.values() for d in plan)
+        for plan in plans.values():
+            for detail in plan:
+                for table in ('customer_requests', 'bot_stats'):
+                    if detail.startswith(('SCAN ' + table, 'SEARCH ' + table)):
+                        assert 'INDEX' in detail, f"סריקה מלאה: {detail}"
+        for name in index_names:
+            assert name in details, f"האינדקס {name} לא בשימוש:\n{details}"
+
+    def test_schema_version_recorded(self, temp_db):
+        conn = temp_db.connections.get()
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == database.SCHEMA_VERSION
+
+    def test_migrations_are_idempotent(self, temp_db):
+        """בדיקה שאתחול חוזר לא נכשל ולא משנה את הגרסה"""
+        again = database.DatabaseManager(temp_db.db_path)
+        conn = again.connections.get()
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == database.SCHEMA_VERSION
+        again.close()
+
+    def test_failed_migration_is_rolled_back(self, temp_db):
+        """שלב שנכשל באמצע לא משאיר DDL חלקי, והגרסה לא מתקדמת"""
+        def fail(conn):
+            raise RuntimeError("crash")
+
+        steps = [(database.SCHEMA_VERSION + 1, "בדיקה", [
+            "CREATE TABLE migration_probe (x INTEGER)",
+            "ALTER TABLE customer_requests RENAME TO customer_requests_old",
+            fail,
+        ])]
+        with patch.object(database, 'SCHEMA_MIGRATIONS', database.SCHEMA_MIGRATIONS + steps):
+            again = database.DatabaseManager(temp_db.db_path)
+        conn = again.connections.get()
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+        assert 'migration_probe' not in names and 'customer_requests' in names
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == database.SCHEMA_VERSION
+        again.close()
+
+    def test_pending_page_is_indexed_range_read(self, temp_db):
+        plans = self._plans(temp_db, lambda: temp_db.get_pending_requests_page(('2100-01-01 00:00:00', 1)))
+        assert len(plans) == 1
+        plan = next(iter(plans.values()))
+        assert any(d.startswith('SEARCH customer_requests USING INDEX idx_requests_pending') for d in plan)
+        assert not any('TEMP B-TREE' in d for d in plan)
+
+    def test_pending_requests_use_partial_index(self, temp_db):
+        self._assert_uses(self._plans(temp_db, temp_db.get_pending_requests), 'idx_requests_pending')
+
+    def test_active_users_use_time_indexes(self, temp_db):
+        plans = self._plans(temp_db, lambda: temp_db.get_active_user_ids(7))
+        self._assert_uses(plans, 'idx_stats_timestamp_user', 'idx_requests_created_user')
+
+    def test_cleanup_drops_partitions_instead_of_deleting_rows(self, temp_db):
+        temp_db.log_user_actions([(5, 'start', None, database._utc_cutoff_str(200))])
+        old_month = database._month_key(database._utc_cutoff_str(200))
+        assert old_month in temp_db._partitions
+
+        conn = temp_db.connections.get()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            temp_db.cleanup_old_data(90)
+        finally:
+            conn.set_trace_callback(None)
+
+        assert old_month not in temp_db._partitions
+        assert not any('DELETE FROM bot_stats' in sql for sql in statements)
+        # המחיצה הנוכחית נשארת ונגישה דרך ה-VIEW
+        assert conn.execute('SELECT COUNT(*) FROM bot_stats').fetchone()[0] == 1
+
+    def test_time_window_reads_only_overlapping_partitions(self, temp_db):
+        temp_db.log_user_actions([(5, 'start', None, database._utc_cutoff_str(200))])
+        old_table = 'bot_stats_' + database._month_key(database._utc_cutoff_str(200))
+        plans = self._plans(temp_db, lambda: temp_db.get_recent_users_by_window((7, 30)))
+        details = "\n".join(d for plan in plans.values() for d in plan)
+        assert old_table not in details
+
+    def test_recent_user_details_use_per_user_indexes(self, temp_db):
+        plans = self._plans(temp_db, lambda: temp_db.get_recent_users_with_details(7))
+        assert len(plans) == 1, "הפרטים צריכים להגיע בשאילתה אחת"
+        self._assert_uses(plans, 'idx_stats_timestamp_user', 'idx_requests_created_user',
+                          'idx_requests_user_created')
+
+class TestActionLogWriter:
+    """בדיקות תור הכתיבה ברקע של הסטטיסטיקות"""
+
+    def _count(self, db):
+        return db.connections.get().execute('SELECT COUNT(*) FROM bot_stats').fetchone()[0]
+
+    def test_enqueue_does_not_write_until_flush(self, temp_db):
+        """בדיקה שה-enqueue לא כותב בעצמו וש-flush כותב הכל"""
+        writer = database.ActionLogWriter(temp_db, batch_size=50, flush_interval=60)
+        for i in range(10):
+            assert writer.enqueue(i, 'start', {'n': i})
+        writer.flush()
+        assert self._count(temp_db) == 10
+        writer.stop()
+
+    def test_background_flush_by_size(self, temp_db):
+        """בדיקה שאצווה מלאה נכתבת ברקע בלי לחכות לחלון הזמן"""
+        writer = database.ActionLogWriter(temp_db, batch_size=5, flush_interval=0.2)
+        for i in range(5):
+            writer.enqueue(i, 'view_info')
+        deadline = time.monotonic() + 5
+        while self._count(temp_db) < 5 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert self._count(temp_db) == 5
+        writer.stop()
+
+    def test_stop_flushes_queue(self, temp_db):
+        """בדיקה שעצירה כותבת את מה שנשאר בתור"""
+        writer = database.ActionLogWriter(temp_db, batch_size=1000, flush_interval=60)
+        writer.enqueue(1, 'start')
+        writer.enqueue(2, 'start')
+        writer.stop()
+        assert self._count(temp_db) == 2
+
+    def test_stop_during_slow_batch_writes_everything(self, temp_db):
+        """עצירה בזמן שאצווה נכתבת לאט: stop חוזר אחרי הכתיבה ושום אירוע לא נשאר בתור"""
+        writer = database.ActionLogWriter(temp_db, batch_size=1, flush_interval=0.01)
+        write = writer._write
+        started = threading.Event()
+
+        def slow_write(batch):
+            started.set()
+            time.sleep(0.3)
+            write(batch)
+
+        writer._write = slow_write
+        writer.enqueue(0, 'start')
+        assert started.wait(5)
+        for i in range(1, 7):
+            writer.enqueue(i, 'start')
+
+        stopper = threading.Thread(target=writer.stop, kwargs={'timeout': 0.05})
+        stopper.start()
+        stopper.join(timeout=10)
+        assert not stopper.is_alive()
+        assert writer.pending == 0
+        assert self._count(temp_db) == 7
+
+    def test_full_queue_drops_instead_of_blocking(self, temp_db):
+        """בדיקה שתור מלא לא חוסם את ה-handler"""
+        writer = database.ActionLogWriter(temp_db, batch_size=1000, flush_interval=60, max_queue=1)
+        writer._stop_event.set()  # בלי חוט רקע כדי שהתור יישאר מלא
+        assert writer.enqueue(1, 'start')
+        assert not writer.enqueue(2, 'start')
+        assert writer.dropped == 1
+
 class TestUtils:
     """בדיקות פונקציות העזר"""
     
@@ -251,6 +1468,194 @@ class TestUtils:
         result = utils.validate_user_input("א", "name")
         assert result["valid"] == False
 
+    def test_retry_honours_retry_after(self):
+        """ב-RetryAfter ממתינים בדיוק את הזמן שטלגרם ביקש"""
+        from telegram.error import RetryAfter
+        calls = []
+
+        @utils.retry_on_error(max_retries=2, delay=5)
+        async def send():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RetryAfter(7)
+            return "ok"
+
+        with patch.object(utils.asyncio, 'sleep', new=AsyncMock()) as sleep:
+            assert asyncio.run(send()) == "ok"
+        sleep.assert_awaited_once_with(7.0)
+        assert utils.retry_after_seconds(ValueError()) is None
+
+
+class TestOutboundRateLimiter:
+    """מתזמן ההודעות היוצאות: דליי אסימונים, עדיפות ו-RetryAfter"""
+
+    def _request(self, limiter, chat_id, log, priority=None, result=True, endpoint='sendMessage'):
+        async def callback():
+            log.append((chat_id, priority))
+            if isinstance(result, Exception):
+                raise result
+            return result
+        data = {'chat_id': chat_id} if chat_id is not None else {}
+        return limiter.process_request(callback, (), {}, endpoint, data, priority)
+
+    def test_chat_bucket_paces_one_chat(self):
+        import outbound
+        limiter = outbound.OutboundRateLimiter(global_per_second=1000, chat_per_second=50, chat_burst=2)
+        log = []
+
+        async def go():
+            started = time.monotonic()
+            await asyncio.gather(*(self._request(limiter, 5, log) for _ in range(4)))
+            elapsed = time.monotonic() - started
+            await limiter.shutdown()
+            return elapsed
+
+        # 2 בפרץ ועוד 2 בקצב 50 לשנייה - לפחות 40ms
+        assert asyncio.run(go()) >= 0.035
+        assert len(log) == 4 and limiter.metrics()["sent"] == {"reply": 4}
+
+    def test_replies_before_background(self):
+        import outbound
+        limiter = outbound.OutboundRateLimiter(global_per_second=100, chat_per_second=100)
+        log = []
+
+        async def go():
+            # הדלי הגלובלי מתרוקן, ואז ממתינות הודעות רקע ותשובה שהגיעה אחריהן
+            limiter._ensure_dispatcher()
+            limiter._global.tokens = 0
+            background = [asyncio.create_task(self._request(limiter, 100 + i, log, outbound.PRIORITY_BACKGROUND))
+                          for i in range(3)]
+            await asyncio.sleep(0)
+            reply = asyncio.create_task(self._request(limiter, 7, log))
+            await asyncio.gather(*background, reply)
+            await limiter.shutdown()
+
+        asyncio.run(go())
+        assert log[0] == (7, None)
+        assert limiter.metrics()["sent"] == {"reply": 1, "background": 3}
+
+    def test_retry_after_pauses_and_retries(self):
+        import datetime as dtm
+        import outbound
+        from telegram.error import RetryAfter
+        limiter = outbound.OutboundRateLimiter(global_per_second=1000, chat_per_second=1000)
+        attempts = []
+
+        async def flaky():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(dtm.timedelta(milliseconds=50))
+            return True
+
+        async def go():
+            result = await limiter.process_request(flaky, (), {}, 'sendMessage', {'chat_id': 1}, None)
+            await limiter.shutdown()
+            return result
+
+        assert asyncio.run(go()) is True
+        assert attempts[1] - attempts[0] >= 0.045
+        metrics = limiter.metrics()
+        assert metrics["retry_after"] == 1 and metrics["failed"] == 0
+
+    def test_non_chat_requests_pass_through(self):
+        import outbound
+        limiter = outbound.OutboundRateLimiter()
+        log = []
+        assert asyncio.run(self._request(limiter, None, log, endpoint='getUpdates')) is True
+        assert limiter.metrics()["sent"] == {} and limiter._dispatcher is None
+
+
+class TestMenu:
+    """בדיקות רישום התפריט: ניתוב, מקלדת מוכנה ופעולות"""
+
+    def _update(self, text):
+        from telegram import Update
+        return Update.de_json({"update_id": 1, "message": {
+            "message_id": 1, "date": 0, "text": text,
+            "chat": {"id": 5, "type": "private"},
+            "from": {"id": 5, "is_bot": False, "first_name": "U"}}}, None)
+
+    def test_routing_and_actions(self):
+        import bot
+        handler = bot.MAIN_MENU.handler()
+        for key in ('whatsapp', 'info', 'callback', 'share'):
+            label = config.BUTTON_TEXTS[key]
+            assert handler.check_update(self._update(label))
+            assert bot.MAIN_MENU.action_for(label)
+        assert not handler.check_update(self._update("סתם טקסט"))
+        assert bot.MAIN_MENU.action_for("סתם טקסט") is None
+
+    def test_reply_uses_prebuilt_keyboard(self):
+        import bot
+        update = Mock()
+        update.message.text = config.BUTTON_TEXTS['info']
+        update.message.reply_text = AsyncMock()
+        asyncio.run(bot.MAIN_MENU.dispatch(update, Mock()))
+        kwargs = update.message.reply_text.call_args.kwargs
+        assert kwargs['reply_markup'] is bot.create_main_keyboard()
+        assert kwargs['parse_mode'] == 'Markdown'
+
+    def test_invalid_items_rejected(self):
+        import menu
+        with pytest.raises(ValueError):
+            menu.Menu([menu.MenuItem('info', 'a', reply='x'), menu.MenuItem('info', 'b', reply='y')])
+        with pytest.raises(ValueError):
+            menu.Menu([menu.MenuItem('info', 'a')])
+
+
+class TestConversationStateStore:
+    """מצב שיחה עם תפוגה, שנשמר בבסיס ושורד הפעלה מחדש"""
+
+    def test_set_get_clear(self, temp_db):
+        import state_store
+        store = state_store.ConversationStateStore(temp_db, ttl_seconds=60)
+        assert store.get(1) is None
+        store.set(1, 'waiting_for_details')
+        assert store.get(1) == 'waiting_for_details' and len(store) == 1
+        store.set(1, None)
+        assert store.get(1) is None and len(store) == 0
+        assert temp_db.get_conversation_state(1, 0) is None
+
+    def test_state_survives_restart(self, temp_db):
+        import state_store
+        state_store.ConversationStateStore(temp_db, ttl_seconds=60).set(7, 'waiting_for_details')
+        restarted = state_store.ConversationStateStore(temp_db, ttl_seconds=60)
+        assert len(restarted) == 0
+        assert restarted.get(7) == 'waiting_for_details'
+        assert restarted.get(8) is None
+        restarted.clear(7)
+        assert state_store.ConversationStateStore(temp_db).get(7) is None
+
+    def test_clear_without_state_skips_db_after_restart(self, temp_db):
+        """/start אחרי הפעלה מחדש (לפני כל get) לא מוחק מהבסיס למשתמש בלי מצב"""
+        import state_store
+        state_store.ConversationStateStore(temp_db, ttl_seconds=60).set(7, 'waiting_for_details')
+        restarted = state_store.ConversationStateStore(temp_db, ttl_seconds=60)
+        with patch.object(temp_db, 'delete_conversation_state',
+                          wraps=temp_db.delete_conversation_state) as delete:
+            restarted.clear(8)
+            restarted.clear(8)
+            delete.assert_not_called()
+            restarted.clear(7)
+            delete.assert_called_once_with(7)
+        assert restarted.get(7) is None
+
+    def test_expired_states_are_evicted(self, temp_db):
+        import state_store
+        store = state_store.ConversationStateStore(temp_db, ttl_seconds=60, purge_interval=0)
+        with patch.object(store, '_now', return_value=1000):
+            store.set(1, 'waiting_for_details')
+        with patch.object(store, '_now', return_value=1030):
+            store.set(2, 'waiting_for_details')
+        with patch.object(store, '_now', return_value=1070):
+            assert store.get(1) is None and store.get(2) == 'waiting_for_details'
+            assert len(store) == 1
+            store.set(3, 'waiting_for_details')
+        # הניקוי התקופתי מוחק גם מהבסיס
+        assert temp_db.get_active_conversation_ids(0) == [2, 3]
+        assert state_store.ConversationStateStore(temp_db).get(1) is None
+
+
 class TestBotKeyboard:
     """בדיקות מקלדת הבוט"""
     
@@ -272,6 +1677,13 @@ class TestBotKeyboard:
         for req_button in required_buttons:
             assert any(req_button in button for button in all_buttons), f"חסר כפתור: {req_button}"
 
+    def test_pending_cursor_round_trip(self):
+        """בדיקה שהסמן של /pending נכנס ל-callback_data ומתפענח בחזרה"""
+        from bot import _encode_pending_cursor, _decode_pending_cursor
+        token = _encode_pending_cursor({'created_at': '2025-01-02 03:04:05', 'id': 42})
+        assert len(f"pending:o:{token}") <= 64
+        assert _decode_pending_cursor(token) == ('2025-01-02 03:04:05', 42)
+
 class TestIntegration:
     """בדיקות אינטגרציה בין רכיבים"""
     
@@ -311,6 +1723,7 @@ class TestIntegration:
             assert success == True
             
         finally:
+            db.close()
             os.unlink(db_path)
 
 # פונקציות עזר לבדיקות ידניות
@@ -365,6 +1778,7 @@ def manual_test_database():
             print(f"  - {req['full_name']}: {req['message_text'][:30]}...")
     
     finally:
+        db.close()
         os.unlink(db_path)
     
     print("בדיקת מסד נתונים הושלמה ✅")
@@ -0,0 +1,130 @@
+"""
+עיבוד עדכונים במקביל עם שמירת סדר לכל משתמש
+עדכונים של משתמשים שונים רצים במקביל (עד concurrency), ועדכונים של אותו משתמש רצים
+אחד אחרי השני לפי סדר ההגעה - כך שמצב השיחה של המשתמש לא נתון למרוץ.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Dict, Hashable, Optional
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def ordering_key(update: object) -> Optional[Hashable]:
+    """המפתח שלפיו נשמר הסדר: המשתמש, ואם אין - הצ'אט. None = בלי דרישת סדר"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return ('chat', update.effective_chat.id)
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """BaseUpdateProcessor של PTB: עד concurrency עדכונים רצים בו-זמנית, וסדר קשיח לכל משתמש.
+
+    הסמפור של PTB נלקח לפני do_process_update, ולכן הוא משמש כאן רק כגבול לעדכונים
+    שבטיפול (max_in_flight, כולל ממתינים). ההגבלה על הריצה עצמה נלקחת רק אחרי שהגיע
+    תור המשתמש - עדכונים שממתינים למשתמש עסוק לא תופסים מקום ריצה של משתמשים אחרים.
+    """
+
+    def __init__(self, concurrency: int, max_in_flight: Optional[int] = None):
+        if concurrency < 1:
+            raise ValueError("concurrency חייב להיות חיובי")
+        super().__init__(max(max_in_flight or concurrency * 16, concurrency))
+        self.concurrency = concurrency
+        self._running = asyncio.Semaphore(concurrency)
+        # הזנב של השרשרת לכל מפתח: ה-Future של העדכון האחרון שנכנס עבורו
+        self._tails: Dict[Hashable, asyncio.Future] = {}
+        self._waiting = 0
+        self._active = 0
+        self._stats = {"processed": 0, "errors": 0, "max_waiting": 0, "max_active": 0,
+                       "wait_total_ms": 0.0, "wait_last_ms": 0.0, "wait_max_ms": 0.0,
+                       "run_total_ms": 0.0, "run_max_ms": 0.0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        # Application.stop כבר מחכה לכל המשימות - לא נשארות שרשראות פתוחות
+        self._tails.clear()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        entered = time.perf_counter()
+        key = ordering_key(update)
+        previous = None
+        done = None
+        if key is not None:
+            # הרישום קורה לפני כל await, ולכן סדר השרשרת הוא סדר ההגעה
+            previous = self._tails.get(key)
+            done = asyncio.get_running_loop().create_future()
+            self._tails[key] = done
+
+        self._waiting += 1
+        self._stats["max_waiting"] = max(self._stats["max_waiting"], self._waiting)
+        try:
+            try:
+                if previous is not None:
+                    # shield: ביטול של העדכון הזה לא מבטל את ה-Future של העדכון הקודם
+                    await asyncio.shield(previous)
+                await self._running.acquire()
+            finally:
+                self._waiting -= 1
+            try:
+                self._record_wait((time.perf_counter() - entered) * 1000)
+                await self._run(coroutine)
+            finally:
+                self._running.release()
+        finally:
+            if done is not None:
+                done.set_result(None)
+                if self._tails.get(key) is done:
+                    del self._tails[key]
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        self._active += 1
+        self._stats["max_active"] = max(self._stats["max_active"], self._active)
+        started = time.perf_counter()
+        try:
+            await coroutine
+        except Exception:
+            # השגיאה כבר עברה ל-error_handler של PTB בתוך process_update
+            self._stats["errors"] += 1
+            raise
+        finally:
+            self._active -= 1
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._stats["processed"] += 1
+            self._stats["run_total_ms"] += elapsed_ms
+            self._stats["run_max_ms"] = max(self._stats["run_max_ms"], elapsed_ms)
+
+    def _record_wait(self, wait_ms: float):
+        self._stats["wait_total_ms"] += wait_ms
+        self._stats["wait_last_ms"] = wait_ms
+        self._stats["wait_max_ms"] = max(self._stats["wait_max_ms"], wait_ms)
+
+    def metrics(self) -> Dict:
+        """עומק התור, זמני המתנה וריצה במילישניות"""
+        stats = self._stats
+        count = stats["processed"]
+        return {
+            "concurrency": self.concurrency,
+            "active": self._active,
+            "waiting": self._waiting,
+            "users_in_flight": len(self._tails),
+            "max_active": stats["max_active"],
+            "max_waiting": stats["max_waiting"],
+            "processed": count,
+            "errors": stats["errors"],
+            "wait_avg_ms": round(stats["wait_total_ms"] / count, 2) if count else 0.0,
+            "wait_last_ms": round(stats["wait_last_ms"], 2),
+            "wait_max_ms": round(stats["wait_max_ms"], 2),
+            "run_avg_ms": round(stats["run_total_ms"] / count, 2) if count else 0.0,
+            "run_max_ms": round(stats["run_max_ms"], 2),
+        }
@@ -7,6 +7,7 @@ import re
 import json
 import asyncio
 import hashlib
+import warnings
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, Any, List, Union
 from functools import wraps
@@ -198,8 +199,22 @@ def rate_limit(calls_per_minute: int = 10):
         return wrapper
     return decorator
 
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """כמה שניות טלגרם ביקש לחכות (RetryAfter), או None אם זו שגיאה אחרת"""
+    from telegram.error import RetryAfter
+
+    if not isinstance(error, RetryAfter):
+        return None
+    # ב-PTB 22 retry_after הוא int עם אזהרת deprecation, ובעתיד timedelta
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
 def retry_on_error(max_retries: int = 3, delay: float = 1.0):
-    """דקורטור לניסיון חוזר במקרה של שגיאה"""
+    """דקורטור לניסיון חוזר במקרה של שגיאה.
+    ב-RetryAfter (flood control) ממתינים בדיוק את הזמן שטלגרם ביקש במקום ההשהיה הקבועה.
+    """
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
@@ -210,8 +225,11 @@ def retry_on_error(max_retries: int = 3, delay: float = 1.0):
                     if attempt == max_retries:
                         logger.error(f"Failed after {max_retries} attempts: {e}")
                         raise
-                    logger.warning(f"Attempt {attempt + 1} failed: {e}, retrying in {delay}s")
-                    await asyncio.sleep(delay * (attempt + 1))
+                    wait = retry_after_seconds(e)
+                    if wait is None:
+                        wait = delay * (attempt + 1)
+                    logger.warning(f"Attempt {attempt + 1} failed: {e}, retrying in {wait}s")
+                    await asyncio.sleep(wait)
         return wrapper
     return decorator
 
@@ -0,0 +1,108 @@
+"""
+קבלת עדכונים מטלגרם ב-webhook, על אותו event loop של הבוט (aiohttp)
+הבקשה נענית מיד אחרי שהעדכון נכנס לתור של PTB - בלי לחכות לסיום ה-handler.
+הקבלה חסומה לפי מספר העדכונים שטרם הסתיים הטיפול בהם (בתור + בעיבוד): מעבר לזה
+מוחזר 503 וטלגרם ישלח את העדכון שוב מאוחר יותר.
+"""
+
+import asyncio
+import hmac
+import json
+from typing import Dict, Optional
+import logging
+
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# הכותרת שטלגרם שולח עם ה-secret_token שהוגדר ב-setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class PendingUpdatesQueue(asyncio.Queue):
+    """update_queue שחוסם לפי עדכונים שבטיפול ולא רק לפי מה שממתין בתור.
+
+    עם concurrent_updates ה-fetcher של PTB מוציא כל עדכון מיד למשימה משלו, כך שתור רגיל
+    כמעט תמיד ריק. PTB קורא ל-task_done רק כשהטיפול בעדכון הסתיים, ולכן pending סופר
+    את מה שבתור ואת מה שעדיין מעובד.
+    """
+
+    def __init__(self, max_pending: int):
+        super().__init__()
+        self.max_pending = max_pending
+        self.pending = 0
+
+    def put_nowait(self, item):
+        if self.pending >= self.max_pending:
+            raise asyncio.QueueFull
+        super().put_nowait(item)
+        self.pending += 1
+
+    async def put(self, item):
+        # put ממתין משמש את PTB לאות העצירה - הוא לא נחסם במגבלה
+        super().put_nowait(item)
+        self.pending += 1
+
+    def task_done(self):
+        super().task_done()
+        self.pending -= 1
+
+
+class WebhookServer:
+    """שרת aiohttp שמכניס עדכונים ל-update_queue של האפליקציה"""
+
+    def __init__(self, update_queue: asyncio.Queue, bot, path: str, secret_token: Optional[str],
+                 app: Optional[web.Application] = None):
+        self.update_queue = update_queue
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.app = app or web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self._runner: Optional[web.AppRunner] = None
+        self._accepting = True
+        self.stats: Dict[str, int] = {"accepted": 0, "forbidden": 0, "bad_request": 0, "queue_full": 0}
+
+    def reject_updates(self):
+        """מכאן והלאה כל עדכון נענה ב-503 (בכיבוי - כדי שלא ייכנס לתור שכבר לא מרוקן)"""
+        self._accepting = False
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not self._accepting:
+            return web.Response(status=503)
+        if self.secret_token:
+            provided = request.headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(provided.encode('utf-8'), self.secret_token.encode('utf-8')):
+                self.stats["forbidden"] += 1
+                return web.Response(status=403)
+
+        try:
+            update = Update.de_json(await request.json(loads=json.loads), self.bot)
+        except Exception as e:
+            self.stats["bad_request"] += 1
+            logger.debug(f"עדכון webhook לא תקין: {e}")
+            return web.Response(status=400)
+
+        try:
+            self.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # לחץ חוזר: טלגרם ינסה שוב, ועד אז ה-handlers מרוקנים את התור
+            self.stats["queue_full"] += 1
+            logger.warning("יותר מדי עדכונים בטיפול - מחזיר 503")
+            return web.Response(status=503)
+
+        self.stats["accepted"] += 1
+        return web.Response(status=200)
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"שרת webhook מאזין ב-{host}:{port}{self.path}")
+
+    async def stop(self):
+        """מפסיק לקבל בקשות (העדכונים שכבר בתור ממשיכים להיות מטופלים)"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None